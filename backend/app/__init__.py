@@ -1,7 +1,15 @@
-from flask import Flask, jsonify, send_from_directory
-from flask_cors import CORS
 import os
 import logging
+from app.utils.result_cache import ResultCache
+from app.utils.analysis_sessions import AnalysisSessionStore
+from app.utils.shared_arrays import sweep_orphaned_segments
+from app.utils.concurrency import configure_concurrency
+from app.utils.jobs import JobRegistry
+from app.utils.upload_store import UploadStore, start_janitor
+from app.utils.prepared_images import PreparedImageStore
+from app.utils.value_raster import ValueRasterStore
+from app.utils.result_files import ResultFiles
+from app.utils.planner import Planner
 
 class Config:
     BASE_DIR = os.path.abspath(os.path.dirname(__file__))
@@ -9,14 +17,72 @@ class Config:
     UPLOAD_FOLDER = os.path.join(STATIC_FOLDER, 'temp_uploads')
     ASSETS_FOLDER = os.path.join(STATIC_FOLDER, 'assets')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
-    ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+    ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'tif', 'tiff'}
+    CHUNKED_UPLOAD_FOLDER = os.path.join(UPLOAD_FOLDER, 'chunked')
+    UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # Chunk size suggested to clients; must stay below MAX_CONTENT_LENGTH
+    UPLOAD_STORE_FOLDER = os.path.join(UPLOAD_FOLDER, 'store')  # Uploads stored once per content hash
+    UPLOAD_STORE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # Size above which unused uploads are evicted, oldest first
+    UPLOAD_STORE_TTL = 24 * 60 * 60  # Seconds an unused upload (or abandoned chunked upload) is kept
+    UPLOAD_STORE_SWEEP_INTERVAL = 10 * 60  # Seconds between eviction sweeps
+    PREPARED_IMAGE_MAX_BYTES = 512 * 1024 * 1024  # Memory for images decoded ahead of their mask (POST /images)
+    PREPARED_IMAGE_TTL = 30 * 60  # Seconds an unused image id stays valid
+    PREPARE_WORKERS = 1  # Threads preparing images in the background
+    RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Memory budget for cached results
+    RESULT_CACHE_TTL = 60 * 60  # Seconds a cached result stays valid
+    RESULT_CACHE_DIR = None  # Set to a directory to persist cached results across restarts
+    RESULT_FILES_FOLDER = os.path.join(UPLOAD_FOLDER, 'exports')  # Preview, CSVs and exports, one directory per result
+    RESULT_FILES_MAX_BYTES = 2 * 1024 * 1024 * 1024  # Size above which result directories are removed, oldest first
+    RESULT_FILES_TTL = 60 * 60  # Seconds an unused result directory is kept
+    PREVIEW_MAX_SIZE = 1024  # Longest side of the segmented preview in pixels
+    MEMORY_LEAN = True  # uint8 pixels, compact label dtypes and in-place masking
+    ANALYSIS_SESSION_LIMIT = 16  # Sessions whose segmentation is kept for value-only recalculation
+    ANALYSIS_SESSION_TTL = 30 * 60  # Seconds an unused session is kept
+    INCREMENTAL_SEGMENTATION = True  # Re-segment only around mask edits within a session
+    ANALYSIS_WORKERS = None  # Worker processes for segmentation (None sizes the pool, 0 runs it on the request thread)
+    MAX_CONCURRENT_ANALYSES = None  # Analyses run at once (None sizes it from cores and memory)
+    MAX_QUEUED_ANALYSES = 8  # Analyses waiting for a slot before new ones are rejected with 429
+    ANALYSIS_QUEUE_TIMEOUT = 30  # Seconds an analysis waits for a slot before it is rejected with 429
+    ANALYSIS_MEMORY_ESTIMATE = 512 * 1024 * 1024  # Peak bytes of one analysis, for sizing concurrency
+    NATIVE_THREADS = None  # OpenCV/BLAS threads per analysis (None divides the cores among concurrent analyses)
+    JOB_TIME_LIMIT = 5 * 60  # Seconds an analysis may run before it is stopped (None for no limit; enforced on workers)
+    JOB_MEMORY_LIMIT = None  # Bytes of address space per worker process (None for no limit; POSIX only)
+    PLANNER_COSTS = None  # Starting cost model per engine and for the estimate, refitted from every run (None uses planner.DEFAULT_COSTS)
+    PLANNER_REQUEST_THREAD_MAX_SECONDS = 0.5  # Longest predicted segmentation run on the request thread (also under the limits)
+    TILE_SIZE = 256  # Side of the preview pyramid's tiles in pixels
+    TILE_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Memory for encoded preview tiles
+    TILE_CACHE_TTL = 60 * 60  # Seconds a preview tile is cached, here and by clients
+    VALUE_RASTER_TABLE_MAX_BYTES = 256 * 1024 * 1024  # Memory for the summed-area tables of region queries
+    ESTIMATE_MAX_SIZE = 256  # Longest side in pixels of the crop estimates (progressive or within a timeBudget) are computed on
+    IPC_SOCKET = None  # Unix domain socket also served besides TCP (set by run.py --socket)
+    APP_VERSION = None  # Version of the app that started the backend (set by run.py --app-version)
 
-logs_dir = os.path.expanduser('~/Logs/Vistar')
-os.makedirs(logs_dir, exist_ok=True)
-log_file = os.path.join(logs_dir, 'backend.log')
-logging.basicConfig(filename=log_file, level=logging.INFO)
+LOGS_DIR = os.path.expanduser('~/Logs/Vistar')
+
+def configure_file_logging():
+    """
+    Sends INFO and above to ~/Logs/Vistar/backend.log. Called by `create_app`
+    rather than on import, so the analysis modules can be imported without
+    touching the filesystem.
+    """
+    os.makedirs(LOGS_DIR, exist_ok=True)
+    log_file = os.path.join(LOGS_DIR, 'backend.log')
+    root = logging.getLogger()
+    if any(getattr(handler, 'baseFilename', None) == log_file for handler in root.handlers):
+        return
+    handler = logging.FileHandler(log_file)
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root.addHandler(handler)
+    if root.level > logging.INFO or root.level == logging.NOTSET:
+        root.setLevel(logging.INFO)
 
 def create_app():
+    configure_file_logging()
+
+    # Flask is imported here so the analysis modules under app.utils can be
+    # used without it (e.g. by the batch CLI)
+    from flask import Flask, jsonify, send_from_directory
+    from flask_cors import CORS
+
     app = Flask(__name__, static_folder='static')
     CORS(app)
 
@@ -31,6 +97,81 @@ def create_app():
     # Ensure upload and assets directories exist
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     os.makedirs(app.config['ASSETS_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['CHUNKED_UPLOAD_FOLDER'], exist_ok=True)
+
+    # Uploads deduplicated by content; unused ones are evicted by TTL and size quota
+    upload_store = UploadStore(
+        app.config['UPLOAD_STORE_FOLDER'],
+        max_bytes=app.config['UPLOAD_STORE_MAX_BYTES'],
+        ttl=app.config['UPLOAD_STORE_TTL'],
+    )
+    app.extensions['upload_store'] = upload_store
+
+    # Files of each result, removed with its cache entry or by TTL and size quota
+    def forget_result(result_id, path):
+        app.extensions['result_cache'].discard(result_id)
+        app.extensions['value_rasters'].discard(path)
+
+    result_files = ResultFiles(
+        app.config['RESULT_FILES_FOLDER'],
+        max_bytes=app.config['RESULT_FILES_MAX_BYTES'],
+        ttl=app.config['RESULT_FILES_TTL'],
+        on_remove=forget_result,
+    )
+    app.extensions['result_files'] = result_files
+    start_janitor(
+        upload_store, app.config['UPLOAD_STORE_SWEEP_INTERVAL'], stale_dirs=[app.config['CHUNKED_UPLOAD_FOLDER']],
+        sweepers=[result_files.evict],
+    )
+
+    # Images sent ahead of their mask, decoded while the user draws it
+    app.extensions['prepared_images'] = PreparedImageStore(
+        upload_store,
+        max_bytes=app.config['PREPARED_IMAGE_MAX_BYTES'],
+        ttl=app.config['PREPARED_IMAGE_TTL'],
+        workers=app.config['PREPARE_WORKERS'],
+    )
+
+    # Share the cores between concurrent analyses and bound the queue of waiting ones
+    plan, admission = configure_concurrency(app.config)
+    app.extensions['concurrency'] = plan
+    app.extensions['admission'] = admission
+
+    # Chooses how each segmentation runs, recalibrated from the timings it sees
+    app.extensions['planner'] = Planner(
+        costs=app.config['PLANNER_COSTS'], memory_limit=app.config['JOB_MEMORY_LIMIT'],
+        request_thread_max_seconds=app.config['PLANNER_REQUEST_THREAD_MAX_SECONDS'],
+        time_limit=app.config['JOB_TIME_LIMIT'],
+    )
+
+    # Analyses in progress, cancellable by id and bounded by JOB_TIME_LIMIT
+    app.extensions['jobs'] = JobRegistry(time_limit=app.config['JOB_TIME_LIMIT'])
+
+    # Remove shared memory left behind by a previous run that crashed
+    sweep_orphaned_segments()
+
+    # Whole-result cache shared by all requests
+    app.extensions['result_cache'] = ResultCache(
+        max_bytes=app.config['RESULT_CACHE_MAX_BYTES'],
+        ttl=app.config['RESULT_CACHE_TTL'],
+        persist_dir=app.config['RESULT_CACHE_DIR'],
+        on_evict=result_files.remove,
+    )
+
+    # Segmentations kept per client session for value-only recalculation
+    app.extensions['analysis_sessions'] = AnalysisSessionStore(
+        max_sessions=app.config['ANALYSIS_SESSION_LIMIT'],
+        ttl=app.config['ANALYSIS_SESSION_TTL'],
+    )
+
+    # Value rasters of single-mask analyses, for point, profile and region queries
+    app.extensions['value_rasters'] = ValueRasterStore(max_table_bytes=app.config['VALUE_RASTER_TABLE_MAX_BYTES'])
+
+    # Encoded tiles of the preview pyramids, rendered on first request
+    app.extensions['tile_cache'] = ResultCache(
+        max_bytes=app.config['TILE_CACHE_MAX_BYTES'],
+        ttl=app.config['TILE_CACHE_TTL'],
+    )
 
     # Custom static file serving for development
     @app.route('/static/<path:filename>')
@@ -40,6 +181,12 @@ def create_app():
     # Register blueprints or routes
     with app.app_context():
         from app.routes import api_bp
+        from app.upload_routes import uploads_bp
+        from app.value_routes import values_bp
+        from app.tile_routes import tiles_bp
         app.register_blueprint(api_bp)
+        app.register_blueprint(uploads_bp)
+        app.register_blueprint(values_bp)
+        app.register_blueprint(tiles_bp)
 
     return app
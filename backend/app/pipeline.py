@@ -0,0 +1,288 @@
+"""
+Library API of the analysis pipeline.
+
+Runs the analysis behind `/calculate-average` on NumPy arrays or image paths
+without Flask and without writing anything to disk:
+
+    from app.pipeline import ColorMap, Pipeline
+
+    color_map = ColorMap.default(top_value=1e20, bottom_value=1e14)
+    pipeline = Pipeline(color_map)
+    result = pipeline.run(image, mask)
+    result.average, result.stats, result.segment_table, result.labels
+
+    # Every frame of a multi-page TIFF or animated GIF
+    frames = pipeline.run_sequence('sweep.tif', mask, workers=4)
+
+A `ColorMap` is calibrated once and can be reused for any number of images.
+"""
+import os
+import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from skimage import io
+from app.utils.analysis import (
+    analyze_image, analyze_regions, regions_from_masks, regions_from_label_mask, ENGINE_PARAMS
+)
+from app.utils.color_map.color_map_segmentation import (
+    build_color_map_table, determine_distribution_type
+)
+from app.utils.color_map.grid_segmentation import grid_segmentation, extract_grid_segment_colors
+from app.utils.image_io import decode_image, iter_frames
+from app.utils.sequence_analysis import analyze_sequence
+from app.utils.concurrency import limit_native_threads
+
+DEFAULT_COLOR_MAP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'assets', 'color_map_crop.jpg')
+
+
+def _as_image(image, page=0):
+    """Returns `image` as an array, decoding it first if it is a path."""
+    if isinstance(image, (str, os.PathLike)):
+        return decode_image(os.fspath(image), page=page)
+    return np.asarray(image)
+
+
+def _as_mask(mask):
+    """Returns a 2D uint8 mask (non-zero inside) from a path or an array."""
+    if isinstance(mask, (str, os.PathLike)):
+        mask = decode_image(os.fspath(mask))
+    mask = np.asarray(mask)
+    if mask.ndim == 3:
+        mask = (mask[..., :3] > 0).any(axis=2)
+    return (mask > 0).astype(np.uint8) * 255
+
+
+class ColorMap:
+    """
+    A calibrated colour map: the mean colour of each band of the colour bar and
+    the value assigned to it.
+
+    Args:
+        image (str or numpy.ndarray): Colour bar image (top = highest value) or its path.
+        top_value (float): Value of the top band.
+        bottom_value (float): Value of the bottom band.
+        num_bands (int): Number of bands the bar is split into.
+    """
+
+    def __init__(self, image, top_value, bottom_value, num_bands=ENGINE_PARAMS['color_map_grid_rows']):
+        if isinstance(image, (str, os.PathLike)):
+            image = io.imread(os.fspath(image))
+        segments, resized = grid_segmentation(np.asarray(image), num_rows=num_bands)
+        self._band_colors = extract_grid_segment_colors(segments, resized)
+        self._set_values(top_value, bottom_value)
+
+    @classmethod
+    def default(cls, top_value, bottom_value):
+        """Calibrates the bundled Sentaurus TCAD colour map."""
+        return cls(DEFAULT_COLOR_MAP, top_value, bottom_value)
+
+    def _set_values(self, top_value, bottom_value):
+        self.top_value = top_value
+        self.bottom_value = bottom_value
+        self.table = build_color_map_table(self._band_colors, bottom_value, top_value)
+
+    def with_values(self, top_value, bottom_value):
+        """
+        Returns a copy with a different value range, reusing the sampled band
+        colours instead of segmenting the colour bar again.
+        """
+        color_map = copy.copy(self)
+        color_map._set_values(top_value, bottom_value)
+        return color_map
+
+    @property
+    def distribution(self):
+        """Value distribution used across the bands ('linear', 'log' or 'symlog')."""
+        return determine_distribution_type(self.bottom_value, self.top_value)
+
+    @property
+    def colors(self):
+        """(N, 3) array of the band colours, top band first."""
+        return self.table[['R', 'G', 'B']].to_numpy()
+
+    @property
+    def values(self):
+        """Value of each band, top band first."""
+        return self.table['Assigned_Value'].to_numpy()
+
+    def __repr__(self):
+        return f"ColorMap(bands={len(self.table)}, top={self.top_value}, bottom={self.bottom_value})"
+
+
+class AnalysisResult:
+    """
+    Result of `Pipeline.run`.
+
+    Attributes:
+        average (float): Area-weighted average value inside the mask.
+        color_map_data (list): Per-colour legend rows, as in the endpoint's 'colorMapData'.
+        stats (dict): Statistics block, as in the endpoint's 'stats'.
+        segment_table (pandas.DataFrame): One row per segment kept inside the
+            mask: Segment, R, G, B, PixelCount, PercentageArea, Assigned_Value.
+        segment_stats (pandas.DataFrame): Raw statistics of every segment.
+        labels (numpy.ndarray): Segment labels of the analysed region.
+        bbox (tuple): (top, bottom, left, right) of `labels` in the image.
+        image_shape (tuple): Height and width of the input image.
+        regions (list): For `Pipeline.run_regions`, one dict per region with
+            'region' and either 'average', 'colorMapData' and 'stats' or
+            'error'; the other attributes then describe the union of the regions.
+    """
+
+    def __init__(self, analysis, image_shape, region_names=None):
+        results = analysis['results']
+        self.average = results['average']
+        self.color_map_data = results['colorMapData']
+        self.stats = results['stats']
+        self.segment_table = analysis['merged_df']
+        self.segment_stats = analysis['segment_stats']
+        self.labels = analysis['segments']
+        self.bbox = analysis['bbox']
+        self.image_shape = image_shape
+        self.regions = []
+        for name, region in zip(region_names or [], analysis.get('regions', [])):
+            if 'error' in region:
+                self.regions.append({'region': name, 'error': region['error']})
+            else:
+                self.regions.append({
+                    'region': name,
+                    'average': region['results']['average'],
+                    'colorMapData': region['results']['colorMapData'],
+                    'stats': region['results']['stats'],
+                })
+
+    def label_image(self):
+        """
+        Returns the labels placed in a full-size array; 0 outside the analysed region.
+        """
+        top, bottom, left, right = self.bbox
+        full = np.zeros(self.image_shape, dtype=self.labels.dtype)
+        full[top:bottom, left:right] = np.maximum(self.labels, 0)
+        return full
+
+    def to_dict(self):
+        """Returns the result in the JSON layout of `/calculate-average`."""
+        result = {
+            'average': self.average,
+            'colorMapData': self.color_map_data,
+            'stats': self.stats,
+        }
+        if self.regions:
+            result['regions'] = self.regions
+        return result
+
+    def __repr__(self):
+        return f"AnalysisResult(average={self.average!r}, segments={len(self.segment_table)})"
+
+
+class Pipeline:
+    """
+    Analyses images against a calibrated colour map.
+
+    Args:
+        color_map (ColorMap): Calibrated colour map, shared by every run.
+        memory_lean (bool): Compact label dtypes and in-place masking.
+        k (int): Neighbouring bands used when interpolating unmatched colours.
+        use_inverse_distance (bool): Weight the neighbours by inverse LAB distance.
+    """
+
+    def __init__(self, color_map, memory_lean=True, k=ENGINE_PARAMS['merge_k'],
+                 use_inverse_distance=ENGINE_PARAMS['merge_inverse_distance']):
+        self.color_map = color_map
+        self.memory_lean = memory_lean
+        self.k = k
+        self.use_inverse_distance = use_inverse_distance
+
+    def run(self, image, mask, page=0):
+        """
+        Analyses the masked region of one image.
+
+        Args:
+            image (str or numpy.ndarray): Image or its path; any layout and
+                dtype `open_image_lazy` produces (grey, RGB, RGBA, 8/16-bit, float).
+            mask (str or numpy.ndarray): Mask of the same height and width, or
+                its path; non-zero pixels are analysed.
+            page (int): TIFF page when `image` is a path.
+
+        Returns:
+            AnalysisResult: The analysis result.
+
+        Raises:
+            ValueError: If the mask does not fit the image or selects nothing.
+        """
+        image = _as_image(image, page=page)
+        analysis = analyze_image(
+            image, _as_mask(mask), self.color_map.table, memory_lean=self.memory_lean,
+            k=self.k, use_inverse_distance=self.use_inverse_distance,
+        )
+        return AnalysisResult(analysis, image.shape[:2])
+
+    def run_regions(self, image, masks, page=0):
+        """
+        Analyses several regions of one image with a single segmentation.
+
+        Args:
+            image (str or numpy.ndarray): Image or its path.
+            masks (list or str or numpy.ndarray): A list of masks (arrays or
+                paths), one per region; or one label-valued mask (array or
+                path) whose distinct non-zero values are the regions.
+            page (int): TIFF page when `image` is a path.
+
+        Returns:
+            AnalysisResult: Result of the union, with per-region results in `regions`.
+        """
+        image = _as_image(image, page=page)
+        if isinstance(masks, (list, tuple)):
+            regions = regions_from_masks([_as_mask(mask) for mask in masks])
+            region_names = list(range(1, len(masks) + 1))
+        else:
+            label_mask = decode_image(os.fspath(masks)) if isinstance(masks, (str, os.PathLike)) else np.asarray(masks)
+            if label_mask.ndim == 3:
+                label_mask = label_mask[..., 0]
+            regions, label_values = regions_from_label_mask(label_mask)
+            region_names = label_values.tolist()
+
+        analysis = analyze_regions(
+            image, regions, self.color_map.table, memory_lean=self.memory_lean,
+            k=self.k, use_inverse_distance=self.use_inverse_distance,
+        )
+        return AnalysisResult(analysis, image.shape[:2], region_names=region_names)
+
+    def run_sequence(self, frames, mask, workers=1):
+        """
+        Analyses every frame of a sequence (time series, parameter sweep) with
+        one mask; the crop and segmentation parameters are shared by all
+        frames. Frames are decoded one at a time.
+
+        Args:
+            frames (str or iterable): Path of a multi-page TIFF or animated
+                GIF, an (N, H, W[, C]) array, or any iterable of frames.
+            mask (str or numpy.ndarray): Mask of the frame size, or its path.
+            workers (int): Worker processes segmenting frames in parallel;
+                1 analyses them in this process.
+
+        Returns:
+            list: One dict per frame with 'frame' (its index) and either
+            'average', 'colorMapData' and 'stats' or 'error'.
+        """
+        if isinstance(frames, (str, os.PathLike)):
+            frames = iter_frames(os.fspath(frames))
+        mask = _as_mask(mask)
+
+        options = {'memory_lean': self.memory_lean, 'k': self.k, 'use_inverse_distance': self.use_inverse_distance}
+        if workers <= 1:
+            return analyze_sequence(frames, mask, self.color_map.table, **options)
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=limit_native_threads,
+            initargs=(max((os.cpu_count() or 1) // workers, 1),),
+        ) as pool:
+            return analyze_sequence(frames, mask, self.color_map.table, pool=pool, max_pending=2 * workers, **options)
+
+    def run_many(self, items):
+        """
+        Analyses (image, mask) pairs one after another, yielding their results.
+        """
+        for image, mask in items:
+            yield self.run(image, mask)
@@ -1,19 +1,45 @@
-from flask import Blueprint, request, jsonify, current_app, url_for
+from flask import Blueprint, request, jsonify, current_app, url_for, send_from_directory
 import os
+import json
 import logging
+import threading
+import time
+import uuid
 from werkzeug.utils import secure_filename
 import cv2
 import numpy as np
 import pandas as pd
-from statistics import mode
 from app.utils.file_utils import allowed_file
-from app.utils.color_map.color_map_segmentation import process_color_map
-from app.utils.calculate_average import calculate_average
+from app.utils.color_map.color_map_segmentation import calibrate_color_map
+from app.utils.aggregate_results import aggregate_results
+from app.utils.export_results import export_results, LABELS_FILENAME, TABLE_FILENAME
+from app.utils.value_raster import write_value_raster, VALUES_FILENAME
 from app.utils.image_segmentation.felzenszwalb_segmentation import (
-    felzenszwalb_segmentation, extract_segment_colors_and_areas, export_segment_data_to_csv, find_optimal_felzenszwalb_params
+    felzenszwalb_segment_array, felzenszwalb_params_for_shape,
+    extract_segment_colors_and_areas, export_segment_data_to_csv, segment_data_to_frame,
+    segment_sums, statistics_from_sums, select_segments
 )
+from app.utils.image_segmentation.incremental_segmentation import resegment_mask_edit
+from app.utils.image_io import open_image_lazy, iter_frames, load_mask, load_label_mask, to_rgb8, mask_bounding_box
+from app.utils.analysis import (
+    ENGINE_PARAMS, SEGMENTATION_MARGIN, crop_to_mask, segment_regions, aggregate_segments, plan_segment_values,
+    regions_from_masks, regions_from_label_mask, estimate_average
+)
+from app.pipeline import ColorMap
+from app.utils.chunked_upload import get_completed_upload_path
+from app.utils.vector_mask import parse_mask_geometry, rasterize_mask, geometry_bounding_box, canonical_geometry
+from app.utils.shared_arrays import get_registry
+from app.utils.sequence_analysis import analyze_sequence
+from app.utils.worker_pool import run_segmentation_in_worker, run_sequence_in_workers, WorkerDied
+from app.utils.concurrency import Saturated
+from app.utils.planner import ENGINES, measure_features, describe_plan
+from app.utils.scenarios import parse_scenarios, evaluate_scenarios
+from app.utils.jobs import JobCancelled, client_disconnected
+from app.utils.image_segmentation.segment_preview import render_segment_preview
+from app.utils.image_segmentation.tile_pyramid import write_tile_labels
 from app.utils.wait_for_file import wait_for_file
 from app.utils.merge_csv import merge_csv_files
+from app.utils.result_cache import build_cache_key, hash_bytes, hash_file, Unshared
 
 api_bp = Blueprint('api', __name__)
 
@@ -21,296 +47,1261 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 STATIC_DIR = os.path.join(BASE_DIR, 'static')
 TEMP_UPLOADS_DIR = os.path.join(STATIC_DIR, 'temp_uploads')
 ASSETS_DIR = os.path.join(STATIC_DIR, 'assets')
+EXPORT_FILENAMES = {'labels': LABELS_FILENAME, 'table': TABLE_FILENAME, 'values': VALUES_FILENAME}
 
-def apply_mask_to_image(image_path, mask_path):
+def apply_mask_to_image(image_path, mask, memory_lean=False):
     """
     Applies a binary mask to an image, setting pixels outside the mask to black.
     
     Args:
         image_path (str): Path to the input image
-        mask_path (str): Path to the binary mask image
+        mask (numpy.ndarray): 2D mask of the same size; non-zero is inside
+        memory_lean (bool): Decode straight to 8-bit 3-channel and mask in place
         
     Returns:
-        numpy.ndarray: Masked RGB image
+        numpy.ndarray: Masked image (OpenCV channel order)
     """
-    # Read the images
-    image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
-    mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
-    
-    # Convert RGBA to RGB if necessary
-    if image.shape[-1] == 4:
-        image = cv2.cvtColor(image, cv2.COLOR_RGBA2RGB)
-    
+    image = read_image_for_masking(image_path, memory_lean=memory_lean)
+    if image.shape[:2] != mask.shape:
+        raise AnalysisError(f'Mask size {mask.shape[::-1]} does not match image size {image.shape[1::-1]}', 400)
+
+    if memory_lean:
+        image[mask == 0] = 0
+        return image
+
     # Apply the mask
     masked_image = image.copy()
     masked_image[mask == 0] = [0, 0, 0]
     
     return masked_image
 
-def generate_comparison_graph(merged_csv_path, output_image_path):
-    stats = {}  # Dictionary to return additional stats
 
+def read_image_for_masking(image_path, memory_lean=False):
+    """
+    Reads an image as `apply_mask_to_image` masks it (OpenCV channel order).
+    """
+    if memory_lean:
+        # Alpha is dropped by the decoder, so no converted copy is needed
+        return cv2.imread(image_path, cv2.IMREAD_COLOR)
+
+    image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+
+    # Convert RGBA to RGB if necessary
+    if image.shape[-1] == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_RGBA2RGB)
+    return image
+
+class AnalysisError(Exception):
+    """An analysis failure that is reported to the client as a JSON error."""
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class UncachedResponse(Exception):
+    """Carries a non-successful response out of a cached computation."""
+
+    def __init__(self, response):
+        super().__init__(response.status)
+        self.response = response
+
+
+class PrivateResponse(UncachedResponse, Unshared):
+    """
+    An uncached response that only holds for the request that computed it;
+    requests coalesced onto that computation run their own instead.
+    """
+
+
+def _uncached(response, sources):
+    """
+    Wraps a response that must not be cached. A cancelled job (409: its
+    client went away, cancelled or was superseded) says nothing about the
+    other requests waiting on the same result, and neither does a result
+    computed from a session's incrementally updated segmentation, which
+    only approximates a full analysis of the same inputs.
+    """
+    if response.status_code == 409 or sources.get('approximate'):
+        return PrivateResponse(response)
+    return UncachedResponse(response)
+
+
+def _upload_hash(file_storage):
+    """Hashes an uploaded file and rewinds it so it can still be saved."""
+    data = file_storage.stream.read()
+    file_storage.stream.seek(0)
+    return hash_bytes(data)
+
+
+def _source_hash(sources, kind):
+    """Content hash of the image or mask, whether sent inline or as a stored upload."""
+    file_storage = sources.get(f'{kind}_file')
+    if file_storage is not None:
+        return _upload_hash(file_storage)
+    if kind == 'mask' and sources.get('mask_geometry') is not None:
+        return hash_bytes(canonical_geometry(sources['mask_geometry']).encode())
+    return hash_file(sources[f'{kind}_path'])
+
+
+def _image_fingerprint(sources):
+    """
+    Identifies the image of a request by content, plus the settings its
+    segmentation depends on apart from the masks.
+    """
+    return build_cache_key(
+        _source_hash(sources, 'image'),
+        page=sources.get('page', 0),
+        memory_lean=current_app.config['MEMORY_LEAN'],
+    )
+
+
+def _input_fingerprint(sources):
+    """
+    Identifies the image and masks of a request by content, plus everything
+    else the segmentation depends on. Requests with the same fingerprint
+    segment identically.
+    """
+    region_mask_files = sources.get('region_mask_files')
+    if region_mask_files:
+        mask_hash = build_cache_key(*(_upload_hash(f) for f in region_mask_files))
+        region_names = tuple(f.filename for f in region_mask_files)
+    else:
+        mask_hash = _source_hash(sources, 'mask')
+        region_names = None
+
+    return build_cache_key(
+        sources['image_fingerprint'],
+        mask_hash,
+        mask_mode=sources['mask_mode'],
+        region_names=region_names,
+    )
+
+
+def _result_cache_key(sources, top_value, bottom_value):
+    """
+    Builds the result cache key from the request's input content and parameters.
+    """
+    color_map_source = request.form.get('colorMapSource', 'sentaurus')
+    if color_map_source == 'other' and 'colorMap' in request.files:
+        color_map_hash = _upload_hash(request.files['colorMap'])
+    else:
+        color_map_hash = hash_file(os.path.join(ASSETS_DIR, 'color_map_crop.jpg'))
+
+    image_file = sources.get('image_file')
+    image_name = image_file.filename if image_file is not None else sources['image_path']
+
+    return build_cache_key(
+        sources['fingerprint'],
+        color_map_hash,
+        top_value=top_value,
+        bottom_value=bottom_value,
+        color_map_source=color_map_source,
+        sequence=sources.get('sequence', False),
+        scenarios=json.dumps(sources.get('scenarios'), sort_keys=True),
+        image_filename=secure_filename(os.path.basename(image_name)),
+        host_url=request.host_url,
+        **ENGINE_PARAMS,
+    )
+
+
+def _save_upload(file_storage, job):
+    """
+    Saves an uploaded file to the content-addressed upload store, held by
+    `job` until it ends, and returns its path. Identical uploads share one
+    file, along with the decode caches written next to it.
+    """
+    return current_app.extensions['upload_store'].put_file(file_storage, owner=job.id)
+
+
+def _open_stored_image(sources, job):
+    """
+    Returns the image of a request that refers to it by upload or image id:
+    the frame prepared in the background for an 'imageId' when there is one,
+    otherwise the stored file opened lazily.
+    """
+    prepared = sources.get('prepared')
+    if prepared is not None:
+        frame = prepared.wait(job=job)
+        if frame is not None:
+            return frame
+    return open_image_lazy(sources['image_path'], page=sources.get('page', 0))
+
+
+def _uploaded_file_path(sources, kind, job):
+    """
+    Saves the request's uploaded 'image' or 'mask' file to the upload store
+    the first time it is needed and returns its path; the upload itself is
+    gone once the request has been answered.
+    """
+    key = f'{kind}_saved_path'
+    if key not in sources:
+        sources[key] = _save_upload(sources[f'{kind}_file'], job)
+    return sources[key]
+
+
+def _source_mask(sources, job, labels=False):
+    """
+    Returns the mask of a request as an array, read once: rasterized from
+    its 'mask_geometry', or decoded from the uploaded 'mask_file' or stored
+    'mask_path'. With `labels`, as a label-valued mask (`load_label_mask`).
+    The mask is kept in `sources` for the later phases of the request.
+    """
+    key = 'label_mask' if labels else 'mask'
+    if key not in sources:
+        geometry = sources.get('mask_geometry')
+        if geometry is not None:
+            sources[key] = rasterize_mask(geometry, labels=labels)
+        else:
+            mask_path = _uploaded_file_path(sources, 'mask', job) if 'mask_file' in sources else sources['mask_path']
+            sources[key] = load_label_mask(mask_path) if labels else load_mask(mask_path)
+    return sources[key]
+
+
+def _source_mask_bbox(sources):
+    """
+    The crop `crop_to_mask` would take, worked out from a geometry's vertices
+    instead of scanning the mask; None for masks sent as images.
+    """
+    geometry = sources.get('mask_geometry')
+    if geometry is None:
+        return None
+    return geometry_bounding_box(geometry, margin=SEGMENTATION_MARGIN)
+
+
+def _segment_stored_upload(image, mask, memory_lean, job, keep_frame=False, bbox=None, engine=None):
+    """
+    Segments a stored upload without converting the whole image.
+
+    `image` comes from `_open_stored_image` and `mask` from `_source_mask`;
+    only the mask's bounding box (`bbox` when known), plus a margin for the
+    Gaussian smoothing, is read and converted to 8-bit RGB.
+
+    Returns:
+        tuple: (segments, segmentation input, SharedArraySpec or None, mask,
+        frame, bbox) for the cropped region; frame is the `_edit_frame` of the
+        crop when `keep_frame` is set, otherwise None.
+    """
     try:
-        df = pd.read_csv(merged_csv_path)
+        region, mask, bbox = crop_to_mask(image, mask, bbox=bbox)
+    except ValueError as e:
+        raise AnalysisError(str(e), 400)
+
+    params = felzenszwalb_params_for_shape(*image.shape[:2])
+    frame = None
+    if keep_frame:
+        top, bottom, left, right = bbox
+        frame = _edit_frame(to_rgb8(image[top:bottom, left:right]), bbox, image.shape[:2], params)
+
+    segments, segmentation_input, segments_spec = _segment_array(
+        region, mask > 0, *params, memory_lean, job, engine=engine
+    )
+    return segments, segmentation_input, segments_spec, mask, frame, bbox
+
+
+def _edit_frame(frame, bbox, image_shape, params):
+    """
+    What a session keeps to update its segmentation when the mask is edited
+    (see `_recalculate_mask_edit`): the unmasked uint8 RGB pixels that were
+    segmented, where they lie in the image and the Felzenszwalb parameters.
+    """
+    return {'frame': frame, 'bbox': bbox, 'image_shape': image_shape, 'params': params}
+
+
+def _segmentation_engines(rgb8):
+    """
+    The engines a segmentation may run on: workers take uint8 RGB images
+    only (`rgb8`) and unless ANALYSIS_WORKERS is 0.
+    """
+    if current_app.config['ANALYSIS_WORKERS'] == 0 or not rgb8:
+        return ['request_thread']
+    return ['worker', 'request_thread']
+
+
+def _segment_array(image, mask, scale, sigma, min_size, memory_lean, job, engine=None):
+    """
+    Segments an in-memory image in a worker process or on the request thread,
+    whichever the planner predicts to be cheaper for it (see `Planner`), or
+    as `engine` says. Workers are only available for uint8 RGB images and
+    unless ANALYSIS_WORKERS is 0. The plan is kept on the job.
+
+    In a worker the segmentation is stopped as soon as `job` is cancelled or
+    runs out of time, and JOB_MEMORY_LIMIT applies; on the request thread the
+    job is only checked before and after it. So under JOB_TIME_LIMIT or
+    JOB_MEMORY_LIMIT the planner leaves only runs predicted to be short and
+    small on the request thread, and refuses to force bigger ones there.
+
+    Returns:
+        tuple: (segments, segmentation input, SharedArraySpec of the segments
+        or None when segmentation ran in this process).
+    """
+    engines = _segmentation_engines(image.dtype == np.uint8 and image.ndim == 3 and image.shape[2] == 3)
+    features = measure_features(image, mask, ENGINE_PARAMS['color_map_grid_rows'])
+    try:
+        job.plan = current_app.extensions['planner'].choose(features, engines, override=engine)
+    except ValueError as e:
+        raise AnalysisError(str(e), 400)
+    job.plan_started = time.monotonic()
+
+    concurrency = current_app.extensions['concurrency']
+    if job.plan.engine == 'worker':
+        return run_segmentation_in_worker(
+            image, mask, scale, sigma, min_size, memory_lean, job, concurrency.workers,
+            threads=concurrency.threads, memory_limit=current_app.config['JOB_MEMORY_LIMIT'],
+        )
+
+    job.check()
+    segments, segmentation_input = felzenszwalb_segment_array(
+        image, mask, scale, sigma, min_size, memory_lean=memory_lean
+    )
+    # A run the planner misjudged is still reported as out of time
+    job.check()
+    return segments, segmentation_input, None
+
+
+def _export_in_background(segments, merged_df, export_dir, segments_spec, raster_args):
+    """
+    Writes the binary exports, the value raster (see `write_value_raster`) and
+    the labels the preview tiles are cut from, then drops the reference held
+    on shared labels.
+    """
+    try:
+        export_results(segments, merged_df, export_dir)
+        write_value_raster(segments, merged_df, export_dir, **raster_args)
+        write_tile_labels(segments, export_dir, mask=raster_args['mask'])
+    finally:
+        if segments_spec is not None:
+            get_registry().release(segments_spec.name)
+
+def _resolve_color_map_path(upload_folder):
+    """
+    Returns the colour map to use: the request's custom upload (saved to
+    `upload_folder`) or the bundled Sentaurus TCAD colour map.
+    """
+    # Process color map - use custom upload if provided, otherwise use default
+    color_map_source = request.form.get('colorMapSource', 'sentaurus')
+    if color_map_source == 'other' and 'colorMap' in request.files:
+        color_map_file = request.files['colorMap']
+        if color_map_file.filename != '':
+            if allowed_file(color_map_file.filename):
+                color_map_filename = secure_filename(color_map_file.filename)
+                # Normalize path for Windows compatibility (handles backslashes properly)
+                color_map_path = os.path.normpath(os.path.join(upload_folder, color_map_filename))
+                color_map_file.save(color_map_path)
+
+                # Wait for file to be fully written (Windows may need time to flush)
+                if not wait_for_file(color_map_path, timeout=5):
+                    raise AnalysisError(f'Color map file not accessible: {color_map_path}')
+
+                # Verify file is readable and not empty
+                if not os.path.exists(color_map_path):
+                    raise AnalysisError(f'Color map file not found: {color_map_path}')
+                if os.path.getsize(color_map_path) == 0:
+                    raise AnalysisError('Color map file is empty')
+            else:
+                raise AnalysisError('Invalid color map file type', 400)
+        else:
+            raise AnalysisError('No color map file provided', 400)
+    else:
+        # Use default Sentaurus TCAD color map
+        color_map_path = os.path.join(ASSETS_DIR, 'color_map_crop.jpg')
+
+    return color_map_path
 
-        required_columns = ['Segment', 'R', 'G', 'B', 'Assigned_Value']
-        if not all(col in df.columns for col in required_columns):
-            return stats
 
-        df_sorted = df.sort_values('Segment').reset_index(drop=True)
+def _request_color_map_path(sources):
+    """
+    The colour map of a request (see `_resolve_color_map_path`), resolved once
+    so phases that run after the request has been answered still find it.
+    """
+    if 'color_map_path' not in sources:
+        sources['color_map_path'] = _resolve_color_map_path(current_app.config['UPLOAD_FOLDER'])
+    return sources['color_map_path']
 
-        # Basic statistics
-        assigned_values = df_sorted['Assigned_Value']
-        stats['num_segments'] = len(df_sorted)
-        stats['max_value'] = assigned_values.max()
-        stats['min_value'] = assigned_values.min()
-        stats['mean'] = assigned_values.mean()
-        stats['median'] = assigned_values.median()
+
+def _request_color_map(sources, top_value, bottom_value):
+    """
+    Returns the request's colour map calibrated for its values, sampling the
+    colour bar only once per request.
+    """
+    color_map = sources.get('color_map')
+    if color_map is None:
         try:
-            stats['mode'] = mode(assigned_values)
-        except:
-            stats['mode'] = "No unique mode"
-
-        # Plot
-        # plt.figure(figsize=(20, 12))
-        # x_vals = df_sorted['Segment']
-        # plt.plot(x_vals, assigned_values, color='purple', marker='o', linestyle='-', label='Assigned Value')
-
-        # # Add mean, median, mode lines
-        # plt.axhline(stats['mean'], color='black', linestyle='--', linewidth=2, label=f'Mean: {stats["mean"]:.2f}')
-        # plt.axhline(stats['median'], color='orange', linestyle='--', linewidth=2, label=f'Median: {stats["median"]:.2f}')
-        # if isinstance(stats['mode'], (int, float)):
-        #     plt.axhline(stats['mode'], color='blue', linestyle='--', linewidth=2, label=f'Mode: {stats["mode"]:.2f}')
-
-        # plt.title('Assigned Value per Segment', fontsize=24)
-        # plt.xlabel('Segment', fontsize=24)
-        # plt.ylabel('Assigned Value', fontsize=24)
-        # plt.xticks(fontsize=18)
-        # plt.yticks(fontsize=18)
-        # plt.legend(fontsize=18)
-        # plt.tight_layout()
-        # plt.savefig(output_image_path)
-        # plt.close()
-
-        return stats
+            color_map = ColorMap(_request_color_map_path(sources), top_value, bottom_value)
+        except AnalysisError:
+            raise
+        except Exception as e:
+            logging.exception("Error processing color map")
+            raise AnalysisError(f'Failed to process color map: {str(e)}')
+        sources['color_map'] = color_map
+    return color_map
+
+
+def _run_calculation(sources, top_value, bottom_value, result_id, job):
+    """
+    Runs the full analysis for one request and returns its JSON response.
+
+    `sources` holds the image and mask either as uploaded files ('image_file',
+    'mask_file') or as paths of stored chunked uploads ('image_path',
+    'mask_path', plus the TIFF 'page'); an image sent ahead with POST /images
+    also carries its 'prepared' `PreparedImage`, and a mask may instead be
+    the selection shapes of 'mask_geometry'. Multi-region requests carry
+    several masks ('region_mask_files') or a label-valued mask ('mask_mode'
+    of 'labels'); 'sequence' requests analyse every frame of the image.
+    `result_id` names the directory the binary exports are written to, and
+    `job` is the `Job` the analysis runs as. A single-mask request with a
+    'time_budget' may be answered with an approximate estimate instead (see
+    `_budgeted_estimate`).
+
+    With a 'session_id' whose last analysis was of the same image and masks,
+    only the value assignment and aggregation run again. If only the mask
+    changed, the segmentation is updated around the edit instead of redone;
+    results from such an updated segmentation set 'approximate' in `sources`
+    and are not cached.
+    """
+    upload_store = current_app.extensions['upload_store']
+    try:
+        # Keep the stored uploads the job reads from being evicted under it
+        for kind in ('image', 'mask'):
+            if sources.get(f'{kind}_path'):
+                upload_store.acquire(sources[f'{kind}_path'], job.id)
+        job.check()
+        if sources.get('sequence'):
+            return _calculate_sequence(sources, top_value, bottom_value, job)
+
+        session_id = sources.get('session_id')
+        if session_id:
+            session = current_app.extensions['analysis_sessions'].get(
+                session_id, sources['fingerprint'], image_fingerprint=sources['image_fingerprint']
+            )
+            if session is not None and session.fingerprint == sources['fingerprint']:
+                return _recalculate(session, sources, top_value, bottom_value, result_id)
+            if session is not None:
+                response = _recalculate_mask_edit(session, sources, top_value, bottom_value, result_id, job)
+                if response is not None:
+                    return response
+
+        if sources.get('region_mask_files') or sources['mask_mode'] == 'labels':
+            return _calculate_regions(sources, top_value, bottom_value, result_id, job)
+        return _calculate(sources, top_value, bottom_value, result_id, job)
+    except AnalysisError as e:
+        return jsonify({'error': e.message}), e.status
+    except JobCancelled as e:
+        logging.info(f"Stopped job {job.id}: {e.reason}")
+        return jsonify({'error': e.reason, 'jobId': job.id}), 504 if e.timed_out else 409
+    except MemoryError:
+        logging.warning(f"Job {job.id} ran out of memory")
+        return jsonify({'error': 'Analysis exceeded its memory limit', 'jobId': job.id}), 507
+    except WorkerDied as e:
+        return jsonify({'error': str(e), 'jobId': job.id}), 500
+    finally:
+        # Free the job's shared buffers; background users hold their own references
+        get_registry().release_owner(job.id)
+        upload_store.release_owner(job.id)
+
+
+def _calculate(sources, top_value, bottom_value, result_id, job):
+    # Files of this result only; a cached response keeps pointing at them
+    result_dir = _result_dir(result_id)
+
+    # Save uploaded files; stored uploads are already on disk
+    image_file = sources.get('image_file')
+    if image_file is not None:
+        image_path = _uploaded_file_path(sources, 'image', job)
+        filename = secure_filename(image_file.filename)
+    else:
+        image_path = sources['image_path']
+        filename = os.path.basename(image_path)
+    # Decoded (or rasterized) once and shared by the masking, segmentation and statistics
+    mask = _source_mask(sources, job)
+
+    # Calibrated once per request; a progressive request's estimate used the same one
+    color_map = _request_color_map(sources, top_value, bottom_value)
+    csv_path_for_colorMap = os.path.join(result_dir, 'color_map_colors_with_values.csv')
+    color_map.table.to_csv(csv_path_for_colorMap)
+
+    if sources.get('time_budget') is not None:
+        response = _budgeted_estimate(sources, top_value, bottom_value, mask, job)
+        if response is not None:
+            return response
+
+    memory_lean = current_app.config['MEMORY_LEAN']
+    keep_frame = bool(sources.get('session_id')) and current_app.config['INCREMENTAL_SEGMENTATION']
+
+    if image_file is None:
+        # Stored uploads are read lazily (or prepared ahead), cropped to the mask
+        image_shape = mask.shape
+        segments, segmentation_input, segments_spec, mask, frame, bbox = _segment_stored_upload(
+            _open_stored_image(sources, job), mask, memory_lean, job, keep_frame=keep_frame,
+            bbox=_source_mask_bbox(sources), engine=sources.get('engine'),
+        )
+    # Wait for the uploaded (cropped) image to be written
+    elif wait_for_file(image_path):
+        # Apply mask to the image
+        masked_image = apply_mask_to_image(image_path, mask, memory_lean=memory_lean)
+        if masked_image.ndim == 3:
+            masked_image = cv2.cvtColor(masked_image, cv2.COLOR_BGR2RGB)
+
+        # Get optimal parameters and perform segmentation
+        scale, sigma, min_size = felzenszwalb_params_for_shape(*mask.shape)
+        segments, segmentation_input, segments_spec = _segment_array(
+            masked_image, mask > 0, scale, sigma, min_size, memory_lean, job, engine=sources.get('engine')
+        )
+        del masked_image
+
+        image_shape, bbox = mask.shape, (0, mask.shape[0], 0, mask.shape[1])
+        frame = None
+        if keep_frame:
+            image = read_image_for_masking(image_path, memory_lean=memory_lean)
+            if image.dtype == np.uint8 and image.ndim == 3:
+                frame = _edit_frame(
+                    cv2.cvtColor(image, cv2.COLOR_BGR2RGB), (0, mask.shape[0], 0, mask.shape[1]),
+                    mask.shape, (scale, sigma, min_size),
+                )
+    else:
+        return jsonify({'error': 'Cropped image not found'}), 500
+
+    # Extract colors and areas only for segments that overlap with the mask
+    sums = segment_sums(segments, segmentation_input, mask)
+    segment_stats = statistics_from_sums(sums, segmentation_input.dtype)
+    segment_colors = extract_segment_colors_and_areas(segments, segmentation_input, mask, segment_stats=segment_stats)
+
+    # Render the segmented preview from the per-segment statistics
+    _render_preview(segments, segment_stats.loc[list(segment_colors)], result_id)
+
+    csv_filename = f"{os.path.splitext(filename)[0]}_colors.csv"
+    csv_path_for_image = os.path.join(result_dir, csv_filename)
+    export_segment_data_to_csv(segment_colors, csv_path_for_image)
+
+    # Merge CSVs
+    file1 = csv_path_for_colorMap
+    file2 = csv_path_for_image
+    output_path_merged_csv = os.path.join(result_dir, 'merged_file.csv')
+    try:
+        merged_file_path = merge_csv_files(file1, file2, output_path_merged_csv)
+    except FileNotFoundError as e:
+        return jsonify({'error': str(e)}), 500
+
+    # Aggregate average, per-colour legend data and statistics in one pass
+    merged_df = pd.read_csv(merged_file_path, float_precision='round_trip')
+    try:
+        results = aggregate_results(merged_df)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 500
 
+    # Recalibrate the planner with what segmentation and colour matching took
+    actual_seconds = time.monotonic() - job.plan_started
+    current_app.extensions['planner'].observe(job.plan, actual_seconds)
+    plan = describe_plan(job.plan, actual_seconds)
+
+    state = {
+        # Shared-memory labels are released when the request ends
+        'segments': np.array(segments) if segments_spec is not None else segments,
+        'bbox': None,
+        'segment_stats': segment_stats,
+        'selected': segment_data_to_frame(segment_colors),
+        'region_selections': [],
+        'region_names': None,
+        # Where the segmented crop lies, for the value raster
+        'origin': (bbox[0], bbox[2]),
+        'image_shape': image_shape,
+    }
+    if frame is not None and segmentation_input.dtype == np.uint8:
+        state.update(frame, mask=mask, sums=sums)
+    _remember_session(sources, state)
+
+    return _single_mask_response(results, csv_path_for_colorMap, result_id, segments, merged_df, segments_spec,
+                                 mask=mask, origin=state['origin'], image_shape=image_shape, plan=plan,
+                                 scenarios=_scenario_results(sources, state, color_map.table))
+
+
+def _scenario_results(sources, state, color_table, plan=None):
+    """
+    Evaluates the request's 'scenarios' (see `evaluate_scenarios`) on a
+    single-mask segmentation, reusing the colour matching `plan` when the
+    session already has one; None if the request has no scenarios.
+    """
+    scenarios = sources.get('scenarios')
+    if not scenarios:
+        return None
+    if plan is None:
+        plan = plan_segment_values(state, color_table)
+    try:
+        return evaluate_scenarios(plan, len(color_table), scenarios)
+    except ValueError as e:
+        raise AnalysisError(str(e))
+
+
+def _single_mask_response(results, csv_path, result_id, segments, merged_df, segments_spec=None,
+                          mask=None, origin=(0, 0), image_shape=None, plan=None, scenarios=None):
+    """
+    Starts the binary exports and builds the JSON response of a single-mask analysis.
+
+    `mask` (cropped like `segments`), `origin` ((top, left) of the crop) and
+    `image_shape` place the value raster the query endpoints read in the image.
+    `plan` is the `describe_plan` of the segmentation, when one ran, and
+    `scenarios` the results of `_scenario_results`, when requested.
+    """
+    # Write the binary exports in the background; the export endpoint waits for them
+    export_dir = _result_dir(result_id)
+    if segments_spec is not None:
+        get_registry().acquire(segments_spec.name)
+    raster_args = {'mask': mask, 'origin': origin, 'image_shape': image_shape}
+    threading.Thread(
+        target=_export_in_background, args=(segments, merged_df, export_dir, segments_spec, raster_args),
+        daemon=True,
+    ).start()
+
+    # Prepare URLs
+    segmented_image_url = _preview_url(result_id)
+    graph_image_url = url_for('static', filename='temp_uploads/comparison_graph.png', _external=True)
+    export_urls = {
+        artifact: url_for('api.export_result', result_id=result_id, artifact=artifact, _external=True)
+        for artifact in EXPORT_FILENAMES
+    }
+    value_query_urls = {
+        query: url_for(f'values.{query}_query', result_id=result_id, _external=True)
+        for query in ('raster', 'point', 'profile', 'region')
+    }
+
+    response = {
+        'success': True,
+        'average': results['average'],
+        'csvPath': csv_path,
+        'segmentedImageUrl': segmented_image_url,
+        'graphImageUrl': graph_image_url,
+        'colorMapData': results['colorMapData'],
+        'stats': results['stats'],
+        'exportUrls': export_urls,
+        'valueQueryUrls': value_query_urls,
+        'tilesUrl': url_for('tiles.pyramid', result_id=result_id, _external=True),
+    }
+    if plan is not None:
+        response['plan'] = plan
+    if scenarios is not None:
+        response['scenarios'] = scenarios
+    return jsonify(response)
+
+
+def _calculate_regions(sources, top_value, bottom_value, result_id, job):
+    """
+    Analyses several regions of one image with a single segmentation.
+
+    The regions come from separate masks, or from the distinct non-zero
+    values of one label-valued mask. The top-level fields describe the
+    union of the regions; 'regions' holds each region's own average,
+    colorMapData and stats.
+    """
+    image_file = sources.get('image_file')
+    if image_file is not None:
+        image_path = _uploaded_file_path(sources, 'image', job)
+    else:
+        image_path = sources['image_path']
+
+    color_map_path = _request_color_map_path(sources)
+    try:
+        color_table = calibrate_color_map(
+            color_map_path, top_value, bottom_value, num_rows=ENGINE_PARAMS['color_map_grid_rows']
+        )
+    except Exception as e:
+        logging.exception("Error processing color map")
+        raise AnalysisError(f'Failed to process color map: {str(e)}')
+
+    region_mask_files = sources.get('region_mask_files')
+    if region_mask_files:
+        masks = []
+        for mask_file in region_mask_files:
+            masks.append(load_mask(_save_upload(mask_file, job)))
+        if any(mask.shape != masks[0].shape for mask in masks):
+            raise AnalysisError('All region masks must have the same size', 400)
+        regions = regions_from_masks(masks)
+        region_names = [os.path.splitext(f.filename)[0] for f in region_mask_files]
+    else:
+        regions, label_values = regions_from_label_mask(_source_mask(sources, job, labels=True))
+        region_names = [str(value) for value in label_values]
+
+    if not region_names:
+        raise AnalysisError('Mask is empty', 400)
+
+    if image_file is not None:
+        image = open_image_lazy(image_path, page=sources.get('page', 0))
+    else:
+        image = _open_stored_image(sources, job)
+    try:
+        state = segment_regions(image, regions, memory_lean=current_app.config['MEMORY_LEAN'])
+        analysis = aggregate_segments(state, color_table)
+    except ValueError as e:
+        raise AnalysisError(str(e), 400)
+
+    state['region_names'] = region_names
+    _remember_session(sources, state)
+    return _regions_response(state, analysis, result_id)
+
+
+def _calculate_sequence(sources, top_value, bottom_value, job):
+    """
+    Analyses every frame of a multi-frame image (multi-page TIFF, animated
+    GIF) with one mask, e.g. a time series or parameter sweep.
+
+    The colour map is calibrated once, the crop and Felzenszwalb parameters
+    are shared by all frames, and frames are decoded one at a time and
+    segmented in parallel in the worker pool. 'frames' holds each frame's
+    average, colorMapData and stats (or an error); 'averages' is the time
+    series of averages, None for frames that failed.
+    """
+    image_file = sources.get('image_file')
+    if image_file is not None:
+        image_path = _uploaded_file_path(sources, 'image', job)
+    else:
+        image_path = sources['image_path']
+    color_map_path = _request_color_map_path(sources)
+    try:
+        color_table = calibrate_color_map(
+            color_map_path, top_value, bottom_value, num_rows=ENGINE_PARAMS['color_map_grid_rows']
+        )
+    except Exception as e:
+        logging.exception("Error processing color map")
+        raise AnalysisError(f'Failed to process color map: {str(e)}')
+
+    mask = _source_mask(sources, job)
+    memory_lean = current_app.config['MEMORY_LEAN']
+    plan = current_app.extensions['concurrency']
+    try:
+        if plan.workers > 1:
+            frames = run_sequence_in_workers(
+                iter_frames(image_path), mask, color_table, memory_lean, job, plan.workers,
+                threads=plan.threads, memory_limit=current_app.config['JOB_MEMORY_LIMIT'],
+            )
+        else:
+            frames = analyze_sequence(iter_frames(image_path), mask, color_table, memory_lean=memory_lean, job=job)
+    except ValueError as e:
+        raise AnalysisError(str(e), 400)
+    logging.info(f"Analysed {len(frames)} frames of {os.path.basename(image_path)}")
+
+    return jsonify({
+        'success': True,
+        'numFrames': len(frames),
+        'averages': [frame.get('average') for frame in frames],
+        'frames': frames,
+    })
+
+
+def _regions_response(state, analysis, result_id):
+    """
+    Builds the JSON response of a multi-region analysis.
+    """
+    _render_preview(state['segments'], state['segment_stats'].loc[analysis['merged_df']['Segment'].to_numpy()], result_id)
+
+    regions_response = []
+    for name, region in zip(state['region_names'], analysis['regions']):
+        if 'error' in region:
+            regions_response.append({'region': name, 'error': region['error']})
+            continue
+        results = region['results']
+        regions_response.append({
+            'region': name,
+            'average': results['average'],
+            'colorMapData': results['colorMapData'],
+            'stats': results['stats'],
+        })
+
+    results = analysis['results']
+    return jsonify({
+        'success': True,
+        'average': results['average'],
+        'segmentedImageUrl': _preview_url(result_id),
+        'graphImageUrl': url_for('static', filename='temp_uploads/comparison_graph.png', _external=True),
+        'colorMapData': results['colorMapData'],
+        'stats': results['stats'],
+        'regions': regions_response,
+    })
+
+
+def _remember_session(sources, state):
+    """Keeps the segmentation of a request for later requests of its session."""
+    session_id = sources.get('session_id')
+    if session_id:
+        current_app.extensions['analysis_sessions'].put(
+            session_id, sources['fingerprint'], state, image_fingerprint=sources['image_fingerprint']
+        )
+
+
+def _session_color_map(session, color_map_path, top_value, bottom_value):
+    """
+    Returns the session's calibration of a colour map for the given values and
+    the plan matching the session's segment colours to it. The colour bar is
+    sampled and the colours matched only the first time the session uses it.
+    """
+    key = hash_file(color_map_path)
+    color_map, plan = session.color_maps.get(key, (None, None))
+    if color_map is None:
+        color_map = ColorMap(color_map_path, top_value, bottom_value)
+    elif (color_map.top_value, color_map.bottom_value) != (top_value, bottom_value):
+        color_map = color_map.with_values(top_value, bottom_value)
+    if plan is None:
+        plan = plan_segment_values(session.state, color_map.table)
+    session.color_maps[key] = (color_map, plan)
+    return color_map, plan
+
+
+def _recalculate(session, sources, top_value, bottom_value, result_id):
+    """
+    Answers a request whose image and masks match the session's last analysis:
+    the segmentation is reused, and only the values are reassigned from the
+    (possibly new) colour map and aggregated again.
+    """
+    color_map_path = _request_color_map_path(sources)
+    try:
+        color_map, plan = _session_color_map(session, color_map_path, top_value, bottom_value)
     except Exception as e:
-        return stats
+        logging.exception("Error processing color map")
+        raise AnalysisError(f'Failed to process color map: {str(e)}')
+
+    state = session.state
+    if state.get('incremental'):
+        # Updated around mask edits rather than segmented afresh: not cached,
+        # and its files must not stand in for a full analysis of the same key
+        sources['approximate'] = True
+        result_id = f"{result_id}-{uuid.uuid4().hex[:12]}"
+    try:
+        analysis = aggregate_segments(state, color_map.table, plan=plan)
+    except ValueError as e:
+        raise AnalysisError(str(e))
+    logging.info(f"Reused the segmentation of session {sources['session_id']}")
+
+    if state['region_names'] is not None:
+        return _regions_response(state, analysis, result_id)
+
+    # Keep the colour map table on disk in step with the values, as process_color_map does
+    csv_path = os.path.join(_result_dir(result_id), 'color_map_colors_with_values.csv')
+    color_map.table.to_csv(csv_path)
+    _render_preview(state['segments'], state['segment_stats'].loc[state['selected'].index], result_id)
+    return _single_mask_response(
+        analysis['results'], csv_path, result_id, state['segments'], analysis['merged_df'],
+        mask=state.get('mask'), origin=state.get('origin', (0, 0)), image_shape=state.get('image_shape'),
+        scenarios=_scenario_results(sources, state, color_map.table, plan=plan),
+    )
+
+
+def _recalculate_mask_edit(session, sources, top_value, bottom_value, result_id, job):
+    """
+    Answers a request whose image matches the session's last single-mask
+    analysis but whose mask was edited: the segmentation is updated around
+    the changed pixels (see `resegment_mask_edit`) and the values are
+    reassigned as in `_recalculate`.
+
+    Returns:
+        Response or None: None if the edit cannot be applied in place (other
+        mask layout, mask outside the segmented crop, or an edit covering too
+        much of the image), so the request is analysed from scratch.
+    """
+    state = session.state
+    if (
+        'frame' not in state or sources.get('region_mask_files') or sources['mask_mode'] != 'binary'
+        or not current_app.config['INCREMENTAL_SEGMENTATION']
+    ):
+        return None
+
+    mask = _source_mask(sources, job)
+
+    # Stored uploads were segmented cropped to the first mask; edits must stay inside the crop
+    top, bottom, left, right = state['bbox']
+    if mask.shape != tuple(state['image_shape']):
+        return None
+    cropped = mask[top:bottom, left:right]
+    if np.count_nonzero(cropped) != np.count_nonzero(mask):
+        return None
+    if not cropped.any():
+        raise AnalysisError('Mask is empty', 400)
+
+    edited = resegment_mask_edit(
+        state['segments'], state['sums'], state['frame'], state['mask'], cropped, state['params'],
+        memory_lean=current_app.config['MEMORY_LEAN'],
+    )
+    if edited is None:
+        return None
+    segments, sums = edited
+
+    segment_stats = statistics_from_sums(sums, np.uint8)
+    selected = select_segments(
+        segment_stats, int(np.count_nonzero(cropped)), inside_mask_count=segment_stats['InsideMaskCount'].to_numpy()
+    )
+    edited_session = current_app.extensions['analysis_sessions'].put(
+        sources['session_id'], sources['fingerprint'],
+        {**state, 'segments': segments, 'segment_stats': segment_stats, 'selected': selected,
+         'mask': cropped, 'sums': sums, 'incremental': True},
+        image_fingerprint=sources['image_fingerprint'],
+    )
+    # Colour maps stay calibrated; only the colour matching depends on the segments
+    edited_session.color_maps = {key: (color_map, None) for key, (color_map, _) in session.color_maps.items()}
+    logging.info(f"Updated the segmentation of session {sources['session_id']} for the edited mask")
+    return _recalculate(edited_session, sources, top_value, bottom_value, result_id)
+
+
+PREVIEW_FILENAME = 'segmentedImage.png'
+
+
+def _result_dir(result_id):
+    """
+    Directory of one result's files: the preview, the CSVs and the binary
+    exports. Cached responses link to them, so results never share files.
+    """
+    return current_app.extensions['result_files'].path_for(secure_filename(result_id))
+
+
+def _preview_url(result_id):
+    folder = os.path.relpath(current_app.config['RESULT_FILES_FOLDER'], current_app.config['STATIC_FOLDER'])
+    return url_for(
+        'static', filename=f"{folder.replace(os.sep, '/')}/{secure_filename(result_id)}/{PREVIEW_FILENAME}",
+        _external=True,
+    )
+
+
+def _render_preview(segments, segment_stats, result_id):
+    """
+    Renders the segmented preview of a result, unless it already has one.
+    """
+    preview_path = os.path.join(_result_dir(result_id), PREVIEW_FILENAME)
+    if os.path.exists(preview_path):
+        return
+    render_segment_preview(
+        segments, segment_stats, preview_path, max_size=current_app.config['PREVIEW_MAX_SIZE'],
+    )
+
+
+def _estimate(sources, top_value, bottom_value, job):
+    """
+    Computes the coarse first answer of a progressive request (see
+    `estimate_average`) from a downsampled crop of the image. The colour
+    map, uploads and mask it reads are kept in `sources` for the full
+    analysis that follows.
+    """
+    color_map = _request_color_map(sources, top_value, bottom_value)
+    if 'image_file' in sources:
+        image = open_image_lazy(_uploaded_file_path(sources, 'image', job))
+    else:
+        image = _open_stored_image(sources, job)
+    mask = _source_mask(sources, job)
+    try:
+        return estimate_average(
+            image, mask, color_table=color_map.table, max_size=current_app.config['ESTIMATE_MAX_SIZE'],
+            bbox=_source_mask_bbox(sources), memory_lean=current_app.config['MEMORY_LEAN'],
+        )
+    except ValueError as e:
+        raise AnalysisError(str(e), 400)
+
+
+def _budgeted_estimate(sources, top_value, bottom_value, mask, job):
+    """
+    Plans a request with a 'time_budget' (seconds) between the exact
+    analysis and the downsampled estimate (see `Planner.choose`).
+
+    Returns:
+        The JSON response of the estimate when the planner picks it (it sets
+        'approximate' in `sources`, so it is not cached), otherwise None and
+        the exact analysis runs.
+    """
+    if 'image_file' in sources:
+        # Uploaded images are segmented whole, stored ones cropped to the mask and converted
+        image, bbox = open_image_lazy(_uploaded_file_path(sources, 'image', job)), None
+        rgb8 = image.dtype == np.uint8 and image.ndim == 3 and image.shape[2] == 3
+    else:
+        image, rgb8 = _open_stored_image(sources, job), True
+        bbox = _source_mask_bbox(sources) or mask_bounding_box(mask, margin=SEGMENTATION_MARGIN)
+    if mask.shape != image.shape[:2] or (bbox is None and not mask.any()):
+        # Left to the exact analysis to report
+        return None
+
+    config = current_app.config
+    planner = current_app.extensions['planner']
+    features = measure_features(
+        image, mask, ENGINE_PARAMS['color_map_grid_rows'], bbox=bbox, estimate_max_size=config['ESTIMATE_MAX_SIZE'],
+    )
+    plan = planner.choose(features, _segmentation_engines(rgb8), budget=sources['time_budget'])
+    if plan.strategy != 'estimate':
+        return None
+
+    started = time.monotonic()
+    job.check()
+    estimate = _estimate(sources, top_value, bottom_value, job)
+    actual_seconds = time.monotonic() - started
+    planner.observe(plan, actual_seconds)
+    sources['approximate'] = True
+    return jsonify({'success': True, 'approximate': True, **estimate, 'plan': describe_plan(plan, actual_seconds)})
+
+
+def _finish_in_background(app, base_url, compute, cache_key, job):
+    """
+    Runs the full analysis of a progressive request after its estimate has
+    been answered, leaving the response for GET /jobs/<job_id>/result.
+    """
+    def run():
+        # url_for in the response needs a request context of the original host
+        with app.test_request_context(base_url=base_url):
+            try:
+                body, _ = app.extensions['result_cache'].get_or_compute(cache_key, compute)
+                outcome = (200, body, {})
+            except UncachedResponse as e:
+                retry_after = e.response.headers.get('Retry-After')
+                outcome = (e.response.status_code, e.response.get_data(),
+                           {'Retry-After': retry_after} if retry_after else {})
+            except Saturated as e:
+                outcome = (429, jsonify({'error': str(e), 'retryAfter': e.retry_after}).get_data(),
+                           {'Retry-After': str(e.retry_after)})
+            except Exception as e:
+                logging.exception(f"Progressive job {job.id} failed")
+                outcome = (500, jsonify({'error': str(e), 'jobId': job.id}).get_data(), {})
+            finally:
+                # Also when the analysis never started (e.g. the queue was full)
+                get_registry().release_owner(job.id)
+                app.extensions['upload_store'].release_owner(job.id)
+            app.extensions['jobs'].finish(job, outcome=outcome)
+
+    threading.Thread(target=run, name=f'progressive-{job.id}', daemon=True).start()
+
+
+def _progressive_response(sources, top_value, bottom_value, cache_key, job_id):
+    """
+    Answers a progressive request: a cached result at once, otherwise the
+    estimate with 202 while the full analysis goes on in the background.
+    """
+    result_cache = current_app.extensions['result_cache']
+    body = result_cache.get(cache_key)
+    if body is not None:
+        current_app.extensions['result_files'].touch(cache_key)
+        logging.info(f"Served progressive /calculate-average from result cache ({cache_key})")
+        return jsonify({**json.loads(body), 'phase': 'final'})
+
+    app = current_app._get_current_object()
+    admission = current_app.extensions['admission']
+    jobs = current_app.extensions['jobs']
+    # The client hangs up after the estimate, so disconnects do not cancel the job
+    job = jobs.start(job_id, session_id=sources['session_id'])
+    try:
+        estimate = _estimate(sources, top_value, bottom_value, job)
+    except BaseException as e:
+        jobs.finish(job)
+        get_registry().release_owner(job.id)
+        current_app.extensions['upload_store'].release_owner(job.id)
+        if isinstance(e, AnalysisError):
+            return jsonify({'error': e.message}), e.status
+        if isinstance(e, JobCancelled):
+            return jsonify({'error': e.reason, 'jobId': job.id}), 504 if e.timed_out else 409
+        raise
+
+    def compute():
+        with admission.admit():
+            response = app.make_response(_run_calculation(sources, top_value, bottom_value, cache_key, job))
+        if response.status_code != 200 or sources.get('approximate'):
+            raise _uncached(response, sources)
+        return response.get_data()
+
+    _finish_in_background(app, request.host_url, compute, cache_key, job)
+    return jsonify({
+        'success': True,
+        'phase': 'estimate',
+        'jobId': job.id,
+        **estimate,
+        'resultUrl': url_for('api.job_result', job_id=job.id, _external=True),
+    }), 202
 
 
 @api_bp.route('/calculate-average', methods=['POST'])
 def calculate_average_route():
     try:
-        if 'image' not in request.files or 'mask' not in request.files:
+        image_id = request.form.get('imageId')
+        image_upload_id = request.form.get('imageUploadId')
+        mask_upload_id = request.form.get('maskUploadId')
+        mask_geometry = request.form.get('maskGeometry')
+        region_mask_files = request.files.getlist('masks')
+        has_mask = 'mask' in request.files or mask_upload_id or mask_geometry or region_mask_files
+        if ('image' not in request.files and not image_upload_id and not image_id) or not has_mask:
             return jsonify({'error': 'No image or mask file found'}), 400
 
-        image_file = request.files['image']
-        mask_file = request.files['mask']
-        
-        if image_file.filename == '' or mask_file.filename == '':
-            return jsonify({'error': 'No selected file'}), 400
+        mask_mode = request.form.get('maskMode', 'binary')
+        if mask_mode not in ('binary', 'labels'):
+            return jsonify({'error': f'Invalid mask mode: {mask_mode}'}), 400
+
+        sources = {'page': int(request.form.get('page', 0)), 'mask_mode': mask_mode}
+        # The planner picks how to segment; clients may force an engine instead
+        engine = request.form.get('engine', 'auto')
+        if engine not in ('auto',) + ENGINES:
+            return jsonify({'error': f"Invalid engine: {engine}; expected auto or one of {', '.join(ENGINES)}"}), 400
+        if engine != 'auto':
+            sources['engine'] = engine
+        # Within a time budget the planner may answer with the downsampled estimate instead
+        if request.form.get('timeBudget'):
+            try:
+                sources['time_budget'] = float(request.form['timeBudget'])
+            except ValueError:
+                sources['time_budget'] = 0.0
+            if not sources['time_budget'] > 0 or 'engine' in sources:
+                return jsonify({'error': 'timeBudget must be a positive number of seconds without an engine'}), 400
+        if request.form.get('sequence', 'false').lower() == 'true':
+            if region_mask_files or mask_mode != 'binary':
+                return jsonify({'error': 'Sequences are analysed with a single binary mask'}), 400
+            sources['sequence'] = True
+        # Progressive requests are answered with a coarse estimate first
+        progressive = request.form.get('progressive', 'false').lower() == 'true'
+        if progressive and (region_mask_files or mask_mode != 'binary' or sources.get('sequence')):
+            return jsonify({'error': 'Progressive results are available for a single binary mask only'}), 400
+        if 'time_budget' in sources and (region_mask_files or mask_mode != 'binary' or sources.get('sequence')
+                                         or progressive):
+            return jsonify({'error': 'Time budgets apply to a single binary mask without progressive results'}), 400
+        # Sweeps of value ranges and distributions, evaluated on the same segmentation
+        if request.form.get('scenarios'):
+            if region_mask_files or mask_mode != 'binary' or sources.get('sequence'):
+                return jsonify({'error': 'Scenarios are evaluated for a single binary mask only'}), 400
+            try:
+                sources['scenarios'] = parse_scenarios(request.form['scenarios'])
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        kinds = [('image', image_upload_id)]
+        if region_mask_files:
+            # Several masks: one region each
+            for file_storage in region_mask_files:
+                if file_storage.filename == '':
+                    return jsonify({'error': 'No selected file'}), 400
+                if not allowed_file(file_storage.filename):
+                    return jsonify({'error': 'Invalid file type'}), 400
+            sources['region_mask_files'] = region_mask_files
+        else:
+            kinds.append(('mask', mask_upload_id))
+
+        upload_root = current_app.config['CHUNKED_UPLOAD_FOLDER']
+        for kind, upload_id in kinds:
+            if kind in request.files:
+                file_storage = request.files[kind]
+                if file_storage.filename == '':
+                    return jsonify({'error': 'No selected file'}), 400
+                if not allowed_file(file_storage.filename):
+                    return jsonify({'error': 'Invalid file type'}), 400
+                sources[f'{kind}_file'] = file_storage
+            elif kind == 'image' and image_id:
+                # Sent ahead with POST /images and prepared while the mask was drawn
+                prepared = current_app.extensions['prepared_images'].get(image_id)
+                if prepared is None:
+                    return jsonify({'error': f'Image not found or expired: {image_id}'}), 404
+                sources.update(image_path=prepared.path, page=prepared.page, prepared=prepared)
+            elif kind == 'mask' and mask_geometry:
+                # Selection shapes, rasterized here instead of uploaded as an image
+                try:
+                    sources['mask_geometry'] = parse_mask_geometry(mask_geometry, labels=mask_mode == 'labels')
+                except ValueError as e:
+                    return jsonify({'error': str(e)}), 400
+            else:
+                path = get_completed_upload_path(upload_root, upload_id)
+                if path is None:
+                    return jsonify({'error': f'Upload not found or incomplete: {upload_id}'}), 404
+                sources[f'{kind}_path'] = path
 
         top_value = float(request.form.get('topValue', 0))
         bottom_value = float(request.form.get('bottomValue', 0))
 
-        if allowed_file(image_file.filename) and allowed_file(mask_file.filename):
-            filename = secure_filename(image_file.filename)
-            mask_filename = secure_filename(mask_file.filename)
-            upload_folder = current_app.config['UPLOAD_FOLDER']
-            
-            # Save both files
-            image_path = os.path.join(upload_folder, filename)
-            mask_path = os.path.join(upload_folder, mask_filename)
-            image_file.save(image_path)
-            mask_file.save(mask_path)
-
-            # Process color map - use custom upload if provided, otherwise use default
-            color_map_source = request.form.get('colorMapSource', 'sentaurus')
-            if color_map_source == 'other' and 'colorMap' in request.files:
-                color_map_file = request.files['colorMap']
-                if color_map_file.filename != '':
-                    if allowed_file(color_map_file.filename):
-                        color_map_filename = secure_filename(color_map_file.filename)
-                        # Normalize path for Windows compatibility (handles backslashes properly)
-                        color_map_path = os.path.normpath(os.path.join(upload_folder, color_map_filename))
-                        color_map_file.save(color_map_path)
-                        
-                        # Wait for file to be fully written (Windows may need time to flush)
-                        if not wait_for_file(color_map_path, timeout=5):
-                            return jsonify({'error': f'Color map file not accessible: {color_map_path}'}), 500
-                        
-                        # Verify file is readable and not empty
-                        if not os.path.exists(color_map_path):
-                            return jsonify({'error': f'Color map file not found: {color_map_path}'}), 500
-                        if os.path.getsize(color_map_path) == 0:
-                            return jsonify({'error': 'Color map file is empty'}), 500
-                    else:
-                        return jsonify({'error': 'Invalid color map file type'}), 400
-                else:
-                    return jsonify({'error': 'No color map file provided'}), 400
-            else:
-                # Use default Sentaurus TCAD color map
-                color_map_path = os.path.join(ASSETS_DIR, 'color_map_crop.jpg')
-            
-            # Process color map with error handling
-            try:
-                csv_path_for_colorMap = process_color_map(color_map_path, upload_folder, top_value, bottom_value)
-            except Exception as e:
-                import traceback
-                error_msg = f"Error processing color map: {str(e)}\n{traceback.format_exc()}"
-                print(error_msg)
-                logging.error(error_msg)
-                return jsonify({'error': f'Failed to process color map: {str(e)}'}), 500
-
-            # Wait for cropped image to be generated
-            cropped_image_path = os.path.join(TEMP_UPLOADS_DIR, 'cropped-image.png')
-            if wait_for_file(cropped_image_path):
-                # Apply mask to the image
-                masked_image = apply_mask_to_image(cropped_image_path, mask_path)
-                
-                # Save the masked image
-                masked_image_path = os.path.join(upload_folder, "masked_image.png")
-                cv2.imwrite(masked_image_path, masked_image)
-                
-                # Get optimal parameters and perform segmentation
-                scale, sigma, min_size = find_optimal_felzenszwalb_params(masked_image_path)
-                segments, segmented_image = felzenszwalb_segmentation(masked_image_path, scale, sigma, min_size, mask_path=mask_path)
-            else:
-                return jsonify({'error': 'Cropped image not found'}), 500
-
-            # Extract colors and areas only for segments that overlap with the mask
-            mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
-            segment_colors = extract_segment_colors_and_areas(segments, segmented_image, mask)
-            
-            csv_filename = f"{os.path.splitext(filename)[0]}_colors.csv"
-            csv_path_for_image = os.path.join(upload_folder, csv_filename)
-            export_segment_data_to_csv(segment_colors, csv_path_for_image)
-
-            # Merge CSVs
-            file1 = os.path.join(TEMP_UPLOADS_DIR, 'color_map_colors_with_values.csv')
-            file2 = os.path.join(TEMP_UPLOADS_DIR, 'cropped-image_colors.csv')
-            output_path_merged_csv = os.path.join(TEMP_UPLOADS_DIR, 'merged_file.csv')
-            try:
-                merged_file_path = merge_csv_files(file1, file2, output_path_merged_csv)
-            except FileNotFoundError as e:
-                return jsonify({'error': str(e)}), 500
+        session_id = request.form.get('sessionId', '')
+        if len(session_id) > 128:
+            return jsonify({'error': 'Session id is too long'}), 400
+        sources['session_id'] = session_id
 
-            # Calculate average
-            average = calculate_average(output_path_merged_csv)
+        # Clients may name the job so they can cancel it while it runs
+        job_id = request.form.get('jobId') or uuid.uuid4().hex
+        if len(job_id) > 128:
+            return jsonify({'error': 'Job id is too long'}), 400
 
-            # Generate graph
-            graph_output_path = os.path.join(TEMP_UPLOADS_DIR, 'comparison_graph.png')
-            graph_stats = generate_comparison_graph(output_path_merged_csv, graph_output_path)
+        sources['image_fingerprint'] = _image_fingerprint(sources)
+        sources['fingerprint'] = _input_fingerprint(sources)
 
-            # Prepare URLs
-            segmented_image_url = url_for('static', filename='temp_uploads/segmentedImage.png', _external=True)
-            graph_image_url = url_for('static', filename='temp_uploads/comparison_graph.png', _external=True)
+        cache_key = _result_cache_key(sources, top_value, bottom_value)
+        result_cache = current_app.extensions['result_cache']
 
-            color_map_data = []
-            unique_colors = {}  # Dictionary to track unique colors with their values
+        admission = current_app.extensions['admission']
+        jobs = current_app.extensions['jobs']
+        environ = request.environ
 
-            # Calculate the total area for percentage calculation
-            total_area = 0
-            try:
-                with open(output_path_merged_csv, 'r') as f:
-                    # Skip header
-                    next(f)
-                    for line in f:
-                        if line.strip():
-                            values = line.strip().split(',')
-                            try:
-                                pixel_count = int(values[4]) if len(values) > 4 else 0
-                                total_area += pixel_count
-                            except (IndexError, ValueError):
-                                continue
-            except Exception:
-                total_area = 1  # Fallback to avoid division by zero
-
-            # Calculate the area under curve for each color
+        if progressive:
+            return _progressive_response(sources, top_value, bottom_value, cache_key, job_id)
+
+        def compute():
+            # A newer request of the session cancels the one still running
+            job = jobs.start(job_id, session_id=session_id, is_disconnected=lambda: client_disconnected(environ))
             try:
-                with open(output_path_merged_csv, 'r') as f:
-                    # Skip header
-                    next(f)
-                    for line in f:
-                        if line.strip():
-                            values = line.strip().split(',')
-                            try:
-                                r = int(values[1])
-                                g = int(values[2])
-                                b = int(values[3])
-                                pixel_count = int(values[4]) if len(values) > 4 else 0
-                                percentage_area = float(values[5]) if len(values) > 5 else (pixel_count / total_area)
-                                assigned_value = float(values[6]) if len(values) > 6 else 0
-
-                                # Calculate area under curve
-                                area_under_curve = pixel_count * assigned_value
-                                
-                                # Calculate percentage under curve with safety checks
-                                max_value = graph_stats.get('max_value', 1)
-                                denominator = total_area * max_value
-                                if denominator > 0 and not np.isnan(denominator) and not np.isinf(denominator):
-                                    percentage_under_curve = (area_under_curve / denominator) * 100
-                                else:
-                                    percentage_under_curve = 0
-
-                                # Use RGB as the unique key
-                                color_key = f"{r},{g},{b}"
-
-                                # If this color is already in our dictionary, add pixel count and update values
-                                if color_key in unique_colors:
-                                    unique_colors[color_key]['pixelCount'] += pixel_count
-                                    unique_colors[color_key]['percentageArea'] += percentage_area
-                                    unique_colors[color_key]['areaUnderCurve'] += area_under_curve
-                                    unique_colors[color_key]['percentageUnderCurve'] += percentage_under_curve
-                                    # Keep the assigned value the same as they should be identical for same RGB
-                                else:
-                                    unique_colors[color_key] = {
-                                        'segment': values[0],
-                                        'r': r,
-                                        'g': g,
-                                        'b': b,
-                                        'pixelCount': pixel_count,
-                                        'percentageArea': percentage_area,
-                                        'assignedValue': assigned_value,
-                                        'areaUnderCurve': area_under_curve,
-                                        'percentageUnderCurve': percentage_under_curve
-                                    }
-                            except (IndexError, ValueError) as e:
-                                print(f"Skipping malformed line: {line.strip()}, error: {str(e)}")
-                                continue
-                            
-                # Convert the dictionary to a list
-                color_map_data = list(unique_colors.values())
-
-                # Sort by assigned value (ascending)
-                color_map_data.sort(key=lambda x: x['assignedValue'])          
-    
-            except Exception as e:          
-                print(f"Error reading color map data: {str(e)}")
-            
-            return jsonify({
-                'success': True,
-                'average': average,
-                'csvPath': csv_path_for_colorMap,
-                'segmentedImageUrl': segmented_image_url,
-                'graphImageUrl': graph_image_url,
-                'colorMapData': color_map_data,  
-                'stats': {
-                    'numSegments': graph_stats.get('num_segments', None),
-                    'maxAssignedValue': graph_stats.get('max_value', None),
-                    'minAssignedValue': graph_stats.get('min_value', None),
-                    'mean': graph_stats.get('mean', None),
-                    'median': graph_stats.get('median', None),
-                    'mode': graph_stats.get('mode', None),
-                    'totalPixel': total_area
-                }
-            })          
-
-        return jsonify({'error': 'Invalid file type'}), 400
+                # Cached results are served without taking an analysis slot
+                with admission.admit():
+                    response = current_app.make_response(
+                        _run_calculation(sources, top_value, bottom_value, cache_key, job)
+                    )
+            finally:
+                jobs.finish(job)
+            if response.status_code != 200 or sources.get('approximate'):
+                raise _uncached(response, sources)
+            return response.get_data()
+
+        try:
+            body, hit = result_cache.get_or_compute(cache_key, compute)
+        except UncachedResponse as e:
+            return e.response
+        except Saturated as e:
+            logging.warning(f"Rejected /calculate-average, analysis queue is full ({admission.snapshot()})")
+            response = jsonify({'error': str(e), 'retryAfter': e.retry_after})
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, 429
+
+        if hit:
+            # Keep the files the cached response links to
+            current_app.extensions['result_files'].touch(cache_key)
+            logging.info(f"Served /calculate-average from result cache ({cache_key})")
+        return current_app.response_class(body, mimetype='application/json')
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@api_bp.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """
+    Cancels a running analysis by the 'jobId' it was submitted with. Work in
+    worker processes is stopped at once; the analysis's own request then
+    answers with 409.
+    """
+    if not current_app.extensions['jobs'].cancel(job_id):
+        return jsonify({'error': 'Job not found or already finished'}), 404
+    logging.info(f"Cancelling job {job_id} at the client's request")
+    return jsonify({'success': True, 'jobId': job_id})
+
+@api_bp.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """
+    Returns the full result of a progressive analysis once it is done, with
+    202 while it is still running.
+    """
+    jobs = current_app.extensions['jobs']
+    outcome = jobs.outcome(job_id)
+    if outcome is not None:
+        status, body, headers = outcome
+        # e.g. Retry-After of an analysis rejected by admission, as on the synchronous path
+        return jsonify({**json.loads(body), 'phase': 'final', 'jobId': job_id}), status, headers
+    if job_id in jobs.running():
+        return jsonify({'phase': 'estimate', 'ready': False, 'jobId': job_id}), 202
+    return jsonify({'error': 'Job not found or its result expired'}), 404
+
+@api_bp.route('/export-results/<result_id>/<artifact>', methods=['GET'])
+def export_result(result_id, artifact):
+    """
+    Serves the compact binary exports of a previous analysis: the segment label
+    raster ('labels') or the merged per-segment table ('table'), both `.npz`,
+    or the float32 value raster ('values', `.npy`, NaN where nothing was analysed).
+    """
+    if artifact not in EXPORT_FILENAMES:
+        return jsonify({'error': f'Unknown export artifact: {artifact}'}), 404
+
+    export_dir = os.path.join(current_app.config['RESULT_FILES_FOLDER'], secure_filename(result_id))
+    if not os.path.isdir(export_dir):
+        return jsonify({'error': 'Export not found'}), 404
+    if not wait_for_file(os.path.join(export_dir, EXPORT_FILENAMES[artifact]), timeout=30):
+        return jsonify({'error': 'Export not ready'}), 404
+
+    return send_from_directory(export_dir, EXPORT_FILENAMES[artifact], as_attachment=True)
+
 @api_bp.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint for Electron to verify backend is running"""
@@ -319,5 +1310,8 @@ def health_check():
     return jsonify({
         'status': 'healthy',
         'message': 'Backend is running',
-        'port': port
+        'port': port,
+        'socket': current_app.config.get('IPC_SOCKET'),
+        'appVersion': current_app.config.get('APP_VERSION'),
+        'pid': os.getpid(),
     }), 200
\ No newline at end of file
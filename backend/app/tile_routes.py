@@ -0,0 +1,70 @@
+from flask import Blueprint, request, jsonify, current_app, url_for
+import os
+from werkzeug.utils import secure_filename
+from app.utils.image_segmentation.tile_pyramid import TILE_LABELS_FILENAME, TilePyramid, encode_tile
+from app.utils.result_cache import build_cache_key
+from app.utils.wait_for_file import wait_for_file
+
+tiles_bp = Blueprint('tiles', __name__)
+
+
+def _export_dir(result_id):
+    """
+    Export directory of a previous single-mask analysis once its tile source
+    has been written (waiting for it like the exports), or None.
+    """
+    export_dir = os.path.join(current_app.config['RESULT_FILES_FOLDER'], secure_filename(result_id))
+    if not os.path.isdir(export_dir) or not wait_for_file(os.path.join(export_dir, TILE_LABELS_FILENAME), timeout=30):
+        return None
+    current_app.extensions['result_files'].touch(secure_filename(result_id))
+    return export_dir
+
+
+@tiles_bp.route('/results/<result_id>/tiles', methods=['GET'])
+def pyramid(result_id):
+    """
+    Describes the tile pyramid of a result: size, tile size, number of
+    levels, layers, value range and the URL template of its tiles.
+    """
+    export_dir = _export_dir(result_id)
+    if export_dir is None:
+        return jsonify({'error': 'Tiles not found for this result'}), 404
+    tile_pyramid = TilePyramid(export_dir, tile_size=current_app.config['TILE_SIZE'])
+    description = tile_pyramid.describe()
+    description['tileUrlTemplate'] = (
+        f"{url_for('tiles.pyramid', result_id=result_id, _external=True)}/{{layer}}/{{z}}/{{x}}/{{y}}.png"
+    )
+    return jsonify(description)
+
+
+@tiles_bp.route('/results/<result_id>/tiles/<layer>/<int:z>/<int:x>/<int:y>.png', methods=['GET'])
+def tile(result_id, layer, z, x, y):
+    """
+    Serves one 'segments' or 'values' tile of a result's pyramid, rendered on
+    first request and cached. Tiles carry an ETag, so a client revisiting
+    them gets 304 without the tile being sent again.
+    """
+    export_dir = _export_dir(result_id)
+    if export_dir is None:
+        return jsonify({'error': 'Tiles not found for this result'}), 404
+
+    tile_size = current_app.config['TILE_SIZE']
+    # A recalculation writes its rasters anew; the modification time keeps keys apart
+    modified = os.stat(os.path.join(export_dir, TILE_LABELS_FILENAME)).st_mtime_ns
+    key = build_cache_key(result_id, layer, modified, z=z, x=x, y=y, tile_size=tile_size)
+
+    response = current_app.response_class(mimetype='image/png')
+    response.set_etag(key)
+    response.cache_control.private = True
+    response.cache_control.max_age = current_app.config['TILE_CACHE_TTL']
+    if request.if_none_match.contains(key):
+        return response.make_conditional(request)
+
+    try:
+        body, _ = current_app.extensions['tile_cache'].get_or_compute(
+            key, lambda: encode_tile(TilePyramid(export_dir, tile_size=tile_size).render(layer, z, x, y))
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+    response.set_data(body)
+    return response
@@ -0,0 +1,220 @@
+from flask import Blueprint, request, jsonify, current_app
+import os
+import re
+import logging
+from werkzeug.utils import secure_filename
+from app.utils.file_utils import allowed_file
+from app.utils.image_io import open_image_lazy, count_pages
+from app.utils.chunked_upload import (
+    create_upload, append_chunk, complete_upload, read_upload_meta, register_stored_upload,
+    get_completed_upload_path
+)
+
+uploads_bp = Blueprint('uploads', __name__)
+
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+def _upload_response(meta):
+    """Public view of an upload's metadata."""
+    return {
+        'uploadId': meta['uploadId'],
+        'filename': meta['filename'],
+        'offset': meta['offset'],
+        'totalSize': meta['totalSize'],
+        'complete': meta['complete'],
+    }
+
+
+def _chunk_range():
+    """
+    Reads the chunk's start offset, length (None when the body has no
+    Content-Length) and the file's total size (None when not given) from
+    Upload-Offset or Content-Range.
+
+    Raises:
+        ValueError: If neither header is valid, or Content-Range disagrees
+            with the body's Content-Length.
+    """
+    body_length = request.content_length
+    if 'Upload-Offset' in request.headers:
+        try:
+            offset = int(request.headers['Upload-Offset'])
+        except ValueError:
+            offset = -1
+        if offset < 0:
+            raise ValueError('Upload-Offset must be a non-negative integer')
+        return offset, body_length, None
+
+    if 'Content-Range' not in request.headers:
+        raise ValueError('Missing Upload-Offset or Content-Range header')
+    match = CONTENT_RANGE_PATTERN.fullmatch(request.headers['Content-Range'])
+    if not match:
+        raise ValueError(f"Invalid Content-Range: {request.headers['Content-Range']}")
+    start, end = int(match.group(1)), int(match.group(2))
+    total = None if match.group(3) == '*' else int(match.group(3))
+    if end < start or (total is not None and end >= total):
+        raise ValueError(f"Invalid Content-Range: {request.headers['Content-Range']}")
+    length = end - start + 1
+    if body_length is not None and body_length != length:
+        raise ValueError(f'Content-Range covers {length} bytes but the body has {body_length}')
+    return start, length, total
+
+
+@uploads_bp.route('/uploads', methods=['POST'])
+def create_chunked_upload():
+    """
+    Starts a resumable upload for files larger than MAX_CONTENT_LENGTH.
+
+    Body (JSON or form): filename, optional totalSize and contentHash (SHA-256
+    hex of the file). The client then sends the file in chunks with
+    PATCH /uploads/<id> and finishes with POST /uploads/<id>/complete.
+
+    If the server already stores a file with that contentHash, the upload is
+    returned complete right away and no chunks need to be sent.
+    """
+    data = request.get_json(silent=True) or request.form
+    filename = secure_filename(data.get('filename', ''))
+    if not filename or not allowed_file(filename):
+        return jsonify({'error': 'Invalid file type'}), 400
+
+    content_hash = (data.get('contentHash') or '').lower()
+    if content_hash:
+        stored_path = current_app.extensions['upload_store'].lookup(
+            content_hash, os.path.splitext(filename)[1]
+        )
+        if stored_path is not None:
+            meta = register_stored_upload(current_app.config['CHUNKED_UPLOAD_FOLDER'], filename, stored_path)
+            logging.info(f"Upload of {filename} skipped, content already stored")
+            return jsonify(_upload_response(meta)), 200
+
+    total_size = data.get('totalSize')
+    if total_size is not None:
+        try:
+            total_size = int(total_size)
+        except (TypeError, ValueError):
+            total_size = -1
+        if total_size < 0:
+            return jsonify({'error': 'totalSize must be a non-negative integer'}), 400
+    meta = create_upload(current_app.config['CHUNKED_UPLOAD_FOLDER'], filename, total_size)
+
+    response = _upload_response(meta)
+    response['chunkSize'] = current_app.config['UPLOAD_CHUNK_SIZE']
+    return jsonify(response), 201
+
+
+@uploads_bp.route('/uploads/<upload_id>', methods=['GET'])
+def get_chunked_upload(upload_id):
+    """Reports how many bytes were received, so an interrupted upload can resume."""
+    meta = read_upload_meta(current_app.config['CHUNKED_UPLOAD_FOLDER'], upload_id)
+    if meta is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify(_upload_response(meta)), 200
+
+
+@uploads_bp.route('/uploads/<upload_id>', methods=['PATCH', 'PUT'])
+def upload_chunk(upload_id):
+    """
+    Appends one chunk (the raw request body) to an upload. The chunk's start
+    offset is given by the Upload-Offset or Content-Range header and must equal
+    the bytes received so far. A Content-Range must match the body's length,
+    and its total the size the upload was created with.
+    """
+    upload_root = current_app.config['CHUNKED_UPLOAD_FOLDER']
+    try:
+        offset, length, total = _chunk_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if total is not None:
+        meta = read_upload_meta(upload_root, upload_id)
+        if meta is None:
+            return jsonify({'error': 'Upload not found'}), 404
+        if meta['totalSize'] is not None and total != meta['totalSize']:
+            return jsonify({'error': f"Content-Range total {total} does not match the upload's "
+                                     f"size of {meta['totalSize']} bytes"}), 400
+
+    try:
+        meta = append_chunk(upload_root, upload_id, offset, request.stream, length=length)
+    except FileNotFoundError:
+        return jsonify({'error': 'Upload not found'}), 404
+    except ValueError as e:
+        meta = read_upload_meta(upload_root, upload_id)
+        response = {'error': str(e)}
+        if meta is not None:
+            response.update(_upload_response(meta))
+        return jsonify(response), 409
+
+    return jsonify(_upload_response(meta)), 200
+
+
+@uploads_bp.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_chunked_upload(upload_id):
+    """
+    Finishes an upload and opens it lazily to report its page count and size.
+    TIFF pages that cannot be memory-mapped directly are decoded once here.
+    """
+    try:
+        meta = complete_upload(
+            current_app.config['CHUNKED_UPLOAD_FOLDER'], upload_id, store=current_app.extensions['upload_store']
+        )
+    except FileNotFoundError:
+        return jsonify({'error': 'Upload not found'}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+
+    response = _upload_response(meta)
+    try:
+        image = open_image_lazy(meta['path'])
+        response['pages'] = count_pages(meta['path'])
+        response['width'] = int(image.shape[1])
+        response['height'] = int(image.shape[0])
+        response['dtype'] = str(image.dtype)
+    except Exception as e:
+        logging.error(f"Could not open upload {upload_id}: {e}")
+        return jsonify({'error': f'Could not decode image: {str(e)}'}), 400
+
+    return jsonify(response), 200
+
+
+@uploads_bp.route('/images', methods=['POST'])
+def prepare_image():
+    """
+    Takes the image of an analysis before its mask is drawn and starts
+    preparing it in the background (decoding, 8-bit RGB conversion).
+
+    Body: the file as multipart 'image', or the 'uploadId' of a finished
+    chunked upload; optional 'page'. The analysis is then requested with
+    'imageId' instead of the image, and the mask must have the image's size.
+    """
+    data = request.get_json(silent=True) or request.form
+    if 'image' in request.files:
+        file_storage = request.files['image']
+        if file_storage.filename == '' or not allowed_file(file_storage.filename):
+            return jsonify({'error': 'Invalid file type'}), 400
+        path = current_app.extensions['upload_store'].put_file(file_storage)
+    elif data.get('uploadId'):
+        path = get_completed_upload_path(current_app.config['CHUNKED_UPLOAD_FOLDER'], data['uploadId'])
+        if path is None:
+            return jsonify({'error': f"Upload not found or incomplete: {data['uploadId']}"}), 404
+    else:
+        return jsonify({'error': 'No image file found'}), 400
+
+    try:
+        image = current_app.extensions['prepared_images'].add(path, page=int(data.get('page', 0)))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logging.error(f"Could not open image {path}: {e}")
+        return jsonify({'error': f'Could not decode image: {str(e)}'}), 400
+
+    return jsonify(image.status()), 202
+
+
+@uploads_bp.route('/images/<image_id>', methods=['GET'])
+def get_prepared_image(image_id):
+    """Reports whether an image sent with POST /images has been prepared."""
+    image = current_app.extensions['prepared_images'].get(image_id)
+    if image is None:
+        return jsonify({'error': 'Image not found or expired'}), 404
+    return jsonify(image.status()), 200
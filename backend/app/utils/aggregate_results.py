@@ -0,0 +1,242 @@
+import numpy as np
+import pandas as pd
+from statistics import StatisticsError
+
+MERGED_COLUMNS = ['Segment', 'R', 'G', 'B', 'PixelCount', 'PercentageArea', 'Assigned_Value']
+
+
+def pack_rgb(r, g, b):
+    """
+    Packs 8-bit RGB channels into a single 24-bit colour key.
+
+    Args:
+        r, g, b (array-like): Channel values in the 0-255 range.
+
+    Returns:
+        numpy.ndarray: uint32 keys of the form 0xRRGGBB.
+    """
+    r = np.asarray(r, dtype=np.uint32)
+    g = np.asarray(g, dtype=np.uint32)
+    b = np.asarray(b, dtype=np.uint32)
+    return (r << 16) | (g << 8) | b
+
+
+def unpack_rgb(keys):
+    """
+    Splits 24-bit colour keys back into their R, G and B channels.
+
+    Args:
+        keys (array-like): uint32 keys produced by `pack_rgb`.
+
+    Returns:
+        tuple: Three uint8 arrays (r, g, b).
+    """
+    keys = np.asarray(keys, dtype=np.uint32)
+    return ((keys >> 16) & 0xFF).astype(np.uint8), ((keys >> 8) & 0xFF).astype(np.uint8), (keys & 0xFF).astype(np.uint8)
+
+
+def summarize_assigned_values(segments, assigned_values):
+    """
+    Computes the per-segment statistics block (count, extremes, mean, median, mode).
+
+    Values are ordered by segment id first so that ties in the mode resolve to the
+    lowest segment, exactly like `statistics.mode` over the sorted table.
+
+    Args:
+        segments (array-like): Segment ids.
+        assigned_values (array-like): Assigned value of each segment.
+
+    Returns:
+        dict: num_segments, max_value, min_value, mean, median and mode.
+    """
+    segments = np.asarray(segments)
+    values = pd.Series(np.asarray(assigned_values, dtype=np.float64)[np.argsort(segments, kind='stable')])
+
+    stats = {
+        'num_segments': len(values),
+        'max_value': values.max(),
+        'min_value': values.min(),
+        'mean': values.mean(),
+        'median': values.median(),
+    }
+
+    try:
+        stats['mode'] = _first_mode(values.to_numpy())
+    except StatisticsError:
+        stats['mode'] = "No unique mode"
+
+    return stats
+
+
+def _first_mode(values):
+    """Most common value, ties broken by first occurrence (same as `statistics.mode`)."""
+    if values.size == 0:
+        raise StatisticsError("no mode for empty data")
+    uniques, first_index, counts = np.unique(values, return_index=True, return_counts=True)
+    candidates = np.flatnonzero(counts == counts.max())
+    return uniques[candidates[np.argmin(first_index[candidates])]]
+
+
+def aggregate_results(merged_df):
+    """
+    Aggregates the merged per-segment table into the values returned by
+    `/calculate-average` in one vectorized pass.
+
+    Segments are grouped by their packed 24-bit colour instead of a string
+    identifier, and the per-colour sums are accumulated in table order so the
+    figures match the original row-by-row loop.
+
+    Args:
+        merged_df (pandas.DataFrame): Table with the columns in `MERGED_COLUMNS`.
+
+    Returns:
+        dict: 'average', 'colorMapData', 'stats' (in the response's camelCase
+        layout) and 'graph_stats' (the raw statistics block).
+
+    Raises:
+        ValueError: If required columns are missing or the total area is zero.
+    """
+    missing_columns = [col for col in MERGED_COLUMNS if col not in merged_df.columns]
+    if missing_columns:
+        raise ValueError(f"Required columns missing in the file: {missing_columns}")
+
+    segments = merged_df['Segment'].to_numpy()
+    pixel_count = merged_df['PixelCount'].to_numpy(dtype=np.int64)
+    percentage_area = merged_df['PercentageArea'].to_numpy(dtype=np.float64)
+    assigned_value = merged_df['Assigned_Value'].to_numpy(dtype=np.float64)
+    keys = pack_rgb(merged_df['R'].to_numpy(), merged_df['G'].to_numpy(), merged_df['B'].to_numpy())
+
+    # Group rows by colour; groups are kept in order of first appearance
+    _, first_index, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    num_colors = first_index.size
+
+    graph_stats = summarize_assigned_values(segments, assigned_value)
+
+    # Area-weighted average over unique colours
+    group_area = np.bincount(inverse, weights=percentage_area, minlength=num_colors)
+    group_value = assigned_value[first_index]
+    total_area_pct = group_area.sum()
+    if total_area_pct == 0:
+        raise ValueError("Total area is zero, cannot calculate weighted average.")
+    average = (group_value * group_area).sum() / total_area_pct
+
+    # Per-colour legend data
+    total_area = int(pixel_count.sum())
+    area_under_curve = pixel_count * assigned_value
+    denominator = total_area * graph_stats.get('max_value', 1)
+    if denominator > 0 and not np.isnan(denominator) and not np.isinf(denominator):
+        percentage_under_curve = (area_under_curve / denominator) * 100
+    else:
+        percentage_under_curve = np.zeros_like(area_under_curve)
+
+    group_pixels = np.bincount(inverse, weights=pixel_count, minlength=num_colors).astype(np.int64)
+    group_auc = np.bincount(inverse, weights=area_under_curve, minlength=num_colors)
+    group_puc = np.bincount(inverse, weights=percentage_under_curve, minlength=num_colors)
+
+    order = np.argsort(first_index, kind='stable')
+    order = order[np.argsort(group_value[order], kind='stable')]
+
+    rgb = merged_df[['R', 'G', 'B']].to_numpy(dtype=np.int64)
+    color_map_data = [
+        {
+            'segment': str(segments[first_index[i]]),
+            'r': int(rgb[first_index[i], 0]),
+            'g': int(rgb[first_index[i], 1]),
+            'b': int(rgb[first_index[i], 2]),
+            'pixelCount': int(group_pixels[i]),
+            'percentageArea': float(group_area[i]),
+            'assignedValue': float(group_value[i]),
+            'areaUnderCurve': float(group_auc[i]),
+            'percentageUnderCurve': float(group_puc[i]),
+        }
+        for i in order
+    ]
+
+    return {
+        'average': float(average),
+        'colorMapData': color_map_data,
+        'stats': {
+            'numSegments': graph_stats.get('num_segments', None),
+            'maxAssignedValue': graph_stats.get('max_value', None),
+            'minAssignedValue': graph_stats.get('min_value', None),
+            'mean': graph_stats.get('mean', None),
+            'median': graph_stats.get('median', None),
+            'mode': graph_stats.get('mode', None),
+            'totalPixel': total_area,
+        },
+        'graph_stats': graph_stats,
+    }
+
+
+def aggregate_scenarios(merged_df, values, weights):
+    """
+    The average and statistics block of `aggregate_results` for many value
+    assignments of the same segments at once, one row of `values` each.
+
+    The segments' modal value is found once, from the rows of `weights`
+    (see `color_matching_weights`): segments whose values come from the same
+    bands with the same weights have equal values in every assignment.
+
+    Args:
+        merged_df (pandas.DataFrame): Segment table with Segment, R, G, B,
+            PixelCount and PercentageArea.
+        values (numpy.ndarray): (assignments x segments) values, in table order.
+        weights (numpy.ndarray): (segments x bands) colour matching weights.
+
+    Returns:
+        dict: 'average' (one per assignment) and 'stats', a dict of arrays
+        with the keys of `aggregate_results`' 'stats'.
+
+    Raises:
+        ValueError: If the total area is zero.
+    """
+    segments = merged_df['Segment'].to_numpy()
+    percentage_area = merged_df['PercentageArea'].to_numpy(dtype=np.float64)
+    keys = pack_rgb(merged_df['R'].to_numpy(), merged_df['G'].to_numpy(), merged_df['B'].to_numpy())
+
+    # Area-weighted average over unique colours, as in `aggregate_results`
+    _, first_index, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    group_area = np.bincount(inverse.ravel(), weights=percentage_area, minlength=first_index.size)
+    total_area_pct = group_area.sum()
+    if total_area_pct == 0:
+        raise ValueError("Total area is zero, cannot calculate weighted average.")
+    average = values[:, first_index] @ group_area / total_area_pct
+
+    # Statistics over the segments ordered by id, as in `summarize_assigned_values`
+    order = np.argsort(segments, kind='stable')
+    ordered = values[:, order]
+    _, first_row, counts = np.unique(weights[order], axis=0, return_index=True, return_counts=True)
+    candidates = np.flatnonzero(counts == counts.max()) if counts.size else np.array([], dtype=np.intp)
+    if candidates.size:
+        mode = ordered[:, first_row[candidates[np.argmin(first_row[candidates])]]]
+    else:
+        mode = np.full(len(values), np.nan)
+
+    with np.errstate(all='ignore'):
+        stats = {
+            'numSegments': np.full(len(values), len(segments)),
+            'maxAssignedValue': np.nanmax(ordered, axis=1) if ordered.size else np.full(len(values), np.nan),
+            'minAssignedValue': np.nanmin(ordered, axis=1) if ordered.size else np.full(len(values), np.nan),
+            'mean': np.nanmean(ordered, axis=1),
+            'median': np.nanmedian(ordered, axis=1),
+            'mode': mode,
+            'totalPixel': np.full(len(values), int(merged_df['PixelCount'].to_numpy(dtype=np.int64).sum())),
+        }
+    return {'average': average, 'stats': stats}
+
+
+def aggregate_merged_csv(merged_csv_path):
+    """
+    Loads the merged CSV file once and aggregates it with `aggregate_results`.
+
+    Floats are parsed with the round-trip parser so they are bit-for-bit the
+    values written by `merge_csv_files`.
+
+    Args:
+        merged_csv_path (str): Path to the merged CSV file.
+
+    Returns:
+        dict: See `aggregate_results`.
+    """
+    return aggregate_results(pd.read_csv(merged_csv_path, float_precision='round_trip'))
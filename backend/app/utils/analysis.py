@@ -0,0 +1,415 @@
+import cv2
+import numpy as np
+import pandas as pd
+from app.utils.aggregate_results import aggregate_results
+from app.utils.image_io import mask_bounding_box, to_rgb8
+from app.utils.merge_csv import plan_color_matching, apply_color_matching
+from app.utils.image_segmentation.felzenszwalb_segmentation import (
+    felzenszwalb_segment_array, felzenszwalb_params_for_shape, compute_segment_statistics,
+    extract_segment_colors_and_areas, segment_data_to_frame, select_segments, region_segment_counts,
+    smallest_unsigned_dtype
+)
+
+# Parameters of the analysis engine that are not part of the request
+ENGINE_PARAMS = {
+    'color_map_grid_rows': 35,
+    'merge_k': 3,
+    'merge_inverse_distance': True,
+}
+
+# Extra pixels read around the mask's bounding box when cropping to the mask
+SEGMENTATION_MARGIN = 8
+
+
+def crop_to_mask(image, mask, margin=SEGMENTATION_MARGIN, bbox=None):
+    """
+    Crops an image and its mask to the mask's bounding box plus `margin` (room
+    for the Gaussian smoothing) and blacks out the pixels outside the mask.
+
+    Only the cropped region of `image` is read, so memory-mapped images are
+    never paged in as a whole.
+
+    Args:
+        image (numpy.ndarray): (H, W) or (H, W, C) image of any supported dtype.
+        mask (numpy.ndarray): 2D mask of the same height and width; non-zero is inside.
+        margin (int): Pixels kept around the bounding box.
+        bbox (tuple, optional): The crop, margin included, when it is already
+            known (e.g. from `geometry_bounding_box`); saves scanning the mask.
+
+    Returns:
+        tuple: (uint8 RGB region, cropped mask, (top, bottom, left, right) of the crop)
+
+    Raises:
+        ValueError: If the shapes differ or the mask is empty.
+    """
+    if mask.shape != image.shape[:2]:
+        raise ValueError(f'Mask size {mask.shape[::-1]} does not match image size {image.shape[1::-1]}')
+
+    if bbox is None:
+        bbox = mask_bounding_box(mask, margin=margin)
+        if bbox is None:
+            raise ValueError('Mask is empty')
+    top, bottom, left, right = bbox
+
+    mask = mask[top:bottom, left:right]
+    if not mask.any():
+        raise ValueError('Mask is empty')
+    region = to_rgb8(image[top:bottom, left:right])
+    region[mask == 0] = 0
+    return region, mask, bbox
+
+
+def segment_image(image, mask, memory_lean=True):
+    """
+    Runs the value-independent part of the analysis: crop to the mask,
+    Felzenszwalb segmentation and per-segment statistics. The result can be
+    aggregated any number of times with `aggregate_segments`, e.g. for new
+    top/bottom values, without segmenting again.
+
+    Args:
+        image (numpy.ndarray): Image to analyse, (H, W) or (H, W, C).
+        mask (numpy.ndarray): 2D mask of the region to analyse; non-zero is inside.
+        memory_lean (bool): See `felzenszwalb_segment_array`.
+
+    Returns:
+        dict: 'segments' (labels of the cropped region), 'bbox' (the crop as
+        (top, bottom, left, right) in image coordinates), 'segment_stats',
+        'selected' (colour and area of the segments kept inside the mask) and
+        'region_selections' (empty for a single mask).
+
+    Raises:
+        ValueError: If the mask does not fit the image or is empty.
+    """
+    region, mask, bbox = crop_to_mask(image, mask)
+
+    # Parameters depend on the full image size, as for uncropped inputs
+    params = felzenszwalb_params_for_shape(*image.shape[:2])
+    return segment_cropped(region, mask, bbox, params, memory_lean=memory_lean)
+
+
+def segment_cropped(region, mask, bbox, params, memory_lean=True):
+    """
+    The part of `segment_image` after the crop, for callers that crop
+    several images the same way (e.g. the frames of a sequence).
+
+    Args:
+        region (numpy.ndarray): uint8 RGB region from `crop_to_mask`; used as
+            the segmentation input, so it is modified in place.
+        mask (numpy.ndarray): Cropped mask; non-zero is inside.
+        bbox (tuple): (top, bottom, left, right) of the crop in the image.
+        params (tuple): Felzenszwalb (scale, sigma, min_size) for the full image size.
+        memory_lean (bool): See `felzenszwalb_segment_array`.
+
+    Returns:
+        dict: See `segment_image`.
+    """
+    scale, sigma, min_size = params
+    segments, segmentation_input = felzenszwalb_segment_array(
+        region, mask > 0, scale, sigma, min_size, memory_lean=memory_lean
+    )
+
+    segment_stats = compute_segment_statistics(segments, segmentation_input, mask)
+    segment_colors = extract_segment_colors_and_areas(segments, segmentation_input, mask, segment_stats=segment_stats)
+
+    return {
+        'segments': segments,
+        'bbox': bbox,
+        'segment_stats': segment_stats,
+        'selected': segment_data_to_frame(segment_colors),
+        'region_selections': [],
+    }
+
+
+def plan_segment_values(state, color_table, k=ENGINE_PARAMS['merge_k'],
+                        use_inverse_distance=ENGINE_PARAMS['merge_inverse_distance']):
+    """
+    Matches the colours of every kept segment of a `segment_image` /
+    `segment_regions` result against a colour map (see `plan_color_matching`).
+    The plan holds for any top/bottom values of that colour map.
+    """
+    candidates = state['selected']
+    if state['region_selections']:
+        # Regions share the assignments of segments they have in common
+        candidates = pd.concat([candidates] + state['region_selections'])
+        candidates = candidates[~candidates.index.duplicated()]
+    return plan_color_matching(color_table, candidates.reset_index(), k=k, use_inverse_distance=use_inverse_distance)
+
+
+def aggregate_segments(state, color_table, k=ENGINE_PARAMS['merge_k'],
+                       use_inverse_distance=ENGINE_PARAMS['merge_inverse_distance'], plan=None):
+    """
+    Assigns values to the segments of a `segment_image`/`segment_regions`
+    result from a colour map table and aggregates them. This is the only part
+    of the analysis that depends on the colour map and the top/bottom values.
+
+    Args:
+        state (dict): Result of `segment_image` or `segment_regions`.
+        color_table (pandas.DataFrame): Result of `calibrate_color_map`.
+        k (int): Neighbours used when interpolating colours between bands.
+        use_inverse_distance (bool): Weight the neighbours by inverse distance.
+        plan (dict, optional): Result of `plan_segment_values` for the same
+            state and colour map, to skip the colour matching.
+
+    Returns:
+        dict: 'merged_df' (per-segment table with assigned values), 'results'
+        (see `aggregate_results`) and 'regions', one entry per region with its
+        'results' or an 'error' message.
+
+    Raises:
+        ValueError: If no segment lies inside the mask (or union of regions).
+    """
+    if plan is None:
+        plan = plan_segment_values(state, color_table, k=k, use_inverse_distance=use_inverse_distance)
+    assigned = apply_color_matching(plan, color_table['Assigned_Value'].to_numpy())
+
+    region_selections = state['region_selections']
+    if not region_selections:
+        return {'merged_df': assigned, 'results': aggregate_results(assigned), 'regions': []}
+
+    assigned_values = pd.Series(assigned['Assigned_Value'].to_numpy(), index=assigned['Segment'].to_numpy())
+
+    def merged_frame(segments):
+        merged_df = segments.reset_index()
+        merged_df['Assigned_Value'] = assigned_values.reindex(merged_df['Segment'].to_numpy()).to_numpy()
+        return merged_df
+
+    region_results = []
+    for region, region_selected in enumerate(region_selections, start=1):
+        try:
+            region_results.append({'region': region, 'results': aggregate_results(merged_frame(region_selected))})
+        except ValueError as e:
+            region_results.append({'region': region, 'error': str(e)})
+
+    merged_df = merged_frame(state['selected'])
+    return {'merged_df': merged_df, 'results': aggregate_results(merged_df), 'regions': region_results}
+
+
+def analyze_image(image, mask, color_table, memory_lean=True, k=ENGINE_PARAMS['merge_k'],
+                  use_inverse_distance=ENGINE_PARAMS['merge_inverse_distance']):
+    """
+    Runs the analysis of `/calculate-average` on in-memory arrays: crop to the
+    mask, Felzenszwalb segmentation, per-segment statistics, colour matching
+    against the colour map table and aggregation. Nothing is written to disk.
+
+    Args:
+        image (numpy.ndarray): Image to analyse, (H, W) or (H, W, C).
+        mask (numpy.ndarray): 2D mask of the region to analyse; non-zero is inside.
+        color_table (pandas.DataFrame): Result of `calibrate_color_map`.
+        memory_lean (bool): See `felzenszwalb_segment_array`.
+        k (int): Neighbours used when interpolating colours between bands.
+        use_inverse_distance (bool): Weight the neighbours by inverse distance.
+
+    Returns:
+        dict: The keys of `segment_image` and `aggregate_segments`.
+
+    Raises:
+        ValueError: If the mask does not fit the image, is empty, or no
+            segment lies inside it.
+    """
+    state = segment_image(image, mask, memory_lean=memory_lean)
+    return {**state, **aggregate_segments(state, color_table, k=k, use_inverse_distance=use_inverse_distance)}
+
+
+def _boundary_fraction(segments, inside):
+    """
+    Fraction of the pixels inside the mask that touch (4-neighbourhood) another
+    segment or the outside of the mask.
+    """
+    labels = np.where(inside, segments.astype(np.int64), -1)
+    boundary = np.zeros(inside.shape, dtype=bool)
+    vertical = labels[1:] != labels[:-1]
+    horizontal = labels[:, 1:] != labels[:, :-1]
+    boundary[1:] |= vertical
+    boundary[:-1] |= vertical
+    boundary[:, 1:] |= horizontal
+    boundary[:, :-1] |= horizontal
+    # Pixels on the edge of the crop border the outside
+    boundary[[0, -1], :] = True
+    boundary[:, [0, -1]] = True
+    return np.count_nonzero(boundary & inside) / max(np.count_nonzero(inside), 1)
+
+
+def estimate_average(image, mask, color_table, max_size=256, bbox=None, memory_lean=True,
+                     k=ENGINE_PARAMS['merge_k'], use_inverse_distance=ENGINE_PARAMS['merge_inverse_distance']):
+    """
+    Coarse, fast version of `analyze_image` for a first answer: the image is
+    cropped to the mask and downsampled so its longer side is at most
+    `max_size` pixels before segmentation and aggregation.
+
+    Interior pixels keep their segment's colour under area averaging, so the
+    estimate can only differ from the full-resolution result where the coarse
+    pixels straddle a segment or mask boundary. 'errorBound' assumes those
+    pixels could take any value in the range of the segments found, which is
+    a conservative heuristic rather than a strict bound.
+
+    Args:
+        image (numpy.ndarray): Image to analyse, (H, W) or (H, W, C).
+        mask (numpy.ndarray): 2D mask of the region to analyse; non-zero is inside.
+        color_table (pandas.DataFrame): Result of `calibrate_color_map`.
+        max_size (int): Longest side of the downsampled crop in pixels.
+        bbox (tuple, optional): Crop (top, bottom, left, right), if already known.
+        memory_lean (bool): See `felzenszwalb_segment_array`.
+        k (int): Neighbours used when interpolating colours between bands.
+        use_inverse_distance (bool): Weight the neighbours by inverse distance.
+
+    Returns:
+        dict: 'average', 'errorBound', 'colorMapData' (percentages of the
+        downsampled area) and 'scale' (original pixels per coarse pixel, per side).
+
+    Raises:
+        ValueError: If the mask does not fit the image, is empty, or no
+            segment lies inside it.
+    """
+    if mask.shape != image.shape[:2]:
+        raise ValueError(f'Mask size {mask.shape[::-1]} does not match image size {image.shape[1::-1]}')
+    if bbox is None:
+        bbox = mask_bounding_box(mask)
+        if bbox is None:
+            raise ValueError('Mask is empty')
+    top, bottom, left, right = bbox
+    height, width = bottom - top, right - left
+    inside = (mask[top:bottom, left:right] > 0).view(np.uint8)
+
+    factor = max(height, width) / max_size
+    if factor > 1:
+        size = (max(int(round(width / factor)), 1), max(int(round(height / factor)), 1))
+        # Strided read first, so memory-mapped images are not paged in as a whole
+        step = max(int(factor // 2), 1)
+        region = cv2.resize(to_rgb8(image[top:bottom:step, left:right:step]), size, interpolation=cv2.INTER_AREA)
+        coarse_mask = cv2.resize(inside * 255, size, interpolation=cv2.INTER_AREA)
+        # Keep thin selections that a majority vote would lose
+        coarse_mask = (coarse_mask >= 128) if (coarse_mask >= 128).any() else (coarse_mask > 0)
+        coarse_mask = coarse_mask.view(np.uint8)
+    else:
+        factor = 1.0
+        region = to_rgb8(image[top:bottom, left:right])
+        coarse_mask = inside
+    if not coarse_mask.any():
+        raise ValueError('Mask is empty')
+    region[coarse_mask == 0] = 0
+
+    params = felzenszwalb_params_for_shape(*region.shape[:2])
+    state = segment_cropped(region, coarse_mask, bbox, params, memory_lean=memory_lean)
+    analysis = aggregate_segments(state, color_table, k=k, use_inverse_distance=use_inverse_distance)
+
+    values = analysis['merged_df']['Assigned_Value'].to_numpy(dtype=np.float64)
+    value_range = float(values.max() - values.min()) if values.size else 0.0
+    results = analysis['results']
+    return {
+        'average': results['average'],
+        'errorBound': _boundary_fraction(state['segments'], coarse_mask > 0) * value_range,
+        'colorMapData': results['colorMapData'],
+        'scale': float(factor),
+    }
+
+
+def regions_from_masks(masks):
+    """
+    Combines separate binary masks into the region layout `analyze_regions`
+    takes: a label array when they are disjoint, a boolean stack otherwise.
+
+    Args:
+        masks (list): 2D masks of equal shape; non-zero is inside.
+
+    Returns:
+        numpy.ndarray: (H, W) labels 1..N, or (N, H, W) booleans if masks overlap.
+    """
+    stack = np.stack([np.asarray(mask) > 0 for mask in masks])
+    if stack.sum(axis=0, dtype=np.uint16).max(initial=0) > 1:
+        return stack
+    labels = np.zeros(stack.shape[1:], dtype=smallest_unsigned_dtype(len(masks)))
+    for index, mask in enumerate(stack, start=1):
+        labels[mask] = index
+    return labels
+
+
+def regions_from_label_mask(label_mask):
+    """
+    Turns a label-valued mask into consecutive region indices.
+
+    Returns:
+        tuple: ((H, W) array of indices 1..N, 0 outside) and the original
+        label value of each region.
+    """
+    values, inverse = np.unique(label_mask, return_inverse=True)
+    inverse = inverse.reshape(label_mask.shape)
+    if values.size and values[0] == 0:
+        return inverse.astype(smallest_unsigned_dtype(values.size - 1)), values[1:]
+    return (inverse + 1).astype(smallest_unsigned_dtype(values.size)), values
+
+
+def segment_regions(image, regions, memory_lean=True):
+    """
+    Segments several regions of one image at once: the value-independent
+    part of `analyze_regions`.
+
+    The image is segmented once over the union of the regions, and a single
+    (region x segment) pixel count tells which segments lie in which region.
+
+    Args:
+        image (numpy.ndarray): Image to analyse, (H, W) or (H, W, C).
+        regions (numpy.ndarray): (H, W) region indices 1..N (0 outside), or an
+            (N, H, W) boolean stack for overlapping regions.
+        memory_lean (bool): See `felzenszwalb_segment_array`.
+
+    Returns:
+        dict: As `segment_image` for the union of the regions, with one
+        selection per region in 'region_selections'.
+    """
+    stacked = regions.ndim == 3
+    num_regions = regions.shape[0] if stacked else int(regions.max(initial=0))
+    union = regions.any(axis=0) if stacked else regions > 0
+
+    region_image, union_mask, bbox = crop_to_mask(image, union.view(np.uint8))
+    top, bottom, left, right = bbox
+    regions = regions[:, top:bottom, left:right] if stacked else regions[top:bottom, left:right]
+
+    scale, sigma, min_size = felzenszwalb_params_for_shape(*image.shape[:2])
+    segments, segmentation_input = felzenszwalb_segment_array(
+        region_image, union_mask > 0, scale, sigma, min_size, memory_lean=memory_lean
+    )
+    segment_stats = compute_segment_statistics(segments, segmentation_input, union_mask)
+    float_colors = np.issubdtype(segmentation_input.dtype, np.floating)
+
+    # Pixels of every segment in every region, in segment_stats order
+    inside = region_segment_counts(segments, regions, num_regions)[:, segment_stats.index.to_numpy()]
+    region_pixels = inside.sum(axis=1)
+
+    return {
+        'segments': segments,
+        'bbox': bbox,
+        'segment_stats': segment_stats,
+        'selected': select_segments(
+            segment_stats, int(np.count_nonzero(union_mask)),
+            inside_mask_count=segment_stats['InsideMaskCount'].to_numpy(), float_colors=float_colors,
+        ),
+        'region_selections': [
+            select_segments(segment_stats, region_pixels[region], inside_mask_count=inside[region], float_colors=float_colors)
+            for region in range(num_regions)
+        ],
+    }
+
+
+def analyze_regions(image, regions, color_table, memory_lean=True, k=ENGINE_PARAMS['merge_k'],
+                    use_inverse_distance=ENGINE_PARAMS['merge_inverse_distance']):
+    """
+    Analyses several regions of one image with a single segmentation.
+
+    Colours are matched against the colour map once for all kept segments,
+    and each region is aggregated on its own rows. The union itself is
+    aggregated too, exactly like a single-mask analysis.
+
+    Args:
+        image (numpy.ndarray): Image to analyse, (H, W) or (H, W, C).
+        regions (numpy.ndarray): See `segment_regions`.
+        color_table (pandas.DataFrame): Result of `calibrate_color_map`.
+        memory_lean (bool): See `felzenszwalb_segment_array`.
+        k (int): Neighbours used when interpolating colours between bands.
+        use_inverse_distance (bool): Weight the neighbours by inverse distance.
+
+    Returns:
+        dict: The keys of `segment_regions` and `aggregate_segments`; 'results'
+        describes the union and 'regions' each region.
+    """
+    state = segment_regions(image, regions, memory_lean=memory_lean)
+    return {**state, **aggregate_segments(state, color_table, k=k, use_inverse_distance=use_inverse_distance)}
@@ -0,0 +1,92 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class AnalysisSession:
+    """
+    What one client's last analysis left behind that does not depend on the
+    colour map or the top/bottom values: the segmentation and per-segment
+    selection (see `segment_image`), keyed by the fingerprint of the image and
+    masks it was computed from, plus the colour maps calibrated so far and
+    how the segment colours match each of them.
+    """
+
+    def __init__(self, fingerprint, state, image_fingerprint=None):
+        self.fingerprint = fingerprint
+        self.image_fingerprint = image_fingerprint
+        self.state = state
+        self.color_maps = {}  # colour map content hash -> (ColorMap, colour matching plan)
+        self.touched_at = time.time()
+
+
+class AnalysisSessionStore:
+    """
+    LRU store of analysis sessions with a TTL.
+
+    A client passes the same session id with every request. When a request
+    comes with the same image and masks as the session's last analysis, the
+    segmentation is reused and only the value assignment and aggregation run
+    again; when only the mask changed, the segmentation can be updated around
+    the edit.
+    """
+
+    def __init__(self, max_sessions=16, ttl=30 * 60):
+        """
+        Args:
+            max_sessions (int): Sessions kept at most; the least recently used is dropped.
+            ttl (float): Seconds an unused session is kept; None or 0 disables expiry.
+        """
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()  # session id -> AnalysisSession
+        self._lock = threading.Lock()
+
+    def _expired(self, session, now):
+        return bool(self.ttl) and now - session.touched_at > self.ttl
+
+    def get(self, session_id, fingerprint, image_fingerprint=None):
+        """
+        Returns the session if its last analysis was of the inputs identified by
+        `fingerprint`, or, when `image_fingerprint` is given, of the same image
+        with other masks; otherwise None.
+        """
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            if self._expired(session, now):
+                del self._sessions[session_id]
+                return None
+            if session.fingerprint != fingerprint and (
+                image_fingerprint is None or session.image_fingerprint != image_fingerprint
+            ):
+                return None
+            session.touched_at = now
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def put(self, session_id, fingerprint, state, image_fingerprint=None):
+        """
+        Records the analysis state of a session, replacing any previous one.
+
+        Returns:
+            AnalysisSession: The new session.
+        """
+        session = AnalysisSession(fingerprint, state, image_fingerprint)
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            self._sessions[session_id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return session
+
+    def discard(self, session_id):
+        """Forgets a session."""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
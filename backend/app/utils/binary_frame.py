@@ -0,0 +1,109 @@
+import json
+import struct
+import numpy as np
+
+# Content type of framed responses; clients ask for it in Accept
+FRAME_MIMETYPE = 'application/x-vistar-frame'
+
+FRAME_MAGIC = b'VSTF'
+FRAME_VERSION = 1
+
+# Magic, version, three reserved bytes and the header length
+_PREFIX = struct.Struct('<4sB3xI')
+
+# Payloads start on multiples of this, so clients can view them as typed arrays in place
+FRAME_ALIGNMENT = 8
+
+
+def _padding(length):
+    return -length % FRAME_ALIGNMENT
+
+
+def encode_frame(meta, arrays):
+    """
+    Packs JSON metadata and raw arrays into one binary frame, so images and
+    rasters travel without JSON, base64 or multipart encoding.
+
+    Layout (little-endian): b'VSTF', a version byte, three reserved bytes,
+    the uint32 length of a UTF-8 JSON header, the header, then every array's
+    bytes in C order. The header is ``{"meta": ..., "arrays": [{"name",
+    "dtype", "shape", "offset", "nbytes"}, ...]}`` with offsets counted from
+    the start of the frame. The header and every payload start on an
+    8-byte boundary.
+
+    Args:
+        meta (dict): JSON-serialisable metadata.
+        arrays (dict): Name -> numpy.ndarray (or bytes, sent as uint8).
+
+    Returns:
+        bytes: The frame.
+    """
+    payloads = []
+    for name, array in arrays.items():
+        if isinstance(array, (bytes, bytearray, memoryview)):
+            array = np.frombuffer(array, dtype=np.uint8)
+        array = np.ascontiguousarray(array)
+        if array.dtype.byteorder == '>':
+            array = array.astype(array.dtype.newbyteorder('<'))
+        payloads.append((name, array))
+
+    # The offsets depend on the header length, which depends on the offsets'
+    # digits; settle on a header length that holds them
+    header_length = 0
+    while True:
+        offset = _PREFIX.size + header_length + _padding(_PREFIX.size + header_length)
+        entries = []
+        for name, array in payloads:
+            entries.append({
+                'name': name,
+                'dtype': array.dtype.str.lstrip('<|='),
+                'shape': list(array.shape),
+                'offset': offset,
+                'nbytes': array.nbytes,
+            })
+            offset += array.nbytes + _padding(array.nbytes)
+        header = json.dumps({'meta': meta, 'arrays': entries}, separators=(',', ':')).encode('utf-8')
+        if len(header) <= header_length:
+            break
+        header_length = len(header)
+    header = header.ljust(header_length)
+
+    parts = [_PREFIX.pack(FRAME_MAGIC, FRAME_VERSION, len(header)), header,
+             b'\0' * _padding(_PREFIX.size + len(header))]
+    for _, array in payloads:
+        parts.append(array.tobytes())
+        parts.append(b'\0' * _padding(array.nbytes))
+    return b''.join(parts)
+
+
+def decode_frame(data):
+    """
+    Unpacks a frame written by `encode_frame`.
+
+    Returns:
+        tuple: (meta, arrays) with arrays as read-only views into `data`.
+
+    Raises:
+        ValueError: If `data` is not a valid frame.
+    """
+    data = memoryview(data)
+    if len(data) < _PREFIX.size:
+        raise ValueError('Frame is truncated')
+    magic, version, header_length = _PREFIX.unpack_from(data)
+    if magic != FRAME_MAGIC:
+        raise ValueError('Not a binary frame')
+    if version != FRAME_VERSION:
+        raise ValueError(f'Unsupported frame version: {version}')
+    try:
+        header = json.loads(bytes(data[_PREFIX.size:_PREFIX.size + header_length]))
+    except ValueError as e:
+        raise ValueError(f'Invalid frame header: {e}')
+
+    arrays = {}
+    for entry in header.get('arrays', []):
+        end = entry['offset'] + entry['nbytes']
+        if entry['offset'] < 0 or end > len(data):
+            raise ValueError(f"Array '{entry['name']}' lies outside the frame")
+        dtype = np.dtype(entry['dtype']).newbyteorder('<')
+        arrays[entry['name']] = np.frombuffer(data[entry['offset']:end], dtype=dtype).reshape(entry['shape'])
+    return header.get('meta'), arrays
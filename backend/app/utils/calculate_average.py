@@ -1,6 +1,7 @@
 import pandas as pd
 import os
 from app.utils.wait_for_file import wait_for_file
+from app.utils.aggregate_results import pack_rgb
 
 def calculate_average(merged_file_path, timeout=30):
     """
@@ -31,8 +32,8 @@ def calculate_average(merged_file_path, timeout=30):
     if missing_columns:
         raise ValueError(f"Required columns missing in the file: {missing_columns}")
 
-    # Create a color identifier by combining RGB values
-    df['Color_ID'] = df['R'].astype(str) + '_' + df['G'].astype(str) + '_' + df['B'].astype(str)
+    # Create a color identifier by packing RGB values into a 24-bit key
+    df['Color_ID'] = pack_rgb(df['R'].to_numpy(), df['G'].to_numpy(), df['B'].to_numpy())
 
     # Group by unique colors and sum their areas
     color_groups = df.groupby('Color_ID').agg({
@@ -0,0 +1,226 @@
+import os
+import json
+import uuid
+import threading
+from contextlib import contextmanager
+
+_locks = {}  # upload id -> [lock, number of threads holding or waiting for it]
+_locks_guard = threading.Lock()
+
+
+@contextmanager
+def _upload_lock(upload_id):
+    """
+    Serialises the operations on one upload. The lock only exists while a
+    thread holds or waits for it, so ids that come and go (or never existed)
+    leave nothing behind.
+    """
+    with _locks_guard:
+        entry = _locks.setdefault(upload_id, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _locks[upload_id]
+
+
+def _meta_path(upload_root, upload_id):
+    return os.path.join(upload_root, f"{upload_id}.json")
+
+
+def _part_path(upload_root, upload_id):
+    return os.path.join(upload_root, f"{upload_id}.part")
+
+
+def _valid_upload_id(upload_id):
+    try:
+        return uuid.UUID(upload_id).hex == upload_id
+    except (ValueError, TypeError):
+        return False
+
+
+def read_upload_meta(upload_root, upload_id):
+    """
+    Returns the metadata of an upload, or None if it does not exist.
+
+    The 'offset' field is the number of bytes received so far; clients resume
+    an interrupted upload by sending the next chunk from there.
+    """
+    if not _valid_upload_id(upload_id):
+        return None
+    try:
+        with open(_meta_path(upload_root, upload_id)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not meta['complete']:
+        part_path = _part_path(upload_root, upload_id)
+        meta['offset'] = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    return meta
+
+
+def _write_meta(upload_root, meta):
+    path = _meta_path(upload_root, meta['uploadId'])
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, path)
+
+
+def create_upload(upload_root, filename, total_size=None):
+    """
+    Starts a chunked upload.
+
+    Args:
+        upload_root (str): Directory holding in-progress and finished uploads.
+        filename (str): Sanitised original file name (its extension is kept).
+        total_size (int, optional): Expected size in bytes, checked on completion.
+
+    Returns:
+        dict: Upload metadata including 'uploadId' and 'offset'.
+    """
+    os.makedirs(upload_root, exist_ok=True)
+    upload_id = uuid.uuid4().hex
+    meta = {
+        'uploadId': upload_id,
+        'filename': filename,
+        'totalSize': total_size,
+        'offset': 0,
+        'complete': False,
+        'path': None,
+    }
+    open(_part_path(upload_root, upload_id), 'wb').close()
+    _write_meta(upload_root, meta)
+    return meta
+
+
+def append_chunk(upload_root, upload_id, offset, stream, length=None, buffer_size=1024 * 1024):
+    """
+    Appends bytes from `stream` to an upload, copying `buffer_size` bytes at a time
+    so the request body is never held in memory.
+
+    A chunk that turns out shorter or longer than `length`, or that runs past
+    the upload's declared total size, is rolled back, so the client can send
+    it again from the same offset.
+
+    Args:
+        upload_root (str): Upload directory.
+        upload_id (str): Upload identifier.
+        offset (int): Byte offset the chunk starts at; must equal the bytes
+            received so far.
+        stream: File-like object to read the chunk from.
+        length (int, optional): Bytes the chunk must have, when known.
+        buffer_size (int): Copy buffer size in bytes.
+
+    Returns:
+        dict: Updated metadata.
+
+    Raises:
+        FileNotFoundError: If the upload does not exist.
+        ValueError: If the upload is complete, `offset` does not match or the
+            chunk does not have the expected size.
+    """
+    with _upload_lock(upload_id):
+        meta = read_upload_meta(upload_root, upload_id)
+        if meta is None:
+            raise FileNotFoundError(f"Unknown upload: {upload_id}")
+        if meta['complete']:
+            raise ValueError("Upload is already complete")
+        if offset != meta['offset']:
+            raise ValueError(f"Chunk offset {offset} does not match received size {meta['offset']}")
+
+        # Bytes the chunk may have; one more is read to notice chunks that run over
+        limit = length
+        if meta['totalSize'] is not None:
+            remaining = meta['totalSize'] - offset
+            limit = remaining if limit is None else min(limit, remaining)
+        received = 0
+        with open(_part_path(upload_root, upload_id), 'ab') as f:
+            while limit is None or received <= limit:
+                block = stream.read(buffer_size if limit is None else min(buffer_size, limit + 1 - received))
+                if not block:
+                    break
+                f.write(block)
+                received += len(block)
+
+            error = None
+            if meta['totalSize'] is not None and offset + received > meta['totalSize']:
+                error = f"Chunk runs past the upload's total size of {meta['totalSize']} bytes"
+            elif length is not None and received > length:
+                error = f"Chunk has more than {length} bytes"
+            elif length is not None and received < length:
+                error = f"Chunk has {received} bytes, expected {length}"
+            if error is not None:
+                f.truncate(offset)
+                raise ValueError(error)
+
+        return read_upload_meta(upload_root, upload_id)
+
+
+def complete_upload(upload_root, upload_id, store=None):
+    """
+    Finishes an upload and moves it to its final name, or into `store` (an
+    `UploadStore`) where identical content is kept only once.
+
+    Returns:
+        dict: Final metadata; 'path' points at the stored file.
+
+    Raises:
+        FileNotFoundError: If the upload does not exist.
+        ValueError: If fewer or more bytes than announced were received.
+    """
+    with _upload_lock(upload_id):
+        meta = read_upload_meta(upload_root, upload_id)
+        if meta is None:
+            raise FileNotFoundError(f"Unknown upload: {upload_id}")
+        if meta['complete']:
+            return meta
+        if meta['totalSize'] is not None and meta['offset'] != meta['totalSize']:
+            raise ValueError(f"Received {meta['offset']} of {meta['totalSize']} bytes")
+
+        if store is not None:
+            final_path = store.adopt(_part_path(upload_root, upload_id), meta['filename'])
+        else:
+            extension = os.path.splitext(meta['filename'])[1].lower()
+            final_path = os.path.join(upload_root, f"{upload_id}{extension}")
+            os.replace(_part_path(upload_root, upload_id), final_path)
+        meta.update({'complete': True, 'path': final_path, 'totalSize': meta['offset']})
+        _write_meta(upload_root, meta)
+        return meta
+
+
+def register_stored_upload(upload_root, filename, path):
+    """
+    Records a finished upload for a file that is already stored, e.g. found
+    in the upload store by its content hash, so nothing has to be sent.
+
+    Returns:
+        dict: Upload metadata, complete and pointing at `path`.
+    """
+    os.makedirs(upload_root, exist_ok=True)
+    size = os.path.getsize(path)
+    meta = {
+        'uploadId': uuid.uuid4().hex,
+        'filename': filename,
+        'totalSize': size,
+        'offset': size,
+        'complete': True,
+        'path': path,
+    }
+    _write_meta(upload_root, meta)
+    return meta
+
+
+def get_completed_upload_path(upload_root, upload_id):
+    """
+    Returns the stored file path of a finished upload, or None (also once the
+    stored file has been evicted).
+    """
+    meta = read_upload_meta(upload_root, upload_id)
+    if meta is None or not meta['complete'] or not os.path.exists(meta['path']):
+        return None
+    return meta['path']
@@ -96,6 +96,24 @@ def generate_distributed_values(min_value, max_value, num_segments, distribution
     else:
         raise ValueError(f"Unknown distribution type: {distribution_type}")
 
+def calibrate_color_map(color_map, top_value, bottom_value, num_rows=35):
+    """
+    Samples the colour bands of a colour map and assigns each one its value,
+    without writing anything to disk.
+
+    Args:
+        color_map (str or numpy.ndarray): Colour map image or its path.
+        top_value (float): Value of the top band.
+        bottom_value (float): Value of the bottom band.
+        num_rows (int): Number of bands the bar is split into.
+
+    Returns:
+        pandas.DataFrame: Indexed by 'Segment' with columns R, G, B and Assigned_Value.
+    """
+    segments, image = grid_segmentation(color_map, num_rows=num_rows)
+    segment_colors = extract_grid_segment_colors(segments, image)
+    return build_color_map_table(segment_colors, bottom_value, top_value)
+
 def process_color_map(filepath, upload_folder, top_value, bottom_value):
     # Segment the image
     segments, image = grid_segmentation(filepath)
@@ -107,7 +125,19 @@ def process_color_map(filepath, upload_folder, top_value, bottom_value):
     
     return csv_path
 
-def export_segment_colors_to_csv(segment_colors, min_value, max_value, output_csv_path):
+def build_color_map_table(segment_colors, min_value, max_value):
+    """
+    Builds the colour map table: one row per band with its mean colour and the
+    value assigned to it, highest value first.
+
+    Args:
+        segment_colors (dict): Band id -> RGB colour, as from `extract_grid_segment_colors`.
+        min_value (float): Value of the last band.
+        max_value (float): Value of the first band.
+
+    Returns:
+        pandas.DataFrame: Indexed by 'Segment' with columns R, G, B and Assigned_Value.
+    """
     # Convert the segment_colors dictionary to a pandas DataFrame
     df = pd.DataFrame.from_dict(segment_colors, orient='index', columns=['R', 'G', 'B'])
     df.index.name = 'Segment'
@@ -115,17 +145,46 @@ def export_segment_colors_to_csv(segment_colors, min_value, max_value, output_cs
     # Exclude segment 0
     df = df[df.index != 0]
 
-    # Determine the appropriate distribution type
-    distribution_type = determine_distribution_type(min_value, max_value)
-    
-    # Generate values based on the determined distribution
-    num_segments = len(df)
+    # Generate values based on the distribution the range calls for
+    df['Assigned_Value'], distribution_type = distributed_band_values(min_value, max_value, len(df))
+    print(f"Using {distribution_type} distribution for value assignment")
+
+    return df
+
+def distributed_band_values(min_value, max_value, num_bands, distribution_type=None):
+    """
+    Values of the colour map bands, highest first, as `build_color_map_table`
+    assigns them.
+
+    Args:
+        min_value (float): Value of the last band.
+        max_value (float): Value of the first band.
+        num_bands (int): Number of bands.
+        distribution_type (str, optional): 'linear', 'log' or 'symlog';
+            `determine_distribution_type` picks one when None.
+
+    Returns:
+        tuple: (numpy.ndarray of values, distribution used). A distribution
+        the range does not allow (a zero end, or a log of a non-positive
+        value) falls back to 'linear', and is reported as such.
+    """
+    if distribution_type is None:
+        distribution_type = determine_distribution_type(min_value, max_value)
+    linear = np.linspace(max_value, min_value, num_bands)
+    # generate_distributed_values quietly returns linear values for a zero end
+    if distribution_type == 'linear' or min_value == 0 or max_value == 0:
+        return linear, 'linear'
     try:
-        df['Assigned_Value'] = generate_distributed_values(min_value, max_value, num_segments, distribution_type)
-        print(f"Using {distribution_type} distribution for value assignment")
-    except ValueError as e:
-        print(f"Error with {distribution_type} distribution: {e}. Falling back to linear distribution.")
-        df['Assigned_Value'] = np.linspace(max_value, min_value, num_segments)
+        values = generate_distributed_values(min_value, max_value, num_bands, distribution_type)
+    except ValueError:
+        return linear, 'linear'
+    if not np.all(np.isfinite(values)):
+        # e.g. 'log' with a positive bottom and negative top value
+        return linear, 'linear'
+    return values, distribution_type
+
+def export_segment_colors_to_csv(segment_colors, min_value, max_value, output_csv_path):
+    df = build_color_map_table(segment_colors, min_value, max_value)
 
     # Export the DataFrame to CSV
     df.to_csv(output_csv_path)
@@ -3,8 +3,20 @@ from skimage import io
 from skimage.transform import resize
 from skimage.color import rgba2rgb
 
-def grid_segmentation(input_image_path, num_rows=35, num_cols=1):
-    image = io.imread(input_image_path)
+def grid_segmentation(input_image, num_rows=35, num_cols=1):
+    """
+    Splits a colour-bar image into a grid of bands on a 512x512 resize.
+
+    Args:
+        input_image (str or numpy.ndarray): Path to the colour map image, or
+            the image itself as decoded by `skimage.io.imread`.
+        num_rows (int): Number of bands along the bar.
+        num_cols (int): Number of columns.
+
+    Returns:
+        tuple: (segment grid, resized float image)
+    """
+    image = io.imread(input_image) if isinstance(input_image, str) else np.asarray(input_image)
     
     # Convert RGBA to RGB if necessary
     if image.ndim == 3 and image.shape[2] == 4:
@@ -0,0 +1,182 @@
+import os
+import math
+import time
+import logging
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+import cv2
+
+# Environment variables read by the BLAS/OpenMP runtimes when they load; set
+# before worker processes start so the workers inherit them
+THREAD_ENV_VARS = (
+    'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS',
+)
+
+# How the machine is shared out between concurrent analyses
+ConcurrencyPlan = namedtuple('ConcurrencyPlan', ['slots', 'workers', 'threads'])
+
+
+def available_memory():
+    """
+    Returns the physical memory currently available in bytes, or None where
+    the platform does not report it.
+    """
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def plan_concurrency(cpu_count=None, memory=None, job_memory=512 * 1024 * 1024,
+                     max_slots=None, workers=None, threads=None):
+    """
+    Sizes the number of analyses run at once, the worker pool and the native
+    threads each analysis may use, so that together they do not oversubscribe
+    the cores or run out of memory.
+
+    Args:
+        cpu_count (int, optional): Cores to plan for; defaults to `os.cpu_count()`.
+        memory (int, optional): Bytes available; defaults to `available_memory()`.
+        job_memory (int): Estimated peak bytes of one analysis.
+        max_slots (int, optional): Analyses run at once; sized from the cores
+            and memory when None.
+        workers (int, optional): Size of the worker pool; sized like the slots
+            when None, 0 for no pool.
+        threads (int, optional): Native threads per analysis; the cores are
+            divided among the concurrent analyses when None.
+
+    Returns:
+        ConcurrencyPlan: (slots, workers, threads).
+    """
+    cpu_count = cpu_count or os.cpu_count() or 1
+    if memory is None:
+        memory = available_memory()
+    fits_in_memory = max(memory // job_memory, 1) if memory and job_memory else cpu_count
+
+    if max_slots is None:
+        max_slots = max(min(cpu_count, fits_in_memory), 1)
+    if workers is None:
+        workers = max_slots
+    if threads is None:
+        threads = max(cpu_count // max(max_slots, workers, 1), 1)
+    return ConcurrencyPlan(max_slots, workers, threads)
+
+
+def limit_native_threads(threads):
+    """
+    Caps the threads OpenCV and the BLAS/OpenMP runtimes use in this process.
+
+    The environment variables only reach runtimes loaded afterwards (worker
+    processes inherit them); runtimes already loaded are limited through
+    threadpoolctl when it is installed.
+    """
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(threads)
+    cv2.setNumThreads(threads)
+
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(limits=threads)
+
+
+class Saturated(Exception):
+    """Raised when an analysis cannot be admitted; `retry_after` is in seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__('Server is busy, retry later')
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Bounds the analyses running at once and the ones waiting for a slot.
+
+    A request beyond `max_active` waits for a slot, as long as no more than
+    `max_queued` are already waiting and a slot frees up within
+    `queue_timeout` seconds; otherwise it is turned away with `Saturated`,
+    so bursts are shed early instead of slowing every request down.
+    """
+
+    def __init__(self, max_active, max_queued=8, queue_timeout=30):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self._active = 0
+        self._queued = 0
+        self._average_seconds = None
+        self._condition = threading.Condition()
+
+    def _retry_after(self):
+        # Roughly the time for the queue ahead to drain, at least one second
+        if self._average_seconds is None:
+            return 1
+        return max(math.ceil(self._average_seconds * (self._queued + 1) / self.max_active), 1)
+
+    @contextmanager
+    def admit(self):
+        """
+        Holds a slot for the duration of the block.
+
+        Raises:
+            Saturated: If the queue is full or no slot frees up in time.
+        """
+        with self._condition:
+            if self._active >= self.max_active:
+                if self._queued >= self.max_queued:
+                    raise Saturated(self._retry_after())
+                self._queued += 1
+                try:
+                    admitted = self._condition.wait_for(
+                        lambda: self._active < self.max_active, timeout=self.queue_timeout
+                    )
+                finally:
+                    self._queued -= 1
+                if not admitted:
+                    raise Saturated(self._retry_after())
+            self._active += 1
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self._condition:
+                self._active -= 1
+                # Exponential moving average of the time a slot is held
+                if self._average_seconds is None:
+                    self._average_seconds = elapsed
+                else:
+                    self._average_seconds = 0.8 * self._average_seconds + 0.2 * elapsed
+                self._condition.notify()
+
+    def snapshot(self):
+        """Returns the number of active and queued analyses."""
+        with self._condition:
+            return {'active': self._active, 'queued': self._queued, 'maxActive': self.max_active}
+
+
+def configure_concurrency(config):
+    """
+    Plans concurrency from the app configuration and applies the native
+    thread limit to this process.
+
+    Returns:
+        tuple: (ConcurrencyPlan, AdmissionController)
+    """
+    plan = plan_concurrency(
+        job_memory=config['ANALYSIS_MEMORY_ESTIMATE'],
+        max_slots=config['MAX_CONCURRENT_ANALYSES'],
+        workers=config['ANALYSIS_WORKERS'] or None,
+        threads=config['NATIVE_THREADS'],
+    )
+    limit_native_threads(plan.threads)
+    logging.info(f"Concurrency: {plan.slots} analyses at once, {plan.workers} pool workers, "
+                 f"{plan.threads} native threads each")
+    controller = AdmissionController(
+        plan.slots, max_queued=config['MAX_QUEUED_ANALYSES'], queue_timeout=config['ANALYSIS_QUEUE_TIMEOUT'],
+    )
+    return plan, controller
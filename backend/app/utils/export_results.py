@@ -0,0 +1,115 @@
+import os
+import numpy as np
+import pandas as pd
+
+LABELS_FILENAME = 'segment_labels.npz'
+TABLE_FILENAME = 'segment_table.npz'
+
+
+def smallest_label_dtype(max_label):
+    """
+    Returns the smallest unsigned integer dtype able to hold labels up to `max_label`.
+
+    Args:
+        max_label (int): Largest label value.
+
+    Returns:
+        numpy.dtype: uint8, uint16, uint32 or uint64.
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def export_segment_labels(segments, output_path):
+    """
+    Saves a label raster as a compressed `.npz` using the smallest integer dtype.
+
+    Negative labels (unlabelled pixels) are stored as 0.
+
+    Args:
+        segments (numpy.ndarray): 2D array of segment labels.
+        output_path (str): Destination `.npz` path.
+
+    Returns:
+        str: Path to the saved file.
+    """
+    max_label = int(segments.max()) if segments.size else 0
+    labels = np.clip(segments, 0, None).astype(smallest_label_dtype(max_label), copy=False)
+    _atomic_save(output_path, np.savez_compressed, labels=labels)
+    return output_path
+
+
+def load_segment_labels(path):
+    """
+    Loads a label raster written by `export_segment_labels`.
+
+    Args:
+        path (str): Path to the `.npz` file.
+
+    Returns:
+        numpy.ndarray: 2D label array in its stored dtype.
+    """
+    with np.load(path) as data:
+        return data['labels']
+
+
+def export_segment_table(df, output_path):
+    """
+    Saves a per-segment table column by column in an uncompressed `.npz`.
+
+    Each column is stored as its own typed array, so loading a column is a
+    single buffer read without any text parsing.
+
+    Args:
+        df (pandas.DataFrame): Table to save (e.g. the merged per-segment table).
+        output_path (str): Destination `.npz` path.
+
+    Returns:
+        str: Path to the saved file.
+    """
+    columns = {f"col_{i}": df[name].to_numpy() for i, name in enumerate(df.columns)}
+    _atomic_save(output_path, np.savez, __columns__=np.array(df.columns, dtype=str), **columns)
+    return output_path
+
+
+def load_segment_table(path):
+    """
+    Loads a table written by `export_segment_table`.
+
+    Args:
+        path (str): Path to the `.npz` file.
+
+    Returns:
+        pandas.DataFrame: The table with its original column order and dtypes.
+    """
+    with np.load(path) as data:
+        names = data['__columns__'].tolist()
+        return pd.DataFrame({name: data[f"col_{i}"] for i, name in enumerate(names)})
+
+
+def export_results(segments, merged_df, output_dir):
+    """
+    Writes the label raster and the merged per-segment table into `output_dir`.
+
+    Args:
+        segments (numpy.ndarray): 2D array of segment labels.
+        merged_df (pandas.DataFrame): Merged per-segment table.
+        output_dir (str): Directory to write into.
+
+    Returns:
+        dict: Paths of the 'labels' and 'table' files.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    return {
+        'labels': export_segment_labels(segments, os.path.join(output_dir, LABELS_FILENAME)),
+        'table': export_segment_table(merged_df, os.path.join(output_dir, TABLE_FILENAME)),
+    }
+
+
+def _atomic_save(output_path, save, **arrays):
+    # Write to a temporary name first so readers never see a partial file
+    tmp_path = f"{output_path}.tmp.npz"
+    save(tmp_path, **arrays)
+    os.replace(tmp_path, output_path)
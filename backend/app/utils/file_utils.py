@@ -1,5 +1,5 @@
 import os
 
 def allowed_file(filename):
-    allowed_extensions = {'png', 'jpg', 'jpeg', 'gif'}
+    allowed_extensions = {'png', 'jpg', 'jpeg', 'gif', 'tif', 'tiff'}
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed_extensions
@@ -0,0 +1,266 @@
+import os
+import cv2
+import numpy as np
+import tifffile
+from PIL import Image, ImageSequence
+
+TIFF_EXTENSIONS = {'tif', 'tiff'}
+ANIMATED_EXTENSIONS = {'gif'}
+
+
+def is_tiff(path):
+    """
+    Returns True if `path` has a TIFF extension.
+    """
+    return path.rsplit('.', 1)[-1].lower() in TIFF_EXTENSIONS
+
+
+def is_animated_format(path):
+    """
+    Returns True if `path` has the extension of a format that can hold
+    several frames besides TIFF (animated GIF).
+    """
+    return path.rsplit('.', 1)[-1].lower() in ANIMATED_EXTENSIONS
+
+
+def count_pages(path):
+    """
+    Returns the number of pages (frames) in an image file; 1 for single-frame formats.
+    """
+    if is_tiff(path):
+        with tifffile.TiffFile(path) as tif:
+            return len(tif.pages)
+    if is_animated_format(path):
+        with Image.open(path) as image:
+            return getattr(image, 'n_frames', 1)
+    return 1
+
+
+def open_image_lazy(path, page=0):
+    """
+    Opens an image without necessarily reading its pixels into memory.
+
+    TIFF pages that are stored uncompressed and contiguously are memory-mapped
+    directly. Other TIFF pages are decoded once into an `.npy` file next to the
+    source and memory-mapped from there, so only the regions that later stages
+    slice are ever paged in. Other formats are decoded with OpenCV.
+
+    Args:
+        path (str): Path to the image.
+        page (int): TIFF page or GIF frame to open.
+
+    Returns:
+        numpy.ndarray: (H, W), (H, W, C) array in RGB(A) channel order, in the
+        file's own dtype (e.g. uint16 for 16-bit TIFFs). TIFF results are
+        read-only memory maps.
+    """
+    if is_tiff(path):
+        return _open_tiff_page(path, page)
+    return decode_image(path, page=page)
+
+
+def decode_image(path, page=0):
+    """
+    Decodes an image fully into memory without writing any cache files.
+
+    Args:
+        path (str): Path to the image.
+        page (int): TIFF page or GIF frame to decode.
+
+    Returns:
+        numpy.ndarray: (H, W) or (H, W, C) array in RGB(A) channel order and the
+        file's own dtype, laid out like `open_image_lazy`.
+    """
+    if is_tiff(path):
+        with tifffile.TiffFile(path) as tif:
+            if not 0 <= page < len(tif.pages):
+                raise ValueError(f"Page {page} out of range for {path} ({len(tif.pages)} pages)")
+            return _tiff_page_array(tif.pages[page])
+
+    if is_animated_format(path):
+        with Image.open(path) as image:
+            num_frames = getattr(image, 'n_frames', 1)
+            if not 0 <= page < num_frames:
+                raise ValueError(f"Page {page} out of range for {path} ({num_frames} pages)")
+            image.seek(page)
+            return np.asarray(image.convert('RGB'))
+
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError(f"Could not decode image: {path}")
+    if image.ndim == 3 and image.shape[2] == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    elif image.ndim == 3 and image.shape[2] == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA)
+    return image
+
+
+def iter_frames(path):
+    """
+    Yields the frames of a multi-frame image (multi-page TIFF or animated GIF)
+    one at a time, so only one decoded frame is held at once.
+
+    TIFF pages stored uncompressed and contiguously are memory-mapped, other
+    pages are decoded into memory; no cache files are written. GIF frames are
+    decoded in a single pass, each composited over the previous ones as a
+    viewer would show it. Single-frame formats yield their only frame.
+
+    Args:
+        path (str): Path to the image.
+
+    Yields:
+        numpy.ndarray: Each frame, laid out like `decode_image`.
+    """
+    if is_tiff(path):
+        with tifffile.TiffFile(path) as tif:
+            for page, tiff_page in enumerate(tif.pages):
+                if tiff_page.is_memmappable:
+                    image = tifffile.memmap(path, page=page, mode='r')
+                    if tiff_page.axes.startswith('S') and image.ndim == 3:
+                        image = np.moveaxis(image, 0, -1)
+                    yield image
+                else:
+                    yield _tiff_page_array(tiff_page)
+        return
+
+    if is_animated_format(path):
+        with Image.open(path) as image:
+            for frame in ImageSequence.Iterator(image):
+                yield np.asarray(frame.convert('RGB'))
+        return
+
+    yield decode_image(path)
+
+
+def _tiff_page_array(tiff_page):
+    """Decodes a TIFF page into memory, channel-last."""
+    image = tiff_page.asarray()
+    if tiff_page.axes.startswith('S') and image.ndim == 3:
+        image = np.moveaxis(image, 0, -1)
+    return image
+
+
+def _open_tiff_page(path, page):
+    with tifffile.TiffFile(path) as tif:
+        if not 0 <= page < len(tif.pages):
+            raise ValueError(f"Page {page} out of range for {path} ({len(tif.pages)} pages)")
+        tiff_page = tif.pages[page]
+        axes = tiff_page.axes
+        memmappable = tiff_page.is_memmappable
+
+        if memmappable:
+            image = tifffile.memmap(path, page=page, mode='r')
+        else:
+            cache_path = f"{path}.page{page}.npy"
+            if not os.path.exists(cache_path):
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=tiff_page.dtype, shape=tiff_page.shape)
+                tiff_page.asarray(out=out)
+                out.flush()
+                del out
+                os.replace(tmp_path, cache_path)
+            image = np.load(cache_path, mmap_mode='r')
+
+    # Planar (channel-first) pages become channel-last views
+    if axes.startswith('S') and image.ndim == 3:
+        image = np.moveaxis(image, 0, -1)
+    return image
+
+
+def to_rgb8(region):
+    """
+    Converts an image region of any supported layout and dtype to an in-memory
+    uint8 RGB array.
+
+    Args:
+        region (numpy.ndarray): (H, W) or (H, W, C) array, possibly memory-mapped.
+
+    Returns:
+        numpy.ndarray: Writable (H, W, 3) uint8 array.
+    """
+    if region.ndim == 2:
+        region = region[..., None]
+    if region.shape[2] in (1, 2):
+        # Grey (+ alpha): replicate the grey channel
+        region = np.repeat(region[..., :1], 3, axis=2)
+    else:
+        region = region[..., :3]
+
+    if region.dtype == np.uint8:
+        return np.array(region, dtype=np.uint8, copy=True)
+    if region.dtype == np.uint16:
+        return (region >> 8).astype(np.uint8)
+    if np.issubdtype(region.dtype, np.floating):
+        return (np.clip(region, 0, 1) * 255).astype(np.uint8)
+    if np.issubdtype(region.dtype, np.integer):
+        max_value = np.iinfo(region.dtype).max
+        return (np.clip(region, 0, None) * (255 / max_value)).astype(np.uint8)
+    raise ValueError(f"Unsupported image dtype: {region.dtype}")
+
+
+def load_mask(path):
+    """
+    Loads a mask as a 2D uint8 array; non-zero pixels are inside the mask.
+
+    Args:
+        path (str): Path to the mask image (PNG/JPEG/TIFF).
+
+    Returns:
+        numpy.ndarray: 2D uint8 mask.
+    """
+    if is_tiff(path):
+        mask = open_image_lazy(path)
+        if mask.ndim == 3:
+            mask = (mask[..., :3] > 0).any(axis=2)
+        return (mask > 0).astype(np.uint8) * 255
+
+    mask = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        raise ValueError(f"Could not decode mask: {path}")
+    return mask
+
+
+def load_label_mask(path):
+    """
+    Loads a label-valued mask: every distinct non-zero value marks one region.
+
+    Args:
+        path (str): Path to the mask image; colour masks use their first channel.
+
+    Returns:
+        numpy.ndarray: 2D integer array, 0 outside every region.
+    """
+    if is_tiff(path):
+        mask = open_image_lazy(path)
+    else:
+        mask = cv2.imread(path, cv2.IMREAD_ANYDEPTH | cv2.IMREAD_GRAYSCALE)
+        if mask is None:
+            raise ValueError(f"Could not decode mask: {path}")
+    if mask.ndim == 3:
+        mask = mask[..., 0]
+    return np.asarray(mask)
+
+
+def mask_bounding_box(mask, margin=0):
+    """
+    Returns the bounding box of the non-zero pixels in `mask`, grown by `margin`.
+
+    Args:
+        mask (numpy.ndarray): 2D mask.
+        margin (int): Pixels added on every side (clamped to the mask).
+
+    Returns:
+        tuple or None: (top, bottom, left, right) as slice bounds, or None if
+        the mask is empty.
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    height, width = mask.shape
+    return (
+        max(int(rows[0]) - margin, 0),
+        min(int(rows[-1]) + 1 + margin, height),
+        max(int(cols[0]) - margin, 0),
+        min(int(cols[-1]) + 1 + margin, width),
+    )
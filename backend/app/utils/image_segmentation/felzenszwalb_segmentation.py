@@ -1,41 +1,94 @@
 import numpy as np
 import pandas as pd
 import os
-from skimage import io, segmentation, color, transform
+from skimage import io, segmentation, transform
 from skimage.transform import resize
 from skimage.color import rgba2rgb
-# import matplotlib.pyplot as plt
+from skimage.util import img_as_ubyte
+from PIL import Image
 
-def reorder_segments_by_position(segments):
+def smallest_unsigned_dtype(max_value):
+    """
+    Returns the smallest unsigned integer dtype that can hold `max_value`.
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def reorder_segments_by_position(segments, compact=False):
     """
     Reorders segment labels such that the bottom-left segment is 1,
     proceeding left to right, bottom to top.
+
+    Centroids are computed with bincount and the relabelling is a single
+    lookup-table pass, so no per-segment boolean masks are built.
+
+    Args:
+        segments (numpy.ndarray): Label array; negative or NaN labels are unlabelled.
+        compact (bool): If True, return the labels in the smallest unsigned dtype
+            that fits them, with unlabelled pixels set to 0. Otherwise return
+            platform ints with unlabelled pixels left at -1.
+
+    Returns:
+        numpy.ndarray: Relabelled segments.
     """
-    segments = np.nan_to_num(segments, nan=-1).astype(int)
-    unique_ids = np.unique(segments)
-    centroids = []
+    if np.issubdtype(segments.dtype, np.floating):
+        segments = np.nan_to_num(segments, nan=-1).astype(int)
 
     height = segments.shape[0]
+    counts, y_sums, x_sums = _segment_centroid_sums(segments)
+
+    old_ids = np.flatnonzero(counts)
+    y_inverted = height - y_sums[old_ids] / counts[old_ids]
+    x_mean = x_sums[old_ids] / counts[old_ids]
+    order = np.lexsort((x_mean, y_inverted))
+
+    # lookup[0] is the value for unlabelled pixels, lookup[old_id + 1] the new id
+    dtype = smallest_unsigned_dtype(len(old_ids)) if compact else np.dtype(int)
+    lookup = np.zeros(counts.size + 1, dtype=dtype)
+    if not compact:
+        lookup[0] = -1
+    lookup[old_ids[order] + 1] = np.arange(1, len(old_ids) + 1, dtype=dtype)
+
+    if segments.size and segments.min() < 0:
+        reordered = lookup[np.maximum(segments, -1) + 1]
+        if not compact:
+            # Keep the original negative values of unlabelled pixels
+            np.copyto(reordered, segments, where=segments < 0)
+        return reordered
+    return lookup[1:][segments]
+
+
+def _segment_centroid_sums(segments, chunk_rows=512):
+    """
+    Pixel counts and row/column coordinate sums for every non-negative label,
+    accumulated over row chunks to keep temporaries small.
+    """
+    height, width = segments.shape
+    num_labels = max(int(segments.max()) + 1, 0) if segments.size else 0
 
-    for seg_id in unique_ids:
-        if seg_id < 0:
-            continue  # Skip unlabeled or NaN regions
-        coords = np.column_stack(np.where(segments == seg_id))
-        if coords.size == 0:
-            continue  # Skip empty segments
-        y_mean, x_mean = coords.mean(axis=0)
-        y_inverted = height - y_mean
-        centroids.append((seg_id, x_mean, y_inverted))
+    counts = np.zeros(num_labels, dtype=np.int64)
+    y_sums = np.zeros(num_labels, dtype=np.float64)
+    x_sums = np.zeros(num_labels, dtype=np.float64)
+    columns = np.arange(width, dtype=np.float64)
 
-    centroids_sorted = sorted(centroids, key=lambda x: (x[2], x[1]))
-    remap_dict = {old_id: new_id + 1 for new_id, (old_id, _, _) in enumerate(centroids_sorted)}
+    for start in range(0, height, chunk_rows):
+        stop = min(start + chunk_rows, height)
+        labels = segments[start:stop].ravel()
+        rows = np.repeat(np.arange(start, stop, dtype=np.float64), width)
+        cols = np.tile(columns, stop - start)
 
-    reordered_segments = np.copy(segments)
-    for old_id, new_id in remap_dict.items():
-        reordered_segments[segments == old_id] = new_id
+        valid = labels >= 0
+        if not valid.all():
+            labels, rows, cols = labels[valid], rows[valid], cols[valid]
 
-    return reordered_segments
+        counts += np.bincount(labels, minlength=num_labels)
+        y_sums += np.bincount(labels, weights=rows, minlength=num_labels)
+        x_sums += np.bincount(labels, weights=cols, minlength=num_labels)
 
+    return counts, y_sums, x_sums
 
 
 def find_optimal_felzenszwalb_params(input_image_path):
@@ -48,12 +101,24 @@ def find_optimal_felzenszwalb_params(input_image_path):
     Returns:
         tuple: Optimal scale, sigma, and min_size parameters for Felzenszwalb segmentation.
     """
-    # Load the input image
-    image = io.imread(input_image_path)
+    # Only the image dimensions are needed, so read the header instead of the pixels
+    with Image.open(input_image_path) as image:
+        width, height = image.size
+
+    return felzenszwalb_params_for_shape(height, width)
 
-    # Get the image dimensions
-    height, width, _ = image.shape
 
+def felzenszwalb_params_for_shape(height, width):
+    """
+    Determines the Felzenszwalb segmentation parameters for an image of the given size.
+
+    Args:
+        height (int): Image height in pixels.
+        width (int): Image width in pixels.
+
+    Returns:
+        tuple: Scale, sigma, and min_size parameters for Felzenszwalb segmentation.
+    """
     # Determine the scale parameter based on the image size
     scale = max(100, int(200 / np.sqrt(height * width)))
 
@@ -69,9 +134,9 @@ def find_optimal_felzenszwalb_params(input_image_path):
     return scale, sigma, min_size
 
 
-def felzenszwalb_segmentation(input_image_path, scale, sigma, min_size, mask_path=None):
+def felzenszwalb_segmentation(input_image_path, scale, sigma, min_size, mask_path=None, memory_lean=False):
     """
-    Applies Felzenszwalb segmentation on an input image, saves the segmented image with labels.
+    Applies Felzenszwalb segmentation on an input image.
     If mask_path is provided, only the masked region is segmented.
 
     Args:
@@ -80,58 +145,178 @@ def felzenszwalb_segmentation(input_image_path, scale, sigma, min_size, mask_pat
         sigma (float): Sigma value for Gaussian smoothing.
         min_size (int): Minimum component size.
         mask_path (str, optional): Path to the binary mask image.
+        memory_lean (bool): Keep pixels as uint8 (dropping alpha and rescaling
+            other dtypes instead of promoting to float32), mask in place and
+            return labels in the smallest sufficient unsigned dtype.
+
+    Returns:
+        tuple: Segments array and the image that was segmented (pixels outside
+        the mask set to the background colour). Per-segment mean colours are
+        computed from it by `compute_segment_statistics`.
+    """
+    image, mask = load_segmentation_inputs(input_image_path, mask_path)
+    return felzenszwalb_segment_array(image, mask, scale, sigma, min_size, memory_lean=memory_lean)
+
+
+def load_segmentation_inputs(input_image_path, mask_path):
+    """
+    Loads the image to segment and its mask as read by `felzenszwalb_segmentation`.
 
     Returns:
-        tuple: Segments array and segmented image.
+        tuple: (image array, boolean mask)
     """
     # Load the input image
     image = io.imread(input_image_path)
     mask = io.imread(mask_path)
     if len(mask.shape) == 3:
         mask = mask[..., 0]
-    mask = (mask > 0)
+    return image, (mask > 0)
+
+
+def felzenszwalb_segment_array(image, mask, scale, sigma, min_size, memory_lean=False):
+    """
+    Applies Felzenszwalb segmentation to an in-memory image; pixels outside
+    `mask` are painted with the background colour first.
+
+    Args:
+        image (numpy.ndarray): RGB image; modified in place when it is uint8.
+        mask (numpy.ndarray): Boolean mask of the region to segment; inverted
+            in place when `memory_lean` is set.
+        scale (float): Scale parameter for segmentation.
+        sigma (float): Sigma value for Gaussian smoothing.
+        min_size (int): Minimum component size.
+        memory_lean (bool): See `felzenszwalb_segmentation`.
+
+    Returns:
+        tuple: Segments array and the image that was segmented.
+    """
+    if memory_lean:
+        if image.ndim == 3 and image.shape[2] == 4:
+            image = image[..., :3]
+        if image.dtype != np.uint8:
+            image = img_as_ubyte(image)
 
     # Set pixels outside the mask to NaN (if float) or a unique color (if uint8)
     if image.dtype == np.uint8:
         unique_bg_color = np.array([255, 0, 255], dtype=np.uint8)
-        image[~mask] = unique_bg_color
+        outside = np.logical_not(mask, out=mask) if memory_lean else ~mask
+        image[outside] = unique_bg_color
     else:
         image = image.astype(np.float32)
         image[~mask] = np.nan
+    del mask
 
     # Perform Felzenszwalb segmentation
     segments = segmentation.felzenszwalb(image, scale=scale, sigma=sigma, min_size=min_size)
-    segments = reorder_segments_by_position(segments)
+    segments = reorder_segments_by_position(segments, compact=memory_lean)
 
-    # Create the segmented image
-    segmented_image = color.label2rgb(segments, image=image, kind='avg')
+    return segments, image
 
-    # Overlay segment IDs on the segmented image
-    # fig, ax = plt.subplots(figsize=(10, 8))
-    # ax.imshow(segmented_image)
 
-    # unique_ids = np.unique(segments)
-    # height = segments.shape[0]
+def compute_segment_statistics(segments, image, mask=None, chunk_rows=512):
+    """
+    Computes per-segment pixel counts, mean colours and centroids with a few
+    bincount passes instead of one boolean mask per segment.
 
-    # for seg_id in unique_ids:
-    #     coords = np.column_stack(np.where(segments == seg_id))
-    #     y_mean, x_mean = coords.mean(axis=0)
-    #     ax.text(x_mean, y_mean, str(seg_id), color='red', fontsize=8,
-    #             ha='center', va='center', bbox=dict(facecolor='white', alpha=0.5, edgecolor='none'))
+    Rows are processed in chunks so temporaries stay small on large images.
 
-    # ax.set_title("Segmented Image with Labels")
-    # ax.axis('off')
+    Args:
+        segments (numpy.ndarray): The segmentation result (non-negative labels)
+        image (numpy.ndarray): The image the statistics are taken from
+        mask (numpy.ndarray, optional): A mask; pixels > 0 are inside
+        chunk_rows (int): Number of rows accumulated per pass
 
-    # # Save the figure instead of the raw image
-    # output_path = "app/static/temp_uploads/segmentedImage.png"
-    # os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    # plt.savefig(output_path, bbox_inches='tight', pad_inches=0)
-    # plt.close()
+    Returns:
+        pandas.DataFrame: Indexed by 'Segment' with columns PixelCount,
+        InsideMaskCount, R, G, B (mean colour in the image's dtype, as
+        `label2rgb(kind='avg')` would paint it), CentroidX and CentroidY.
+        Only labels that occur in `segments` are included.
+    """
+    sums = segment_sums(segments, image, mask, chunk_rows=chunk_rows)
+    return statistics_from_sums(sums, image.dtype)
 
-    return segments, segmented_image
 
+def segment_sums(segments, image, mask=None, num_labels=None, origin=(0, 0), chunk_rows=512):
+    """
+    Accumulates the per-label sums behind `compute_segment_statistics`.
+
+    Sums are additive, so the statistics of a label map can be updated for an
+    edited window by subtracting the window's old sums and adding its new ones.
 
-def extract_segment_colors_and_areas(segments, image, mask=None):
+    Args:
+        segments (numpy.ndarray): Non-negative labels.
+        image (numpy.ndarray): The image the colours are taken from.
+        mask (numpy.ndarray, optional): A mask; pixels > 0 are inside. Without
+            one every pixel counts as inside.
+        num_labels (int, optional): Length of the result; defaults to the
+            largest label + 1.
+        origin (tuple): (row, column) of `segments[0, 0]` in the full label
+            map, so windows add up to the centroids of the whole map.
+        chunk_rows (int): Number of rows accumulated per pass.
+
+    Returns:
+        numpy.ndarray: (7, num_labels) float64 array; the rows are the pixel
+        count, inside-mask count, R, G and B sums, row sum and column sum.
+    """
+    height, width = segments.shape
+    if num_labels is None:
+        num_labels = int(segments.max()) + 1 if segments.size else 1
+
+    sums = np.zeros((7, num_labels), dtype=np.float64)
+    columns = np.arange(origin[1], origin[1] + width, dtype=np.float64)
+
+    for start in range(0, height, chunk_rows):
+        stop = min(start + chunk_rows, height)
+        labels = segments[start:stop].ravel()
+
+        sums[0] += np.bincount(labels, minlength=num_labels)
+        if mask is not None:
+            sums[1] += np.bincount(labels[(mask[start:stop] > 0).ravel()], minlength=num_labels)
+
+        chunk = image[start:stop]
+        for channel in range(3):
+            sums[2 + channel] += np.bincount(labels, weights=chunk[..., channel].ravel(), minlength=num_labels)
+
+        rows = np.arange(origin[0] + start, origin[0] + stop, dtype=np.float64)
+        sums[5] += np.bincount(labels, weights=np.repeat(rows, width), minlength=num_labels)
+        sums[6] += np.bincount(labels, weights=np.tile(columns, stop - start), minlength=num_labels)
+
+    if mask is None:
+        sums[1] = sums[0]
+    return sums
+
+
+def statistics_from_sums(sums, dtype):
+    """
+    Turns the result of `segment_sums` into the table of `compute_segment_statistics`.
+
+    Args:
+        sums (numpy.ndarray): (7, num_labels) per-label sums.
+        dtype (numpy.dtype): Dtype of the image the colours were summed from;
+            mean colours of integer images are truncated to it.
+
+    Returns:
+        pandas.DataFrame: See `compute_segment_statistics`.
+    """
+    counts = sums[0].astype(np.int64)
+    present = np.flatnonzero(counts)
+    n = sums[0, present]
+    means = sums[2:5, present] / n
+    if np.issubdtype(dtype, np.integer):
+        means = means.astype(dtype)
+
+    return pd.DataFrame({
+        'PixelCount': counts[present],
+        'InsideMaskCount': sums[1, present].astype(np.int64),
+        'R': means[0],
+        'G': means[1],
+        'B': means[2],
+        'CentroidX': sums[6, present] / n,
+        'CentroidY': sums[5, present] / n,
+    }, index=pd.Index(present, name='Segment'))
+
+
+def extract_segment_colors_and_areas(segments, image, mask=None, segment_stats=None):
     """
     Extracts colors and areas for each segment in the image.
     
@@ -139,102 +324,146 @@ def extract_segment_colors_and_areas(segments, image, mask=None):
         segments (numpy.ndarray): The segmentation result
         image (numpy.ndarray): The original image
         mask (numpy.ndarray, optional): A mask to filter segments
+        segment_stats (pandas.DataFrame, optional): Precomputed result of
+            `compute_segment_statistics` for the same inputs
         
     Returns:
         dict: Dictionary containing segment colors and areas
     """
-    segment_data = {}
-    segment_ids = np.unique(segments)
+    if segment_stats is None:
+        segment_stats = compute_segment_statistics(segments, image, mask)
+
     total_pixels = np.sum(mask > 0) if mask is not None else image.shape[0] * image.shape[1]
+    inside_mask_count = segment_stats['InsideMaskCount'].to_numpy() if mask is not None else None
+    selected = select_segments(
+        segment_stats, total_pixels, inside_mask_count=inside_mask_count,
+        float_colors=image.dtype == np.float32 or image.dtype == np.float64,
+    )
+
+    # Store both color and area information
+    return {
+        segment: {'R': r, 'G': g, 'B': b, 'PixelCount': pixel_count, 'PercentageArea': percentage_area}
+        for segment, r, g, b, pixel_count, percentage_area in zip(
+            selected.index, selected['R'].to_numpy(), selected['G'].to_numpy(), selected['B'].to_numpy(),
+            selected['PixelCount'].to_numpy(), selected['PercentageArea'].to_numpy(),
+        )
+    }
+
+
+def select_segments(segment_stats, total_pixels, inside_mask_count=None, float_colors=False):
+    """
+    Picks the segments that belong to a masked region: segments at least 90%
+    inside the region whose colour is not the magenta background.
+
+    Args:
+        segment_stats (pandas.DataFrame): Result of `compute_segment_statistics`.
+        total_pixels (int): Pixels in the region; areas are percentages of it.
+        inside_mask_count (numpy.ndarray, optional): Pixels of each segment
+            (in `segment_stats` order) inside the region; None keeps every segment.
+        float_colors (bool): True if the mean colours are floats in [0, 1].
+
+    Returns:
+        pandas.DataFrame: Indexed by 'Segment' with columns R, G, B, PixelCount
+        and PercentageArea.
+    """
     bg_color = np.array([255, 0, 255])  # Magenta background
-    
-    for seg_id in segment_ids:
-        if seg_id < 0:  # Skip invalid segments if any
-            continue
 
-        # Create a mask for each segment
-        segment_mask = segments == seg_id
-        
-        # If a mask is provided, only consider pixels that are in both the segment and the mask
-        if mask is not None:
-            mask_bool = mask > 0
-            if not np.any(np.logical_and(segment_mask, mask_bool)):
-                continue  # No overlap with mask
-            # Only keep if most pixels are inside the mask
-            inside_mask_count = np.sum(np.logical_and(segment_mask, mask_bool))
-            total_segment_count = np.sum(segment_mask)
-            if inside_mask_count / total_segment_count < 0.9:
-                continue  # Skip segments mostly outside the mask
-        
-        # Count the number of pixels in the segment (area)
-        pixel_count = np.sum(segment_mask)
-        
-        # Skip segments with no pixels in the masked region
-        if pixel_count == 0:
-            continue
-        
-        # Calculate percentage of total area
-        percentage_area = (pixel_count / total_pixels) * 100
-        
-        # Compute the mean color of the segment
-        mean_color = np.mean(image[segment_mask], axis=0)
-        
-        # Check for NaN in mean_color
-        if np.isnan(mean_color).any():
-            continue
-        
-        # Scale the color values to 0-255 range
-        if image.dtype == np.float32 or image.dtype == np.float64:
-            mean_color = np.clip(mean_color * 255, 0, 255).astype(int)
+    pixel_count = segment_stats['PixelCount'].to_numpy()
+    keep = pixel_count > 0
+
+    # If a mask is provided, only keep segments that are mostly inside it
+    if inside_mask_count is not None:
+        keep &= inside_mask_count > 0
+        keep &= inside_mask_count / np.maximum(pixel_count, 1) >= 0.9
+
+    mean_color = segment_stats[['R', 'G', 'B']].to_numpy()
+
+    # Skip segments whose colour could not be computed
+    keep &= ~np.isnan(mean_color.astype(np.float64)).any(axis=1)
+
+    # Skip segments that are just background (magenta) or nearly magenta
+    keep &= ~np.isclose(mean_color, bg_color, atol=10).all(axis=1)
+
+    # Scale the color values to 0-255 range
+    if float_colors:
+        mean_color = np.clip(np.nan_to_num(mean_color) * 255, 0, 255).astype(int)
+    else:
+        mean_color = np.clip(mean_color, 0, 255).astype(int)
+
+    # Calculate percentage of total area
+    percentage_area = (pixel_count / total_pixels) * 100
+
+    return pd.DataFrame({
+        'R': mean_color[keep, 0],
+        'G': mean_color[keep, 1],
+        'B': mean_color[keep, 2],
+        'PixelCount': pixel_count[keep],
+        'PercentageArea': percentage_area[keep],
+    }, index=pd.Index(segment_stats.index[keep], name='Segment'))
+
+
+def region_segment_counts(segments, regions, num_regions, chunk_rows=512):
+    """
+    Counts the pixels of every segment inside every region in one 2D
+    (region x segment) bincount.
+
+    Args:
+        segments (numpy.ndarray): Non-negative segment labels.
+        regions (numpy.ndarray): Region index of each pixel, 0 for none and
+            1..num_regions for the regions; or a (num_regions, H, W) boolean
+            stack when regions may overlap (one bincount per region then).
+        num_regions (int): Number of regions.
+        chunk_rows (int): Number of rows accumulated per pass.
+
+    Returns:
+        numpy.ndarray: (num_regions, max label + 1) int64 matrix.
+    """
+    height = segments.shape[0]
+    num_labels = int(segments.max()) + 1 if segments.size else 1
+    counts = np.zeros((num_regions + 1) * num_labels, dtype=np.int64)
+
+    for start in range(0, height, chunk_rows):
+        stop = min(start + chunk_rows, height)
+        labels = segments[start:stop].ravel().astype(np.int64)
+        if regions.ndim == 2:
+            codes = regions[start:stop].ravel().astype(np.int64) * num_labels + labels
+            counts += np.bincount(codes, minlength=counts.size)
         else:
-            mean_color = np.clip(mean_color, 0, 255).astype(int)
-        
-        # Skip segments that are just background (magenta) or nearly magenta
-        segment_pixels = image[segment_mask]
-        try:
-            if segment_pixels.size == 0:
-                continue
-            if segment_pixels.ndim == 1:
-                # Only one pixel in the segment
-                if segment_pixels.shape[0] == 3 and np.allclose(segment_pixels, bg_color, atol=10):
-                    continue
-            elif segment_pixels.ndim == 2:
-                if np.all(np.isclose(segment_pixels, bg_color, atol=10).all(axis=1)):
-                    continue
-            else:
-                continue
-        except Exception:
-            continue
-        
-        # Store both color and area information
-        segment_data[seg_id] = {
-            'R': mean_color[0],
-            'G': mean_color[1],
-            'B': mean_color[2],
-            'PixelCount': pixel_count,
-            'PercentageArea': percentage_area,
-        }
+            for region in range(num_regions):
+                inside = labels[regions[region, start:stop].ravel()]
+                counts[(region + 1) * num_labels:(region + 2) * num_labels] += np.bincount(inside, minlength=num_labels)
 
-    return segment_data
+    # Row 0 holds the pixels outside every region
+    return counts.reshape(num_regions + 1, num_labels)[1:]
 
 
-def export_segment_data_to_csv(segment_data, output_csv_path):
+def segment_data_to_frame(segment_data):
     """
-    Exports the segment colors and areas to a CSV file.
+    Converts the output of `extract_segment_colors_and_areas` to a table.
 
     Args:
         segment_data (dict): Dictionary containing segment colors and areas.
-        output_csv_path (str): Path to save the CSV file.
+
+    Returns:
+        pandas.DataFrame: Indexed by 'Segment' with columns R, G, B,
+        PixelCount and PercentageArea.
     """
     # Convert the nested dictionary to a DataFrame
     df = pd.DataFrame.from_dict(segment_data, orient='index')
     df.index.name = 'Segment'
-    
+
     # Reorder columns for better readability
     column_order = ['R', 'G', 'B', 'PixelCount', 'PercentageArea']
-    df = df[column_order]
-    
-    # Export the DataFrame to CSV
-    df.to_csv(output_csv_path)
+    return df.reindex(columns=column_order)
+
 
+def export_segment_data_to_csv(segment_data, output_csv_path):
+    """
+    Exports the segment colors and areas to a CSV file.
 
+    Args:
+        segment_data (dict): Dictionary containing segment colors and areas.
+        output_csv_path (str): Path to save the CSV file.
+    """
+    # Export the DataFrame to CSV
+    segment_data_to_frame(segment_data).to_csv(output_csv_path)
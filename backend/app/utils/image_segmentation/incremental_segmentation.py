@@ -0,0 +1,133 @@
+import numpy as np
+from app.utils.image_io import mask_bounding_box
+from app.utils.image_segmentation.felzenszwalb_segmentation import (
+    felzenszwalb_segment_array, segment_sums, smallest_unsigned_dtype
+)
+
+# Pixels around the edited pixels that are segmented again
+EDIT_MARGIN = 16
+
+# Extra pixels read around the re-segmented window for the Gaussian smoothing
+CONTEXT_MARGIN = 8
+
+# Above this share of the frame, re-segmenting the edit is not worth it
+MAX_EDIT_FRACTION = 0.5
+
+BACKGROUND_COLOR = np.array([255, 0, 255], dtype=np.uint8)
+
+
+def segmentation_input(frame, mask):
+    """
+    Returns what `felzenszwalb_segment_array` segments for a uint8 frame: the
+    frame with the pixels outside `mask` painted with the background colour.
+    """
+    image = frame.copy()
+    image[mask == 0] = BACKGROUND_COLOR
+    return image
+
+
+def resegment_mask_edit(labels, sums, frame, old_mask, new_mask, params, memory_lean=True,
+                        margin=EDIT_MARGIN, max_fraction=MAX_EDIT_FRACTION):
+    """
+    Updates a Felzenszwalb segmentation after its mask was edited, segmenting
+    only around the edited pixels instead of the whole frame.
+
+    The window re-segmented is the bounding box of the changed pixels plus
+    `margin`, together with every segment inside the old mask that reaches
+    into it, so segments of the region are replaced whole. Pixels of the
+    window that stay inside the mask but belong to no replaced segment are
+    treated as background while segmenting, which keeps the new segments
+    from crossing into the untouched ones. Segments away from the edit keep
+    their extent; segments that reach into the window from outside the masks
+    (background) are cut at its edge.
+
+    The per-segment sums are updated by subtracting the window's old
+    contribution and adding the new one, and the labels are renumbered
+    bottom-left first, as `reorder_segments_by_position` numbers them.
+
+    Args:
+        labels (numpy.ndarray): Labels of the frame, 1..N.
+        sums (numpy.ndarray): `segment_sums` of `labels` over the frame's
+            segmentation input and `old_mask`.
+        frame (numpy.ndarray): (H, W, 3) uint8 frame, unmasked.
+        old_mask (numpy.ndarray): Mask `labels` were computed with; non-zero is inside.
+        new_mask (numpy.ndarray): Edited mask of the same shape.
+        params (tuple): Felzenszwalb (scale, sigma, min_size) of the frame.
+        memory_lean (bool): See `felzenszwalb_segment_array`; compact labels
+            are kept compact.
+        margin (int): Pixels segmented again around the changed pixels.
+        max_fraction (float): Largest share of the frame worth re-segmenting.
+
+    Returns:
+        tuple or None: (labels, sums) of the edited segmentation, or None if
+        the edit touches too much of the frame to be worth doing in place.
+    """
+    old_inside = old_mask > 0
+    new_inside = new_mask > 0
+    dirty_bbox = mask_bounding_box(old_inside != new_inside, margin=margin)
+    if dirty_bbox is None:
+        return labels, sums
+    top, bottom, left, right = dirty_bbox
+
+    # Segments of the region that reach into the window are replaced whole
+    touched = np.unique(labels[top:bottom, left:right])
+    touched = touched[sums[1, touched] > 0]
+    replaced = np.zeros(sums.shape[1], dtype=bool)
+    replaced[touched] = True
+    edited = replaced[labels]
+    edited[top:bottom, left:right] = True
+
+    height, width = labels.shape
+    top, bottom, left, right = mask_bounding_box(edited, margin=CONTEXT_MARGIN)
+    if (bottom - top) * (right - left) > max_fraction * height * width:
+        return None
+    origin = (top, left)
+    window = (slice(top, bottom), slice(left, right))
+    edited = edited[window]
+
+    # Take the window's old contribution out of the sums
+    old_labels = np.where(edited, labels[window], 0)
+    sums = sums - segment_sums(
+        old_labels, segmentation_input(frame[window], old_mask[window]), old_mask[window],
+        num_labels=sums.shape[1], origin=origin,
+    )
+    sums[:, 0] = 0
+
+    # Segment the edited pixels only; the rest of the window is background
+    scale, sigma, min_size = params
+    window_labels, window_input = felzenszwalb_segment_array(
+        frame[window].copy(), edited & new_inside[window], scale, sigma, min_size, memory_lean=memory_lean
+    )
+    window_labels = np.where(edited, window_labels, 0).astype(np.int64)
+    new_sums = segment_sums(window_labels, window_input, new_mask[window], origin=origin)
+
+    # New segments are appended after the old ones, then everything is renumbered
+    offset = sums.shape[1] - 1
+    sums = np.concatenate([sums, new_sums[:, 1:]], axis=1)
+    lookup, sums = _position_order(sums, height)
+    merged = lookup[labels]
+    merged[window][edited] = lookup[window_labels[edited] + offset]
+    if not memory_lean:
+        merged = merged.astype(labels.dtype, copy=False)
+    return merged, sums
+
+
+def _position_order(sums, height):
+    """
+    Numbers the labels present in `sums` bottom-left first from their
+    centroids, like `reorder_segments_by_position`.
+
+    Returns:
+        tuple: (old label -> new label lookup, sums reordered to the new labels)
+    """
+    present = np.flatnonzero(sums[0])
+    y_inverted = height - sums[5, present] / sums[0, present]
+    x_mean = sums[6, present] / sums[0, present]
+    order = present[np.lexsort((x_mean, y_inverted))]
+
+    lookup = np.zeros(sums.shape[1], dtype=smallest_unsigned_dtype(order.size))
+    lookup[order] = np.arange(1, order.size + 1)
+
+    reordered = np.zeros((sums.shape[0], order.size + 1), dtype=np.float64)
+    reordered[:, 1:] = sums[:, order]
+    return lookup, reordered
@@ -0,0 +1,107 @@
+import os
+import threading
+import cv2
+import numpy as np
+
+
+def build_palette(segment_stats, num_labels, background=(0, 0, 0)):
+    """
+    Builds a label -> BGR colour lookup table from the per-segment statistics.
+
+    Args:
+        segment_stats (pandas.DataFrame): Output of `compute_segment_statistics`
+            (or a subset of its rows); uses the R, G, B columns.
+        num_labels (int): Size of the palette (largest label + 1).
+        background (tuple): RGB colour for labels missing from `segment_stats`.
+
+    Returns:
+        numpy.ndarray: (num_labels, 3) uint8 palette in BGR order.
+    """
+    palette = np.empty((num_labels, 3), dtype=np.uint8)
+    palette[:] = background[::-1]
+    ids = segment_stats.index.to_numpy()
+    ids = ids[(ids >= 0) & (ids < num_labels)]
+    colors = segment_stats.loc[ids, ['B', 'G', 'R']].to_numpy(dtype=np.float64)
+    palette[ids] = np.clip(colors, 0, 255).astype(np.uint8)
+    return palette
+
+
+def downsample_labels(segments, max_size):
+    """
+    Nearest-neighbour downsampling of a label raster so its longest side is at
+    most `max_size` pixels.
+
+    Args:
+        segments (numpy.ndarray): 2D label array.
+        max_size (int): Maximum width/height of the result.
+
+    Returns:
+        tuple: (downsampled labels, scale factor applied).
+    """
+    height, width = segments.shape
+    scale = min(1.0, max_size / max(height, width))
+    if scale >= 1.0:
+        return segments, 1.0
+
+    out_height = max(1, int(round(height * scale)))
+    out_width = max(1, int(round(width * scale)))
+    rows = (np.arange(out_height) * (height / out_height)).astype(np.intp)
+    cols = (np.arange(out_width) * (width / out_width)).astype(np.intp)
+    return segments[rows[:, None], cols[None, :]], scale
+
+
+def render_segment_preview(segments, segment_stats, output_path, max_size=1024,
+                           draw_labels=True, background=(0, 0, 0), label_segments=None):
+    """
+    Renders the segmented preview: every segment painted with its mean colour
+    and, optionally, its ID drawn at its centroid.
+
+    Colours come from a palette lookup on a downsampled label raster, so the
+    cost depends on the preview size rather than on the image or segment count.
+
+    Args:
+        segments (numpy.ndarray): 2D label array.
+        segment_stats (pandas.DataFrame): Per-segment statistics with R, G, B,
+            CentroidX and CentroidY columns, indexed by segment id. Segments not
+            in the table are painted with `background`.
+        output_path (str): Destination file; the extension selects the format
+            (.png or .webp).
+        max_size (int): Longest side of the preview in pixels.
+        draw_labels (bool): Whether to draw segment IDs.
+        background (tuple): RGB colour for unlisted segments.
+        label_segments (iterable, optional): Segment ids to label; defaults to
+            every segment in `segment_stats`.
+
+    Returns:
+        str: Path to the written preview.
+    """
+    num_labels = int(segments.max()) + 1 if segments.size else 1
+    palette = build_palette(segment_stats, num_labels, background)
+
+    small, scale = downsample_labels(segments, max_size)
+    preview = palette[np.clip(small, 0, num_labels - 1)]
+
+    if draw_labels:
+        ids = segment_stats.index if label_segments is None else list(label_segments)
+        centroids = segment_stats.loc[ids, ['CentroidX', 'CentroidY']].to_numpy() * scale
+        font_scale = max(0.3, min(preview.shape[:2]) / 1500)
+        for seg_id, (x, y) in zip(ids, centroids):
+            text = str(seg_id)
+            (text_w, text_h), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, font_scale, 1)
+            origin = (int(x - text_w / 2), int(y + text_h / 2))
+            cv2.putText(preview, text, origin, cv2.FONT_HERSHEY_SIMPLEX, font_scale, (255, 255, 255), 3, cv2.LINE_AA)
+            cv2.putText(preview, text, origin, cv2.FONT_HERSHEY_SIMPLEX, font_scale, (0, 0, 255), 1, cv2.LINE_AA)
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    root, extension = os.path.splitext(output_path)
+    if extension.lower() == '.webp':
+        params = [cv2.IMWRITE_WEBP_QUALITY, 90]
+    else:
+        params = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+    # Written beside and renamed, so the preview is never served half-written
+    tmp_path = f"{root}.{os.getpid()}.{threading.get_ident()}.tmp{extension}"
+    if not cv2.imwrite(tmp_path, preview, params):
+        raise ValueError(f'Could not write preview: {output_path}')
+    os.replace(tmp_path, output_path)
+
+    return output_path
@@ -0,0 +1,155 @@
+import os
+import math
+import cv2
+import numpy as np
+from app.utils.export_results import TABLE_FILENAME, load_segment_table, smallest_label_dtype
+from app.utils.value_raster import VALUES_FILENAME
+
+TILE_LABELS_FILENAME = 'tile_labels.npy'
+
+# Layers a pyramid serves: segments in their mean colour, or values colourised
+TILE_LAYERS = ('segments', 'values')
+
+
+def write_tile_labels(segments, output_dir, mask=None):
+    """
+    Writes the label raster uncompressed, so tiles can be cut from it
+    memory-mapped. Labels are stored shifted by one in the smallest dtype
+    that fits, with 0 for unlabelled pixels and those outside `mask`.
+
+    Returns:
+        str: Path of the raster.
+    """
+    max_label = int(segments.max()) if segments.size else 0
+    labels = np.clip(segments, -1, None)
+    labels += 1
+    labels = labels.astype(smallest_label_dtype(max_label + 1), copy=False)
+    if mask is not None:
+        labels[np.asarray(mask) == 0] = 0
+    output_path = os.path.join(output_dir, TILE_LABELS_FILENAME)
+    tmp_path = f"{output_path}.tmp.npy"
+    np.save(tmp_path, labels)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def pyramid_levels(height, width):
+    """
+    Number of levels of a Deep Zoom pyramid: level 0 is 1x1 pixel and every
+    level doubles the size up to the full image at the last one.
+    """
+    return int(math.ceil(math.log2(max(height, width, 1)))) + 1
+
+
+def level_shape(height, width, level, levels):
+    """Returns the (height, width) of a pyramid level."""
+    factor = 2 ** (levels - 1 - level)
+    return int(math.ceil(height / factor)), int(math.ceil(width / factor))
+
+
+def _tile_indices(shape, level, levels, x, y, tile_size):
+    """
+    Rows and columns of the full-resolution raster that a tile samples, by
+    nearest neighbour at the centre of each tile pixel; slices at full size.
+
+    Raises:
+        ValueError: If the level or tile does not exist.
+    """
+    if not 0 <= level < levels:
+        raise ValueError(f'Level {level} out of range (0-{levels - 1})')
+    height, width = shape
+    level_height, level_width = level_shape(height, width, level, levels)
+    top, left = y * tile_size, x * tile_size
+    if not (0 <= top < level_height and 0 <= left < level_width):
+        raise ValueError(f'Tile {x},{y} out of range at level {level}')
+    bottom, right = min(top + tile_size, level_height), min(left + tile_size, level_width)
+
+    factor = 2 ** (levels - 1 - level)
+    if factor == 1:
+        return slice(top, bottom), slice(left, right)
+    rows = np.minimum(((np.arange(top, bottom) + 0.5) * factor).astype(np.intp), height - 1)
+    cols = np.minimum(((np.arange(left, right) + 0.5) * factor).astype(np.intp), width - 1)
+    return rows[:, None], cols[None, :]
+
+
+class TilePyramid:
+    """
+    Deep Zoom tile pyramid of one analysis's segmented crop, cut lazily from
+    the memory-mapped label and value rasters in its export directory. Only
+    the pixels a tile samples are read, so a tile costs the same at every level.
+    """
+
+    def __init__(self, directory, tile_size=256):
+        self.labels = np.load(os.path.join(directory, TILE_LABELS_FILENAME), mmap_mode='r')
+        self.tile_size = tile_size
+        self.height, self.width = self.labels.shape
+        self.levels = pyramid_levels(self.height, self.width)
+        self._directory = directory
+        self._table = None
+
+    def _segment_table(self):
+        if self._table is None:
+            self._table = load_segment_table(os.path.join(self._directory, TABLE_FILENAME))
+        return self._table
+
+    def value_range(self):
+        """(lowest, highest) assigned value, the range the 'values' layer spans."""
+        values = self._segment_table()['Assigned_Value'].to_numpy(dtype=np.float64)
+        values = values[np.isfinite(values)]
+        if not values.size:
+            return 0.0, 0.0
+        return float(values.min()), float(values.max())
+
+    def describe(self):
+        """JSON-serialisable layout of the pyramid for the client."""
+        return {
+            'width': self.width,
+            'height': self.height,
+            'tileSize': self.tile_size,
+            'levels': self.levels,
+            'layers': list(TILE_LAYERS),
+            'valueRange': list(self.value_range()),
+        }
+
+    def _segment_palette(self):
+        # BGRA by shifted label; unanalysed segments stay transparent
+        table = self._segment_table()
+        ids = table['Segment'].to_numpy(dtype=np.int64) + 1
+        palette = np.zeros((max(int(ids.max(initial=0)), 0) + 1, 4), dtype=np.uint8)
+        palette[ids, :3] = np.clip(table[['B', 'G', 'R']].to_numpy(dtype=np.float64), 0, 255).astype(np.uint8)
+        palette[ids, 3] = 255
+        return palette
+
+    def render(self, layer, level, x, y):
+        """
+        Renders one tile as a BGRA array.
+
+        Raises:
+            ValueError: If the layer, level or tile does not exist.
+        """
+        if layer not in TILE_LAYERS:
+            raise ValueError(f"Unknown layer: {layer}; expected one of {', '.join(TILE_LAYERS)}")
+        index = _tile_indices(self.labels.shape, level, self.levels, x, y, self.tile_size)
+
+        if layer == 'segments':
+            palette = self._segment_palette()
+            labels = np.asarray(self.labels[index])
+            return palette[np.where(labels < len(palette), labels, 0)]
+
+        values = np.asarray(np.load(os.path.join(self._directory, VALUES_FILENAME), mmap_mode='r')[index])
+        low, high = self.value_range()
+        valid = np.isfinite(values)
+        scaled = np.zeros(values.shape, dtype=np.uint8)
+        if high > low:
+            scaled[valid] = np.clip((values[valid] - low) / (high - low) * 255, 0, 255).astype(np.uint8)
+        tile = cv2.cvtColor(cv2.applyColorMap(scaled, cv2.COLORMAP_VIRIDIS), cv2.COLOR_BGR2BGRA)
+        tile[..., 3] = valid * np.uint8(255)
+        return tile
+
+
+def encode_tile(tile):
+    """Encodes a tile as PNG bytes, favouring speed over size."""
+    ok, encoded = cv2.imencode('.png', tile, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    if not ok:
+        raise ValueError('Could not encode tile')
+    return encoded.tobytes()
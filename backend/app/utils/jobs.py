@@ -0,0 +1,168 @@
+import time
+import select
+import socket
+import threading
+from collections import OrderedDict
+
+
+class JobCancelled(Exception):
+    """Raised when a job was cancelled or ran out of time; `reason` says which."""
+
+    def __init__(self, reason, timed_out=False):
+        super().__init__(reason)
+        self.reason = reason
+        self.timed_out = timed_out
+
+
+class Job:
+    """
+    An analysis in progress. Long-running stages call `check` (or poll
+    `stop_reason`) and give up as soon as the job is cancelled, its client
+    disconnected or its time limit passed.
+    """
+
+    def __init__(self, job_id, session_id=None, time_limit=None, is_disconnected=None):
+        self.id = job_id
+        self.session_id = session_id
+        self.started_at = time.monotonic()
+        self.deadline = self.started_at + time_limit if time_limit else None
+        # Execution plan of its segmentation and when that started, once planned
+        self.plan = None
+        self.plan_started = None
+        self._is_disconnected = is_disconnected
+        self._reason = None
+        self._lock = threading.Lock()
+
+    def cancel(self, reason='Cancelled'):
+        """Marks the job cancelled; the first reason given is kept."""
+        with self._lock:
+            if self._reason is None:
+                self._reason = reason
+
+    def stop_reason(self):
+        """
+        Returns why the job should stop, or None if it should carry on.
+
+        Returns:
+            tuple or None: (reason, timed_out)
+        """
+        with self._lock:
+            if self._reason is not None:
+                return self._reason, False
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            return f'Analysis exceeded its time limit of {self.deadline - self.started_at:.0f} s', True
+        if self._is_disconnected is not None and self._is_disconnected():
+            self.cancel('Client disconnected')
+            return 'Client disconnected', False
+        return None
+
+    def check(self):
+        """
+        Raises:
+            JobCancelled: If the job should stop.
+        """
+        stop = self.stop_reason()
+        if stop is not None:
+            raise JobCancelled(*stop)
+
+
+class JobRegistry:
+    """
+    Tracks the analyses in progress so they can be cancelled by id, and so a
+    newer request of a session cancels the one it supersedes. Jobs that run
+    on after their request has been answered (progressive results) leave an
+    outcome the client collects later; the last `max_outcomes` are kept.
+    """
+
+    def __init__(self, time_limit=None, max_outcomes=64):
+        self.time_limit = time_limit
+        self.max_outcomes = max_outcomes
+        self._jobs = {}
+        self._by_session = {}
+        self._outcomes = OrderedDict()  # job id -> (HTTP status, response body, headers)
+        self._lock = threading.Lock()
+
+    def start(self, job_id, session_id=None, is_disconnected=None):
+        """
+        Registers a job, cancelling the running job of the same session.
+
+        Returns:
+            Job: The new job.
+        """
+        job = Job(job_id, session_id=session_id, time_limit=self.time_limit, is_disconnected=is_disconnected)
+        with self._lock:
+            previous = self._jobs.get(job_id)
+            if previous is not None:
+                previous.cancel('Superseded by a newer request with the same job id')
+            self._jobs[job_id] = job
+            if session_id:
+                superseded = self._by_session.get(session_id)
+                if superseded is not None:
+                    superseded.cancel('Superseded by a newer request of the session')
+                self._by_session[session_id] = job
+        return job
+
+    def finish(self, job, outcome=None):
+        """
+        Forgets a job that has ended, keeping its `outcome` (HTTP status,
+        response body, dict of response headers) for `outcome` if given.
+        """
+        with self._lock:
+            if self._jobs.get(job.id) is job:
+                del self._jobs[job.id]
+            if job.session_id and self._by_session.get(job.session_id) is job:
+                del self._by_session[job.session_id]
+            if outcome is not None:
+                self._outcomes.pop(job.id, None)
+                self._outcomes[job.id] = outcome
+                while len(self._outcomes) > self.max_outcomes:
+                    self._outcomes.popitem(last=False)
+
+    def outcome(self, job_id):
+        """
+        Returns the (HTTP status, response body, headers) a finished job left, or None.
+        """
+        with self._lock:
+            return self._outcomes.get(job_id)
+
+    def cancel(self, job_id, reason='Cancelled by the client'):
+        """
+        Cancels a running job.
+
+        Returns:
+            bool: False if no job with that id is running.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return False
+        job.cancel(reason)
+        return True
+
+    def running(self):
+        """Returns the ids of the jobs in progress."""
+        with self._lock:
+            return list(self._jobs)
+
+
+def client_disconnected(environ):
+    """
+    Returns True if the client of a WSGI request has closed its connection.
+
+    The request body has been read by then, so a readable socket with
+    nothing to read means the peer hung up. Servers that do not expose the
+    socket (only the Werkzeug server does, as 'werkzeug.socket') are assumed
+    connected.
+    """
+    sock = environ.get('werkzeug.socket')
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b''
+    except ConnectionError:
+        return True
+    except (OSError, ValueError):
+        return False
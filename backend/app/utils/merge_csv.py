@@ -26,61 +26,166 @@ def merge_csv_files(file1, file2, output_path, k=3, use_inverse_distance=True):
     df1 = pd.read_csv(file1)  # Reference colors with assigned values
     df2 = pd.read_csv(file2)  # Colors that need values assigned
 
+    merged_df = assign_values_by_color(df1, df2, k=k, use_inverse_distance=use_inverse_distance)
+
+    # Ensure the output directory exists
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    # Save the merged CSV file
+    merged_df.to_csv(output_path, index=False)
+
+    return output_path
+
+
+def plan_color_matching(reference_df, segment_df, k=3, use_inverse_distance=True):
+    """
+    Works out, for every segment, where its value comes from: the band with
+    exactly its RGB colour, or its k nearest bands in LAB space and their
+    distances. The plan depends only on colours, so it can be applied to any
+    number of value assignments of the same colour map with
+    `apply_color_matching`.
+
+    Args:
+        reference_df (pandas.DataFrame): Colour map table with R, G and B.
+        segment_df (pandas.DataFrame): Segment table with R, G, B, PixelCount and
+            PercentageArea; 'Segment' must be a column, not the index.
+        k (int): Number of nearest neighbors to use for interpolation (default: 3).
+        use_inverse_distance (bool): Whether to use inverse distance weighting (default: True).
+
+    Returns:
+        dict: The matching plan.
+    """
+    # Work on positionally indexed copies; the LAB columns are only needed while matching
+    df1 = reference_df.reset_index(drop=True)
+    df2 = segment_df.reset_index(drop=True)
+
     # Convert RGB to LAB color space
     df1_lab = rgb2lab(df1[['R', 'G', 'B']].values.reshape(-1, 1, 3) / 255.0).reshape(-1, 3)
     df2_lab = rgb2lab(df2[['R', 'G', 'B']].values.reshape(-1, 1, 3) / 255.0).reshape(-1, 3)
-
-    # Add LAB columns
-    df1[['L', 'A', 'B_val']] = df1_lab
     df2[['L', 'A', 'B_val']] = df2_lab
 
     # Merge based on RGB values to find exact matches
-    merged_df = pd.merge(df2, df1[['R', 'G', 'B', 'Assigned_Value']], on=['R', 'G', 'B'], how='left')
-
-    def interpolate_lab_value(row):
-        if pd.isna(row['Assigned_Value']):  # No exact RGB match
-            # Calculate distances to each LAB color in reference dataset
-            distances = np.sqrt((df1['L'] - row['L']) ** 2 +
-                               (df1['A'] - row['A']) ** 2 +
-                               (df1['B_val'] - row['B_val']) ** 2)
-            
-            # Find k nearest neighbors
-            k_neighbors = min(k, len(df1))
-            nearest_indices = np.argsort(distances)[:k_neighbors]
-            nearest_distances = distances[nearest_indices]
-            nearest_values = df1.iloc[nearest_indices]['Assigned_Value'].values
-            
-            # Handle the case where some distances are zero
-            zero_distances = nearest_distances == 0
-            if np.any(zero_distances):
-                # If we have exact LAB matches (but different RGB), use their mean
-                return np.mean(nearest_values[zero_distances])
-            
-            if use_inverse_distance:
-                # Inverse distance weighting
+    bands = df1[['R', 'G', 'B']].assign(_band=np.arange(len(df1)))
+    merged_df = pd.merge(df2, bands, on=['R', 'G', 'B'], how='left')
+    exact_band = merged_df['_band'].to_numpy()
+    unmatched = np.flatnonzero(np.isnan(exact_band))
+
+    # Distances from every unmatched colour to every band, summed in the same
+    # order as the per-row computation so the results are bit-for-bit equal
+    lab = merged_df[['L', 'A', 'B_val']].to_numpy()[unmatched]
+    distances = np.sqrt((df1_lab[None, :, 0] - lab[:, None, 0]) ** 2 +
+                        (df1_lab[None, :, 1] - lab[:, None, 1]) ** 2 +
+                        (df1_lab[None, :, 2] - lab[:, None, 2]) ** 2)
+
+    # Find k nearest neighbors
+    k_neighbors = min(k, len(df1))
+    neighbors = np.argsort(distances, axis=1)[:, :k_neighbors]
+
+    return {
+        'merged_df': merged_df.drop(columns=['L', 'A', 'B_val', '_band']),
+        'exact_band': np.nan_to_num(exact_band, nan=-1).astype(np.int64),
+        'unmatched': unmatched,
+        'neighbors': neighbors,
+        'distances': np.take_along_axis(distances, neighbors, axis=1),
+        'use_inverse_distance': use_inverse_distance,
+    }
+
+
+def apply_color_matching(plan, band_values):
+    """
+    Computes the segments' values from a plan of `plan_color_matching` and the
+    value of each band.
+
+    Args:
+        plan (dict): Result of `plan_color_matching`.
+        band_values (array-like): Assigned_Value of each colour map band, in table order.
+
+    Returns:
+        pandas.DataFrame: The segment table with an Assigned_Value column.
+    """
+    band_values = np.asarray(band_values, dtype=np.float64)
+    exact_band = plan['exact_band']
+    values = np.where(exact_band >= 0, band_values[np.maximum(exact_band, 0)], np.nan)
+
+    unmatched = plan['unmatched']
+    if unmatched.size:
+        nearest_distances = plan['distances']
+        nearest_values = band_values[plan['neighbors']]
+
+        # Handle the case where some distances are zero
+        zero_distances = nearest_distances == 0
+        has_zero = zero_distances.any(axis=1)
+
+        if plan['use_inverse_distance']:
+            # Inverse distance weighting, weights normalized to sum to 1
+            with np.errstate(divide='ignore', invalid='ignore'):
                 weights = 1.0 / nearest_distances
-                # Normalize weights to sum to 1
-                weights = weights / np.sum(weights)
-                # Calculate weighted average
-                interpolated_value = np.sum(weights * nearest_values)
-            else:
-                # Simple average
-                interpolated_value = np.mean(nearest_values)
-                
-            return interpolated_value
+                weights = weights / np.sum(weights, axis=1, keepdims=True)
+                interpolated = np.sum(weights * nearest_values, axis=1)
+        else:
+            # Simple average
+            interpolated = np.mean(nearest_values, axis=1)
 
-        return row['Assigned_Value']  # Return existing value if exact match found
+        for row in np.flatnonzero(has_zero):
+            # If we have exact LAB matches (but different RGB), use their mean
+            interpolated[row] = np.mean(nearest_values[row][zero_distances[row]])
+        values[unmatched] = interpolated
 
-    # Apply interpolation to fill missing values
-    merged_df['Assigned_Value'] = merged_df.apply(interpolate_lab_value, axis=1)
+    merged_df = plan['merged_df'].copy()
+    merged_df['Assigned_Value'] = values
+    return merged_df
 
-    # Drop the LAB columns before saving
-    merged_df = merged_df.drop(columns=['L', 'A', 'B_val'])
 
-    # Ensure the output directory exists
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+def color_matching_weights(plan, num_bands):
+    """
+    Writes a plan of `plan_color_matching` as a (segments x bands) weight
+    matrix W, so that the segments' values for any band values v are W @ v,
+    as `apply_color_matching` computes them one assignment at a time.
 
-    # Save the merged CSV file
-    merged_df.to_csv(output_path, index=False)
+    Args:
+        plan (dict): Result of `plan_color_matching`.
+        num_bands (int): Number of colour map bands.
 
-    return output_path
\ No newline at end of file
+    Returns:
+        numpy.ndarray: float64 weights; every row sums to 1.
+    """
+    exact_band = plan['exact_band']
+    weights = np.zeros((exact_band.size, num_bands), dtype=np.float64)
+    exact = np.flatnonzero(exact_band >= 0)
+    weights[exact, exact_band[exact]] = 1.0
+
+    unmatched = plan['unmatched']
+    if unmatched.size:
+        distances = plan['distances']
+        zero_distances = distances == 0
+        has_zero = zero_distances.any(axis=1)
+        if plan['use_inverse_distance']:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                neighbor_weights = 1.0 / distances
+                neighbor_weights = neighbor_weights / np.sum(neighbor_weights, axis=1, keepdims=True)
+        else:
+            neighbor_weights = np.full(distances.shape, 1.0 / distances.shape[1])
+        # Exact LAB matches (but different RGB) share the weight equally
+        neighbor_weights[has_zero] = zero_distances[has_zero] / zero_distances[has_zero].sum(axis=1, keepdims=True)
+        np.add.at(weights, (unmatched[:, None], plan['neighbors']), neighbor_weights)
+    return weights
+
+
+def assign_values_by_color(reference_df, segment_df, k=3, use_inverse_distance=True):
+    """
+    Assigns each segment the value of its colour by LAB colour space matching
+    against the colour map table: exact RGB matches take the band's value, other
+    colours are interpolated from their k nearest bands.
+
+    Args:
+        reference_df (pandas.DataFrame): Colour map table with R, G, B and Assigned_Value.
+        segment_df (pandas.DataFrame): Segment table with R, G, B, PixelCount and
+            PercentageArea; 'Segment' must be a column, not the index.
+        k (int): Number of nearest neighbors to use for interpolation (default: 3).
+        use_inverse_distance (bool): Whether to use inverse distance weighting (default: True).
+
+    Returns:
+        pandas.DataFrame: `segment_df` with an Assigned_Value column.
+    """
+    plan = plan_color_matching(reference_df, segment_df, k=k, use_inverse_distance=use_inverse_distance)
+    return apply_color_matching(plan, reference_df['Assigned_Value'].to_numpy())
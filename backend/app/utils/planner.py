@@ -0,0 +1,263 @@
+import math
+import threading
+from collections import namedtuple
+import numpy as np
+from app.utils.image_io import to_rgb8
+from app.utils.concurrency import available_memory
+
+# Ways the segmentation of a single-mask analysis can be run
+ENGINES = ('worker', 'request_thread')
+
+# How a single-mask analysis can be computed: by segmenting the crop around
+# the mask at full resolution ('exact'), or a downsampled copy of it
+# ('estimate', see `estimate_average`). Estimates are approximate, so they
+# are only planned for requests that set a time budget.
+STRATEGIES = ('exact', 'estimate')
+
+# Pixels sampled when counting the distinct colours of a region
+COLOR_SAMPLE_PIXELS = 65536
+
+# Peak bytes per segmented pixel (image, smoothing, graph edges and labels)
+BYTES_PER_PIXEL = 64
+
+# Bytes per pixel handed to a worker through shared memory (RGB, mask, labels)
+SHARED_BYTES_PER_PIXEL = 8
+
+# Terms of every cost model: fixed seconds, seconds per megapixel segmented
+# (the mask's bounding-box crop for stored images), per megapixel inside the
+# mask (statistics and colour extraction) and per million (distinct colour x
+# colour map band) pairs to match
+COST_TERMS = ('overhead', 'per_megapixel', 'per_mask_megapixel', 'per_match')
+
+# Starting cost model per option: each exact engine, and the estimate
+DEFAULT_COSTS = {
+    'worker': {'overhead': 0.05, 'per_megapixel': 0.5, 'per_mask_megapixel': 0.1, 'per_match': 0.2},
+    'request_thread': {'overhead': 0.0, 'per_megapixel': 0.5, 'per_mask_megapixel': 0.1, 'per_match': 0.2},
+    'estimate': {'overhead': 0.02, 'per_megapixel': 0.5, 'per_mask_megapixel': 0.1, 'per_match': 0.2},
+}
+
+# Weight old runs keep at each new one, so the models follow the machine
+FORGETTING = 0.95
+
+# How many runs' worth of evidence the starting costs count as
+PRIOR_WEIGHT = 1.0
+
+PlanFeatures = namedtuple(
+    'PlanFeatures',
+    ['pixels', 'mask_pixels', 'distinct_colors', 'bands', 'available_memory', 'estimate_pixels'],
+)
+Plan = namedtuple(
+    'Plan', ['strategy', 'engine', 'predicted_seconds', 'alternatives', 'features', 'override', 'budget']
+)
+
+
+def count_distinct_colors(region, sample_pixels=COLOR_SAMPLE_PIXELS):
+    """
+    Counts the distinct colours on an evenly strided sample of a region, a
+    cheap proxy for how many segments it will break into.
+    """
+    height, width = region.shape[:2]
+    step = max(int(math.sqrt(height * width / sample_pixels)), 1)
+    sample = to_rgb8(region[::step, ::step]).reshape(-1, 3).astype(np.uint32)
+    return int(np.unique((sample[:, 0] << 16) | (sample[:, 1] << 8) | sample[:, 2]).size)
+
+
+def measure_features(region, mask, bands, bbox=None, estimate_max_size=256):
+    """
+    Extracts the cheap features the planner decides on.
+
+    Args:
+        region (numpy.ndarray): The image about to be analysed; may be lazy.
+        mask (numpy.ndarray): Its mask; non-zero is inside.
+        bands (int): Bands of the colour map the segments are matched against.
+        bbox (tuple, optional): Crop (top, bottom, left, right) that will be
+            segmented; the whole region by default.
+        estimate_max_size (int): Longest side of the crop an estimate segments.
+
+    Returns:
+        PlanFeatures: The features.
+    """
+    if bbox is not None:
+        top, bottom, left, right = bbox
+        region = region[top:bottom, left:right]
+        mask = mask[top:bottom, left:right]
+    height, width = region.shape[:2]
+    factor = max(max(height, width) / estimate_max_size, 1.0)
+    return PlanFeatures(
+        pixels=int(height * width),
+        mask_pixels=int(np.count_nonzero(mask)),
+        distinct_colors=count_distinct_colors(region),
+        bands=int(bands),
+        available_memory=available_memory(),
+        estimate_pixels=int(math.ceil(height / factor) * math.ceil(width / factor)),
+    )
+
+
+class CostModel:
+    """
+    Predicted seconds of one option, linear in (1, megapixels, mask
+    megapixels, million matches) with one coefficient per COST_TERMS entry.
+
+    Every term is refitted after each run by recursive least squares: old
+    runs are discounted by FORGETTING, and the starting costs act as
+    PRIOR_WEIGHT runs' worth of evidence, so a handful of runs cannot throw
+    the model far. Coefficients are kept non-negative.
+    """
+
+    def __init__(self, costs):
+        self.prior = np.array([float(costs[term]) for term in COST_TERMS])
+        self.coefficients = self.prior.copy()
+        self._gram = np.zeros((len(COST_TERMS), len(COST_TERMS)))
+        self._moment = np.zeros(len(COST_TERMS))
+
+    def predict(self, x):
+        return float(self.coefficients @ x)
+
+    def observe(self, x, seconds):
+        self._gram = FORGETTING * self._gram + np.outer(x, x)
+        self._moment = FORGETTING * self._moment + x * seconds
+        regularisation = PRIOR_WEIGHT * np.eye(len(COST_TERMS))
+        fitted = np.linalg.solve(self._gram + regularisation, self._moment + regularisation @ self.prior)
+        self.coefficients = np.maximum(fitted, 0.0)
+
+    def costs(self):
+        return {term: float(value) for term, value in zip(COST_TERMS, self.coefficients)}
+
+
+class Planner:
+    """
+    Picks how to compute a single-mask analysis from a cost model of every
+    option: the exact strategy on each engine, and the downsampled estimate.
+
+    Engines whose predicted peak memory does not fit are only chosen when
+    nothing else does: a worker that runs out is stopped cleanly, while the
+    request thread would take the server down. The request thread cannot be
+    stopped part-way either, so it is only considered for runs predicted to
+    finish within `request_thread_max_seconds` and, with a `memory_limit`,
+    to peak below it. Under a `time_limit` or `memory_limit` an override of
+    the request thread is refused for runs predicted to break those bounds.
+
+    The estimate is planned only for a request with a time budget, when the
+    cheapest exact option is predicted to overrun it and the estimate is
+    predicted to be cheaper.
+    """
+
+    def __init__(self, costs=None, memory_limit=None, request_thread_max_seconds=0.5, time_limit=None):
+        """
+        Args:
+            costs (dict, optional): Starting cost model per option; see DEFAULT_COSTS.
+                Terms left out keep their default.
+            memory_limit (int, optional): Address space of a worker (JOB_MEMORY_LIMIT), also kept to on the request thread.
+            request_thread_max_seconds (float): Longest predicted run left on the request thread.
+            time_limit (float, optional): Seconds an analysis may run (JOB_TIME_LIMIT).
+        """
+        costs = costs or {}
+        self.models = {
+            option: CostModel({**DEFAULT_COSTS.get(option, {}), **costs.get(option, {})})
+            for option in {**DEFAULT_COSTS, **costs}
+        }
+        self.memory_limit = memory_limit
+        self.time_limit = time_limit
+        self.request_thread_max_seconds = request_thread_max_seconds
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _terms(option, features):
+        pixels, mask_pixels = features.pixels, features.mask_pixels
+        if option == 'estimate' and pixels:
+            # The estimate's mask is downsampled with its crop
+            pixels, mask_pixels = features.estimate_pixels, mask_pixels * features.estimate_pixels / pixels
+        return np.array([1.0, pixels / 1e6, mask_pixels / 1e6, features.distinct_colors * features.bands / 1e6])
+
+    def predict(self, option, features):
+        """Returns the predicted seconds of `option` (an engine or 'estimate') on `features`."""
+        with self._lock:
+            return self.models[option].predict(self._terms(option, features))
+
+    def _within_limits(self, engine, features, predicted_seconds):
+        """Whether a request-thread run, which cannot be stopped part-way, is predicted to keep to the limits."""
+        if engine != 'request_thread':
+            return True
+        if self.time_limit and predicted_seconds > self.request_thread_max_seconds:
+            return False
+        return not self.memory_limit or features.pixels * BYTES_PER_PIXEL <= self.memory_limit
+
+    def _fits(self, engine, features, predicted_seconds):
+        if engine == 'request_thread' and predicted_seconds > self.request_thread_max_seconds:
+            return False
+        if not self._within_limits(engine, features, predicted_seconds):
+            return False
+        peak = features.pixels * BYTES_PER_PIXEL
+        if engine == 'worker':
+            if self.memory_limit and peak > self.memory_limit:
+                return False
+            peak = features.pixels * SHARED_BYTES_PER_PIXEL
+        elif features.available_memory is not None:
+            # Leave half of what is free to the server and the other analyses
+            return peak <= features.available_memory / 2
+        return features.available_memory is None or peak <= features.available_memory
+
+    def choose(self, features, engines, override=None, budget=None):
+        """
+        Chooses the cheapest of `engines` that fits in memory, or `override`,
+        for the exact strategy; or the estimate, within a `budget` in seconds
+        (see the class docstring).
+
+        Raises:
+            ValueError: If `override` is not one of `engines`, or is the
+                request thread for a run predicted to break the limits.
+
+        Returns:
+            Plan: The chosen strategy and engine with its predicted cost and the others'.
+        """
+        alternatives = {engine: self.predict(engine, features) for engine in engines}
+        if budget is not None:
+            alternatives['estimate'] = self.predict('estimate', features)
+        if override is not None:
+            if override not in engines:
+                raise ValueError(f"Engine '{override}' is not available; expected one of {', '.join(engines)}")
+            if not self._within_limits(override, features, alternatives[override]):
+                raise ValueError(f"Engine '{override}' cannot stop this analysis within its time or memory limit")
+            return Plan('exact', override, alternatives[override], alternatives, features, True, budget)
+
+        fitting = [engine for engine in engines if self._fits(engine, features, alternatives[engine])]
+        if not fitting:
+            fitting = ['worker'] if 'worker' in engines else list(engines)
+        engine = min(fitting, key=alternatives.get)
+        if budget is not None and alternatives[engine] > budget and alternatives['estimate'] < alternatives[engine]:
+            # Small enough to run in-process whatever the image
+            return Plan('estimate', 'request_thread', alternatives['estimate'], alternatives, features, False, budget)
+        return Plan('exact', engine, alternatives[engine], alternatives, features, False, budget)
+
+    def observe(self, plan, seconds):
+        """Refits the cost model of the option `plan` ran with from how long it took."""
+        option = 'estimate' if plan.strategy == 'estimate' else plan.engine
+        with self._lock:
+            self.models[option].observe(self._terms(option, plan.features), seconds)
+
+    def costs(self):
+        """The current cost model of every option."""
+        with self._lock:
+            return {option: model.costs() for option, model in self.models.items()}
+
+
+def describe_plan(plan, actual_seconds=None):
+    """JSON-serialisable view of a plan for the response."""
+    features = plan.features
+    return {
+        'strategy': plan.strategy,
+        'engine': plan.engine,
+        'override': plan.override,
+        'timeBudget': plan.budget,
+        'predictedSeconds': round(plan.predicted_seconds, 4),
+        'actualSeconds': None if actual_seconds is None else round(actual_seconds, 4),
+        'alternatives': {option: round(seconds, 4) for option, seconds in plan.alternatives.items()},
+        'features': {
+            'pixels': features.pixels,
+            'estimatePixels': features.estimate_pixels,
+            'maskPixels': features.mask_pixels,
+            'distinctColors': features.distinct_colors,
+            'bands': features.bands,
+            'availableMemory': features.available_memory,
+        },
+    }
@@ -0,0 +1,182 @@
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from app.utils.image_io import open_image_lazy, count_pages, to_rgb8
+from app.utils.image_segmentation.felzenszwalb_segmentation import felzenszwalb_params_for_shape
+from app.utils.result_cache import hash_file
+
+
+class PreparedImage:
+    """
+    An image registered before its mask is known, and the mask-independent
+    work done on it in the background: the page decoded and converted to
+    uint8 RGB once, its Felzenszwalb parameters and its content hash.
+    """
+
+    def __init__(self, image_id, path, page):
+        self.id = image_id
+        self.path = path
+        self.page = page
+        self.shape = None
+        self.params = None
+        self.future = None
+        self.touched_at = time.time()
+        self._frame = None
+
+    def wait(self, job=None, poll_interval=0.1):
+        """
+        Waits for the preparation to finish, checking `job` meanwhile. If it
+        has not started yet it is cancelled instead, so the caller does not
+        queue behind other images' preparation.
+
+        Returns:
+            numpy.ndarray or None: The read-only uint8 RGB frame, or None if
+            preparation failed, was cancelled or its frame was dropped to stay
+            within the memory budget; callers then decode `path` themselves.
+
+        Raises:
+            JobCancelled: If `job` should stop while waiting.
+        """
+        if self.future.cancel():
+            return None
+        while True:
+            try:
+                self.future.result(timeout=poll_interval)
+            except FuturesTimeoutError:
+                if job is not None:
+                    job.check()
+                continue
+            except Exception:
+                return None
+            return self._frame
+
+    @property
+    def ready(self):
+        return self.future is not None and self.future.done()
+
+    def status(self):
+        """JSON-serialisable view for the client."""
+        status = {'imageId': self.id, 'page': self.page, 'ready': self.ready}
+        if self.shape is not None:
+            status['height'], status['width'] = int(self.shape[0]), int(self.shape[1])
+        if self.ready and not self.future.cancelled() and self.future.exception() is not None:
+            status['error'] = str(self.future.exception())
+        return status
+
+
+class PreparedImageStore:
+    """
+    Images sent ahead of their mask, prepared speculatively while the user
+    draws it, so the final analysis request only carries the image id.
+
+    Prepared frames are kept in memory up to `max_bytes`, least recently used
+    dropped first (their ids stay valid and fall back to decoding from the
+    upload store); ids expire `ttl` seconds after their last use.
+    """
+
+    def __init__(self, upload_store, max_bytes=512 * 1024 * 1024, ttl=30 * 60, workers=1):
+        self.upload_store = upload_store
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._images = OrderedDict()  # image id -> PreparedImage
+        self._by_source = {}  # (path, page) -> image id
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prepare-image')
+
+    def _owner(self, image_id):
+        # Upload store reference held while the id is valid
+        return f"prepared:{image_id}"
+
+    def add(self, path, page=0):
+        """
+        Registers a stored upload and starts preparing it in the background.
+        Registering the same file and page again returns the existing image.
+
+        Returns:
+            PreparedImage: The registered image.
+
+        Raises:
+            ValueError: If the page does not exist.
+        """
+        pages = count_pages(path)
+        if not 0 <= page < pages:
+            raise ValueError(f"Page {page} out of range ({pages} pages)")
+
+        with self._lock:
+            self._expire(time.time())
+            image_id = self._by_source.get((path, page))
+            if image_id is not None:
+                image = self._images[image_id]
+                image.touched_at = time.time()
+                self._images.move_to_end(image_id)
+                return image
+            image = PreparedImage(uuid.uuid4().hex, path, page)
+            self._images[image.id] = image
+            self._by_source[(path, page)] = image.id
+            self.upload_store.acquire(path, self._owner(image.id))
+            image.future = self._executor.submit(self._prepare, image)
+        return image
+
+    def _prepare(self, image):
+        started = time.monotonic()
+        # Warms the memoised hash the request's fingerprint is built from
+        hash_file(image.path)
+        # TIFF pages are decoded into their .npy cache next to the stored file here
+        source = open_image_lazy(image.path, page=image.page)
+        image.shape = source.shape[:2]
+        image.params = felzenszwalb_params_for_shape(*image.shape)
+        frame = to_rgb8(source)
+        del source
+        frame.flags.writeable = False
+
+        with self._lock:
+            if image.id not in self._images:
+                return
+            image._frame = frame
+            self._trim()
+        logging.info(f"Prepared image {image.id} ({image.shape[1]}x{image.shape[0]}) "
+                     f"in {time.monotonic() - started:.2f} s")
+
+    def get(self, image_id):
+        """Returns the registered image, or None if the id is unknown or expired."""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            image = self._images.get(image_id)
+            if image is not None:
+                image.touched_at = now
+                self._images.move_to_end(image_id)
+            return image
+
+    def _expire(self, now):
+        # Caller holds the lock
+        if not self.ttl:
+            return
+        for image_id in [i for i, image in self._images.items() if now - image.touched_at > self.ttl]:
+            self._drop(image_id)
+
+    def _drop(self, image_id):
+        # Caller holds the lock
+        image = self._images.pop(image_id)
+        image._frame = None
+        if image.future is not None:
+            image.future.cancel()
+        self._by_source.pop((image.path, image.page), None)
+        self.upload_store.release_owner(self._owner(image_id))
+
+    def _trim(self):
+        # Caller holds the lock; drops the least recently used frames over budget
+        total = sum(image._frame.nbytes for image in self._images.values() if image._frame is not None)
+        for image in self._images.values():
+            if total <= self.max_bytes:
+                break
+            if image._frame is not None:
+                total -= image._frame.nbytes
+                image._frame = None
+
+    def shutdown(self):
+        """Stops preparing images; registered ids stay valid."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
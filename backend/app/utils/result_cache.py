@@ -0,0 +1,305 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+# Bump whenever the analysis pipeline changes in a way that alters results
+CACHE_VERSION = '1'
+
+
+def hash_bytes(data):
+    """
+    Returns a short content hash for a block of bytes.
+
+    Args:
+        data (bytes): Content to hash.
+
+    Returns:
+        str: Hex digest.
+    """
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+
+def hash_file(filepath, chunk_size=1024 * 1024):
+    """
+    Returns the content hash of a file, memoized on its path, size and mtime.
+
+    Args:
+        filepath (str): Path to the file.
+        chunk_size (int): Read size in bytes.
+
+    Returns:
+        str: Hex digest.
+    """
+    stat = os.stat(filepath)
+    signature = (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+    with _file_hashes_lock:
+        digest = _file_hashes.get(signature)
+    if digest is not None:
+        return digest
+
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    digest = hasher.hexdigest()
+
+    with _file_hashes_lock:
+        _file_hashes[signature] = digest
+    return digest
+
+
+def build_cache_key(*parts, **params):
+    """
+    Builds a cache key from content hashes and the numeric/engine parameters.
+
+    Args:
+        *parts (str): Content hashes of the inputs, in a fixed order.
+        **params: Scalar parameters that influence the result.
+
+    Returns:
+        str: Hex digest identifying the request.
+    """
+    hasher = hashlib.blake2b(digest_size=20)
+    hasher.update(CACHE_VERSION.encode())
+    for part in parts:
+        hasher.update(b'\x00')
+        hasher.update(str(part).encode())
+    for name in sorted(params):
+        hasher.update(b'\x01')
+        hasher.update(f"{name}={params[name]!r}".encode())
+    return hasher.hexdigest()
+
+
+class Unshared(Exception):
+    """
+    Raised by a computation whose outcome only holds for its own caller: a
+    result that must not be reused, or a failure of that caller's making
+    (its client went away or cancelled). Callers waiting on the same key run
+    the computation themselves instead of receiving it.
+    """
+
+
+class _InFlight:
+    """A computation currently running for one key, shared by every waiter."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResultCache:
+    """
+    Memory-bounded LRU cache of serialized results with a TTL, optional disk
+    persistence and single-flight coalescing of identical concurrent requests.
+
+    Values are stored as bytes so a cached response is byte-identical to the
+    one produced by the computation that filled it.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=3600, persist_dir=None, on_evict=None):
+        """
+        Args:
+            max_bytes (int): Upper bound on the total size of values kept in memory.
+            ttl (float): Seconds an entry stays valid; None or 0 disables expiry.
+            persist_dir (str, optional): Directory to mirror entries to, so they
+                survive restarts.
+            on_evict (callable, optional): Called with the key of every entry
+                that leaves the cache for good (expired, or pushed out of
+                memory when it is not persisted), e.g. to delete files the
+                cached value refers to.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.persist_dir = persist_dir
+        self.on_evict = on_evict
+        self._entries = OrderedDict()  # key -> (stored_at, value)
+        self._size = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if persist_dir:
+            os.makedirs(persist_dir, exist_ok=True)
+
+    def _expired(self, stored_at, now):
+        return bool(self.ttl) and now - stored_at > self.ttl
+
+    def _disk_path(self, key):
+        return os.path.join(self.persist_dir, f"{key}.bin")
+
+    def _evicted(self, keys):
+        # Called without the lock
+        if self.on_evict is None:
+            return
+        for key in keys:
+            try:
+                self.on_evict(key)
+            except Exception:
+                logging.exception(f"Eviction callback failed for {key}")
+
+    def _load_from_disk(self, key, now):
+        path = self._disk_path(key)
+        try:
+            stored_at = os.path.getmtime(path)
+            if self._expired(stored_at, now):
+                os.remove(path)
+                self._evicted([key])
+                return None
+            with open(path, 'rb') as f:
+                return stored_at, f.read()
+        except OSError:
+            return None
+
+    def _save_to_disk(self, key, value):
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(value)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not persist cached result {key}: {e}")
+
+    def _store(self, key, stored_at, value):
+        """
+        Caller holds the lock. Returns the keys pushed out of memory for good
+        (none when entries are persisted), for `_evicted`.
+        """
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= len(old[1])
+        if len(value) > self.max_bytes:
+            # Not kept, but its caller is about to answer with it
+            return []
+        self._entries[key] = (stored_at, value)
+        self._size += len(value)
+        evicted_keys = []
+        while self._size > self.max_bytes:
+            evicted_key, (_, evicted) = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+            evicted_keys.append(evicted_key)
+        return [] if self.persist_dir else evicted_keys
+
+    def get(self, key):
+        """
+        Returns the cached value for `key`, or None if absent or expired.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not self._expired(entry[0], now):
+                    self._entries.move_to_end(key)
+                    return entry[1]
+                del self._entries[key]
+                self._size -= len(entry[1])
+        if entry is not None and not self.persist_dir:
+            self._evicted([key])
+
+        if self.persist_dir:
+            entry = self._load_from_disk(key, now)
+            if entry is not None:
+                with self._lock:
+                    evicted = self._store(key, *entry)
+                self._evicted(evicted)
+                return entry[1]
+        return None
+
+    def put(self, key, value):
+        """
+        Stores `value` (bytes) under `key` in memory and, if enabled, on disk.
+        """
+        with self._lock:
+            evicted = self._store(key, time.time(), value)
+        if self.persist_dir:
+            self._save_to_disk(key, value)
+        self._evicted(evicted)
+
+    def discard(self, key):
+        """
+        Drops `key` from memory and disk, without calling `on_evict`; for
+        values whose files were removed from under the cache.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= len(entry[1])
+        if self.persist_dir:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached value for `key`, computing it at most once even when
+        several callers ask for the same key at the same time.
+
+        If `compute` raises, nothing is cached and every caller waiting on the
+        same key receives the same exception, except for `Unshared` ones: the
+        waiters then compute the value themselves (one of them leading again).
+
+        Args:
+            key (str): Cache key.
+            compute (callable): Produces the value (bytes); called by one caller only.
+
+        Returns:
+            tuple: (value, hit) where hit is True if no computation ran for this caller.
+        """
+        value = self.get(key)
+        if value is not None:
+            with self._lock:
+                self.hits += 1
+            return value, True
+
+        while True:
+            with self._lock:
+                # A computation may have finished between the lookup above and here
+                entry = self._entries.get(key)
+                if entry is not None and not self._expired(entry[0], time.time()):
+                    self.hits += 1
+                    return entry[1], True
+                flight = self._in_flight.get(key)
+                leader = flight is None
+                if leader:
+                    flight = _InFlight()
+                    self._in_flight[key] = flight
+                    self.misses += 1
+
+            if leader:
+                break
+            flight.done.wait()
+            if isinstance(flight.error, Unshared):
+                continue
+            if flight.error is not None:
+                raise flight.error
+            with self._lock:
+                self.hits += 1
+            return flight.value, True
+
+        try:
+            flight.value = compute()
+            self.put(key, flight.value)
+            return flight.value, False
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            flight.done.set()
+
+    def clear(self):
+        """Drops every in-memory entry."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
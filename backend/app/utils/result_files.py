@@ -0,0 +1,96 @@
+import os
+import time
+import shutil
+import logging
+import threading
+
+# Seconds a directory is kept after use whatever the quota, so results being
+# written or just answered are not removed under their request
+IN_USE_GRACE = 60
+
+
+class ResultFiles:
+    """
+    Per-result directories (preview, CSVs, binary exports, value raster and
+    tile labels) under `root`, one per result id.
+
+    A directory counts as used when it is written to or `touch`ed, e.g. when
+    its cached response is served again. Directories unused for `ttl`
+    seconds are removed, then the least recently used while the total is
+    above `max_bytes`. `on_remove(result_id, path)` is called for every
+    removed directory, so whatever still refers to it (the result cache, open
+    value rasters) can forget it.
+    """
+
+    def __init__(self, root, max_bytes=2 * 1024 ** 3, ttl=60 * 60, on_remove=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.on_remove = on_remove
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, result_id):
+        """Returns the directory of `result_id`, created and marked used."""
+        path = os.path.join(self.root, result_id)
+        os.makedirs(path, exist_ok=True)
+        self.touch(result_id)
+        return path
+
+    def touch(self, result_id):
+        """Marks the directory of `result_id` used, if it exists."""
+        try:
+            os.utime(os.path.join(self.root, result_id))
+        except OSError:
+            pass
+
+    def _entries(self):
+        """(result id, size in bytes, last used) of every directory."""
+        entries = []
+        for entry in os.scandir(self.root):
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            try:
+                last_used = entry.stat().st_mtime
+                size = 0
+                for child in os.scandir(entry.path):
+                    stat = child.stat(follow_symlinks=False)
+                    size += stat.st_size
+                    last_used = max(last_used, stat.st_mtime)
+            except FileNotFoundError:
+                continue
+            entries.append((entry.name, size, last_used))
+        return entries
+
+    def remove(self, result_id):
+        """Deletes the directory of `result_id` and calls `on_remove`."""
+        path = os.path.join(self.root, result_id)
+        shutil.rmtree(path, ignore_errors=True)
+        if self.on_remove is not None:
+            try:
+                self.on_remove(result_id, path)
+            except Exception:
+                logging.exception(f"Could not forget removed result {result_id}")
+
+    def evict(self, now=None):
+        """
+        Removes the directories that expired, then the least recently used
+        ones while the total is over the quota.
+
+        Returns:
+            int: Number of directories removed.
+        """
+        now = time.time() if now is None else now
+        removed = 0
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda entry: entry[2])
+            total = sum(size for _, size, _ in entries)
+            for result_id, size, last_used in entries:
+                expired = bool(self.ttl) and now - last_used > self.ttl
+                over_quota = bool(self.max_bytes) and total > self.max_bytes
+                if not (expired or over_quota) or now - last_used < IN_USE_GRACE:
+                    continue
+                self.remove(result_id)
+                total -= size
+                removed += 1
+        return removed
@@ -0,0 +1,101 @@
+import json
+import math
+import numpy as np
+from app.utils.aggregate_results import aggregate_scenarios
+from app.utils.color_map.color_map_segmentation import distributed_band_values
+from app.utils.merge_csv import color_matching_weights
+
+# Value distributions a scenario may ask for; 'auto' picks one from the range
+DISTRIBUTIONS = ('auto', 'linear', 'log', 'symlog')
+
+# Most scenarios evaluated for one request
+MAX_SCENARIOS = 1000
+
+
+def parse_scenarios(text):
+    """
+    Parses and validates the scenarios of a sweep, JSON of the form::
+
+        [{"topValue": 1e20, "bottomValue": 1e14, "distribution": "log"}, ...]
+
+    where 'distribution' is optional and defaults to 'auto'.
+
+    Returns:
+        list: Dicts with float 'topValue' and 'bottomValue' and 'distribution'.
+
+    Raises:
+        ValueError: If the scenarios are malformed.
+    """
+    try:
+        scenarios = json.loads(text)
+    except ValueError as e:
+        raise ValueError(f'Invalid scenarios: {e}')
+    if not isinstance(scenarios, list) or not scenarios:
+        raise ValueError('Scenarios must be a non-empty list')
+    if len(scenarios) > MAX_SCENARIOS:
+        raise ValueError(f'At most {MAX_SCENARIOS} scenarios can be evaluated at once')
+
+    parsed = []
+    for scenario in scenarios:
+        try:
+            top_value, bottom_value = float(scenario['topValue']), float(scenario['bottomValue'])
+            distribution = scenario.get('distribution', 'auto')
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            raise ValueError(f'Invalid scenario: {e}')
+        if not (math.isfinite(top_value) and math.isfinite(bottom_value)):
+            raise ValueError('Scenario values must be finite')
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError(f"Unknown distribution: {distribution}; expected one of {', '.join(DISTRIBUTIONS)}")
+        parsed.append({'topValue': top_value, 'bottomValue': bottom_value, 'distribution': distribution})
+    return parsed
+
+
+def evaluate_scenarios(plan, num_bands, scenarios):
+    """
+    Evaluates the average and statistics of one segmentation under every
+    scenario at once.
+
+    The colour matching is done once (`plan`, from `plan_segment_values`)
+    and written as a weight matrix, so every scenario's segment values come
+    from a single (scenarios x bands) @ (bands x segments) product, and the
+    aggregation runs over the resulting matrix.
+
+    Args:
+        plan (dict): Colour matching plan of the segments.
+        num_bands (int): Number of colour map bands.
+        scenarios (list): Result of `parse_scenarios`.
+
+    Returns:
+        list: One dict per scenario with its values, the 'distribution' used,
+        'average' and 'stats'.
+    """
+    band_values = []
+    distributions = []
+    for scenario in scenarios:
+        requested = None if scenario['distribution'] == 'auto' else scenario['distribution']
+        values, distribution = distributed_band_values(
+            scenario['bottomValue'], scenario['topValue'], num_bands, requested
+        )
+        band_values.append(values)
+        distributions.append(distribution)
+
+    weights = color_matching_weights(plan, num_bands)
+    values = np.asarray(band_values, dtype=np.float64) @ weights.T
+    aggregated = aggregate_scenarios(plan['merged_df'], values, weights)
+
+    def number(value):
+        value = float(value)
+        return value if math.isfinite(value) else None
+
+    stats = aggregated['stats']
+    return [
+        {
+            'topValue': scenario['topValue'],
+            'bottomValue': scenario['bottomValue'],
+            'distribution': distributions[i],
+            'average': number(aggregated['average'][i]),
+            'stats': {key: int(column[i]) if key in ('numSegments', 'totalPixel') else number(column[i])
+                      for key, column in stats.items()},
+        }
+        for i, scenario in enumerate(scenarios)
+    ]
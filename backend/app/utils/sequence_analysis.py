@@ -0,0 +1,187 @@
+import os
+import uuid
+from concurrent.futures import FIRST_COMPLETED, wait
+import numpy as np
+from app.utils.analysis import SEGMENTATION_MARGIN, ENGINE_PARAMS, segment_cropped, aggregate_segments
+from app.utils.image_io import mask_bounding_box, to_rgb8
+from app.utils.image_segmentation.felzenszwalb_segmentation import felzenszwalb_params_for_shape
+from app.utils.shared_arrays import get_registry, attach_shared_array
+
+
+def plan_sequence(mask, margin=SEGMENTATION_MARGIN):
+    """
+    Works out what every frame of a sequence shares: the crop to the mask and
+    the Felzenszwalb parameters, which depend only on the frame size.
+
+    Args:
+        mask (numpy.ndarray): 2D mask used for every frame; non-zero is inside.
+        margin (int): Pixels kept around the mask's bounding box.
+
+    Returns:
+        dict: 'bbox' (top, bottom, left, right), 'mask' (the cropped mask),
+        'params' (scale, sigma, min_size) and 'shape' (frame height and width).
+
+    Raises:
+        ValueError: If the mask is empty.
+    """
+    bbox = mask_bounding_box(mask, margin=margin)
+    if bbox is None:
+        raise ValueError('Mask is empty')
+    top, bottom, left, right = bbox
+    return {
+        'bbox': bbox,
+        'mask': np.ascontiguousarray(mask[top:bottom, left:right]),
+        'params': felzenszwalb_params_for_shape(*mask.shape),
+        'shape': mask.shape,
+    }
+
+
+def crop_frame(frame, plan):
+    """
+    Crops one frame as `crop_to_mask` would, using the crop of `plan_sequence`.
+
+    Returns:
+        numpy.ndarray: uint8 RGB region with the pixels outside the mask blacked out.
+
+    Raises:
+        ValueError: If the frame size differs from the mask's.
+    """
+    if frame.shape[:2] != plan['shape']:
+        raise ValueError(f"Frame size {frame.shape[1::-1]} does not match mask size {plan['shape'][::-1]}")
+    top, bottom, left, right = plan['bbox']
+    region = to_rgb8(frame[top:bottom, left:right])
+    region[plan['mask'] == 0] = 0
+    return region
+
+
+def analyze_cropped_frame(region, mask, bbox, params, color_table, memory_lean=True, k=ENGINE_PARAMS['merge_k'],
+                          use_inverse_distance=ENGINE_PARAMS['merge_inverse_distance']):
+    """
+    Segments one cropped frame and aggregates it against a calibrated colour
+    map; `k` and `use_inverse_distance` are as in `aggregate_segments`.
+
+    Returns:
+        dict: 'average', 'colorMapData' and 'stats' of the frame.
+
+    Raises:
+        ValueError: If no segment lies inside the mask.
+    """
+    state = segment_cropped(region, mask, bbox, params, memory_lean=memory_lean)
+    results = aggregate_segments(state, color_table, k=k, use_inverse_distance=use_inverse_distance)['results']
+    return {'average': results['average'], 'colorMapData': results['colorMapData'], 'stats': results['stats']}
+
+
+def analyze_shared_frame(region_spec, mask_spec, bbox, params, color_table, memory_lean, k, use_inverse_distance):
+    """
+    Worker entry point: attaches to a cropped frame and the shared cropped
+    mask by name and analyses the frame with `analyze_cropped_frame`.
+    """
+    with attach_shared_array(region_spec) as region, attach_shared_array(mask_spec) as mask:
+        return analyze_cropped_frame(
+            region, mask, bbox, params, color_table, memory_lean=memory_lean,
+            k=k, use_inverse_distance=use_inverse_distance,
+        )
+
+
+def analyze_sequence(frames, mask, color_table, memory_lean=True, pool=None, max_pending=None, job_id=None,
+                     k=ENGINE_PARAMS['merge_k'], use_inverse_distance=ENGINE_PARAMS['merge_inverse_distance'],
+                     job=None):
+    """
+    Analyses every frame of a sequence (time series, parameter sweep) with one
+    mask and one calibrated colour map.
+
+    The crop and Felzenszwalb parameters are worked out once. Frames are
+    consumed one at a time from `frames` and cropped straight away, so only
+    the cropped regions of the frames in flight are held in memory. With a
+    `pool`, each cropped frame is handed to a worker process through shared
+    memory and the frames are segmented in parallel.
+
+    Args:
+        frames (iterable): Frames of the same size as the mask, e.g. from
+            `iter_frames`.
+        mask (numpy.ndarray): 2D mask of the region to analyse; non-zero is inside.
+        color_table (pandas.DataFrame): Result of `calibrate_color_map`.
+        memory_lean (bool): See `felzenszwalb_segment_array`.
+        pool (concurrent.futures.Executor, optional): Process pool the frames
+            are analysed in; without one they are analysed in this process.
+        max_pending (int, optional): Frames decoded ahead of the workers;
+            defaults to two per CPU.
+        job_id (str, optional): Owner of the shared buffers; they are released
+            before returning.
+        k (int): Neighbours used when interpolating colours between bands.
+        use_inverse_distance (bool): Weight the neighbours by inverse distance.
+        job (Job, optional): Checked before each frame; the sequence stops
+            with `JobCancelled` once the job should stop.
+
+    Returns:
+        list: One dict per frame, in frame order, with 'frame' (its index) and
+        either the keys of `analyze_cropped_frame` or an 'error' message.
+
+    Raises:
+        ValueError: If the mask is empty.
+    """
+    plan = plan_sequence(mask)
+    bbox, params = plan['bbox'], plan['params']
+
+    if pool is None:
+        results = []
+        for index, frame in enumerate(frames):
+            if job is not None:
+                job.check()
+            try:
+                region = crop_frame(frame, plan)
+                del frame
+                results.append({'frame': index, **analyze_cropped_frame(
+                    region, plan['mask'], bbox, params, color_table, memory_lean=memory_lean,
+                    k=k, use_inverse_distance=use_inverse_distance,
+                )})
+            except ValueError as e:
+                results.append({'frame': index, 'error': str(e)})
+        return results
+
+    if max_pending is None:
+        max_pending = 2 * (os.cpu_count() or 1)
+    registry = get_registry()
+    owner = job_id or uuid.uuid4().hex
+    results = {}
+    pending = {}  # future -> (frame index, SharedArraySpec of its region)
+
+    def collect(futures):
+        for future in futures:
+            index, spec = pending[future]
+            try:
+                results[index] = {'frame': index, **future.result()}
+            except (ValueError, MemoryError) as e:
+                results[index] = {'frame': index, 'error': str(e)}
+            del pending[future]
+            registry.release(spec.name)
+
+    try:
+        mask_spec, _ = registry.share(plan['mask'], owner=owner)
+        for index, frame in enumerate(frames):
+            if job is not None:
+                job.check()
+            try:
+                region = crop_frame(frame, plan)
+            except ValueError as e:
+                results[index] = {'frame': index, 'error': str(e)}
+                continue
+            del frame
+
+            spec, _ = registry.share(region, owner=owner)
+            del region
+            future = pool.submit(
+                analyze_shared_frame, spec, mask_spec, bbox, params, color_table, memory_lean, k, use_inverse_distance
+            )
+            pending[future] = (index, spec)
+
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(list(pending))
+    finally:
+        for future in pending:
+            future.cancel()
+        registry.release_owner(owner)
+
+    return [results[index] for index in sorted(results)]
@@ -0,0 +1,216 @@
+import os
+import uuid
+import atexit
+import logging
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+import numpy as np
+
+SHARED_PREFIX = 'vistar'
+
+# Everything a worker needs to attach to a buffer; small and cheap to pickle
+SharedArraySpec = namedtuple('SharedArraySpec', ['name', 'shape', 'dtype'])
+
+
+def _segment_name(prefix):
+    # The creator's PID is part of the name so orphans can be detected after a crash
+    return f"{prefix}_{os.getpid()}_{uuid.uuid4().hex[:16]}"
+
+
+class _Entry:
+    def __init__(self, shm, spec, owner):
+        self.shm = shm
+        self.spec = spec
+        self.owner = owner
+        self.refcount = 1
+
+
+class SharedArrayRegistry:
+    """
+    Creates NumPy arrays backed by `multiprocessing.shared_memory` and tracks
+    their lifetimes with reference counts.
+
+    The creating process holds one reference per buffer on behalf of its owner
+    (a job id). Other users, such as a background export thread, `acquire` an
+    extra reference. A buffer is unlinked once its count drops to zero, or when
+    `release_owner` is called as the job finishes. If the process dies, the
+    multiprocessing resource tracker unlinks whatever is left, and
+    `sweep_orphaned_segments` removes leftovers of processes killed hard.
+    """
+
+    def __init__(self, prefix=SHARED_PREFIX):
+        self.prefix = prefix
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def create(self, shape, dtype, owner=None):
+        """
+        Allocates a shared buffer.
+
+        Args:
+            shape (tuple): Array shape.
+            dtype: Array dtype.
+            owner (str, optional): Job the buffer belongs to.
+
+        Returns:
+            tuple: (SharedArraySpec, numpy.ndarray view of the buffer).
+        """
+        dtype = np.dtype(dtype)
+        size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        shm = shared_memory.SharedMemory(name=_segment_name(self.prefix), create=True, size=size)
+        spec = SharedArraySpec(shm.name, tuple(int(n) for n in shape), dtype.str)
+        with self._lock:
+            self._entries[shm.name] = _Entry(shm, spec, owner)
+        return spec, np.ndarray(spec.shape, dtype=dtype, buffer=shm.buf)
+
+    def share(self, array, owner=None):
+        """
+        Copies `array` into a new shared buffer.
+
+        Returns:
+            tuple: (SharedArraySpec, numpy.ndarray view of the buffer).
+        """
+        spec, view = self.create(array.shape, array.dtype, owner=owner)
+        view[...] = array
+        return spec, view
+
+    def view(self, spec):
+        """
+        Returns an array view of a buffer created by this registry.
+        """
+        with self._lock:
+            entry = self._entries[spec.name]
+        return np.ndarray(spec.shape, dtype=np.dtype(spec.dtype), buffer=entry.shm.buf)
+
+    def acquire(self, name):
+        """Adds a reference to a buffer."""
+        with self._lock:
+            self._entries[name].refcount += 1
+
+    def release(self, name):
+        """Drops a reference; the buffer is unlinked when none are left."""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return
+            entry.refcount -= 1
+            if entry.refcount > 0:
+                return
+            del self._entries[name]
+        _destroy(entry.shm)
+
+    def release_owner(self, owner):
+        """Drops the owner's reference on every buffer created for `owner`."""
+        with self._lock:
+            names = [name for name, entry in self._entries.items() if entry.owner == owner]
+        for name in names:
+            self.release(name)
+
+    def cleanup(self):
+        """Unlinks every buffer regardless of its reference count."""
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            _destroy(entry.shm)
+
+    def active_buffers(self):
+        """Returns {name: refcount} for the buffers currently alive."""
+        with self._lock:
+            return {name: entry.refcount for name, entry in self._entries.items()}
+
+
+def _destroy(shm):
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+    try:
+        shm.close()
+    except BufferError:
+        # Views are still alive somewhere; the mapping is released with the last one
+        pass
+
+
+@contextmanager
+def attach_shared_array(spec):
+    """
+    Attaches to a shared buffer by name from any process and yields it as an
+    array. The buffer is detached, but not unlinked, on exit.
+
+    Args:
+        spec (SharedArraySpec): Handle produced by `SharedArrayRegistry`.
+
+    Yields:
+        numpy.ndarray: View of the shared buffer.
+    """
+    # Pool workers share the creating process's resource tracker, so attaching
+    # does not add a second owner; only the creator unlinks the segment
+    shm = shared_memory.SharedMemory(name=spec.name)
+    try:
+        array = np.ndarray(spec.shape, dtype=np.dtype(spec.dtype), buffer=shm.buf)
+        yield array
+        del array
+    finally:
+        try:
+            shm.close()
+        except BufferError:
+            pass
+
+
+def sweep_orphaned_segments(prefix=SHARED_PREFIX, shm_dir='/dev/shm'):
+    """
+    Unlinks shared buffers left behind by processes that no longer exist.
+
+    Only POSIX systems expose named segments in a directory; on Windows the
+    operating system frees a segment once its last handle closes.
+
+    Returns:
+        int: Number of segments removed.
+    """
+    if not os.path.isdir(shm_dir):
+        return 0
+
+    removed = 0
+    for name in os.listdir(shm_dir):
+        parts = name.split('_')
+        if len(parts) != 3 or parts[0] != prefix or not parts[1].isdigit():
+            continue
+        pid = int(parts[1])
+        if pid == os.getpid() or _pid_alive(pid):
+            continue
+        try:
+            os.unlink(os.path.join(shm_dir, name))
+            removed += 1
+        except OSError:
+            continue
+
+    if removed:
+        logging.info(f"Removed {removed} orphaned shared memory segments")
+    return removed
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """Returns the process-wide registry, creating it on first use."""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = SharedArrayRegistry()
+            atexit.register(_registry.cleanup)
+        return _registry
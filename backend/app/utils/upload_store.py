@@ -0,0 +1,266 @@
+import os
+import re
+import glob
+import time
+import uuid
+import hashlib
+import logging
+import threading
+
+# Stored files are named <sha256 hex><extension>
+STORED_NAME_PATTERN = re.compile(r'^([0-9a-f]{64})(\.[a-z0-9]+)?$')
+
+
+def _extension(filename):
+    return os.path.splitext(filename)[1].lower()
+
+
+def hash_stream(stream, out=None, chunk_size=1024 * 1024):
+    """
+    Returns the SHA-256 hex digest of a stream, copying it to `out` on the way.
+
+    SHA-256 is used, rather than the result cache's blake2b, so clients can
+    compute the same key (e.g. with Web Crypto) before uploading anything.
+    """
+    hasher = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        hasher.update(chunk)
+        if out is not None:
+            out.write(chunk)
+    return hasher.hexdigest()
+
+
+class UploadStore:
+    """
+    Content-addressed store of uploaded files.
+
+    A file is kept once under its SHA-256 and extension, however often it is
+    uploaded. Jobs hold references on the files they read; files nobody
+    holds are evicted once unused for `ttl` seconds, or least recently used
+    first while the store is above `max_bytes`. Cache files that decoders
+    write next to a stored file (e.g. `<name>.page0.npy`) belong to it and
+    are counted and evicted with it, so repeated inputs are not decoded again
+    either.
+    """
+
+    def __init__(self, root, max_bytes=2 * 1024 ** 3, ttl=24 * 60 * 60):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._refs = {}  # path -> {owner: count}
+        self._last_used = {}  # path -> time of last put/lookup
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, digest, extension=''):
+        """Returns where the file with `digest` and `extension` is stored."""
+        return os.path.join(self.root, f"{digest}{extension.lower()}")
+
+    def _hold(self, path, owner):
+        # Caller holds the lock
+        self._last_used[path] = time.time()
+        if owner is not None:
+            owners = self._refs.setdefault(path, {})
+            owners[owner] = owners.get(owner, 0) + 1
+
+    def put(self, stream, filename, owner=None):
+        """
+        Stores the content of `stream` unless the same content is already
+        stored, in which case nothing is written.
+
+        Args:
+            stream: File-like object to read the content from.
+            filename (str): Original file name; only its extension is kept.
+            owner (str, optional): Job holding a reference until `release_owner`.
+
+        Returns:
+            str: Path of the stored file.
+        """
+        tmp_path = os.path.join(self.root, f".{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp_path, 'wb') as f:
+                digest = hash_stream(stream, out=f)
+            path = self.path_for(digest, _extension(filename))
+            with self._lock:
+                if os.path.exists(path):
+                    os.remove(tmp_path)
+                else:
+                    os.replace(tmp_path, path)
+                self._hold(path, owner)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return path
+
+    def put_file(self, file_storage, owner=None):
+        """Stores a Werkzeug `FileStorage` upload; see `put`."""
+        path = self.put(file_storage.stream, file_storage.filename, owner=owner)
+        file_storage.stream.seek(0)
+        return path
+
+    def adopt(self, source_path, filename, owner=None):
+        """
+        Moves a finished file (e.g. an assembled chunked upload) into the store.
+
+        Returns:
+            str: Path of the stored file.
+        """
+        with open(source_path, 'rb') as f:
+            digest = hash_stream(f)
+        path = self.path_for(digest, _extension(filename))
+        with self._lock:
+            if os.path.exists(path):
+                os.remove(source_path)
+            else:
+                os.replace(source_path, path)
+            self._hold(path, owner)
+        return path
+
+    def lookup(self, digest, extension='', owner=None):
+        """
+        Returns the stored path of `digest`, or None if it is not stored, so
+        a client can skip uploading content the server already has.
+        """
+        if not re.fullmatch(r'[0-9a-f]{64}', digest or ''):
+            return None
+        path = self.path_for(digest, extension)
+        with self._lock:
+            if not os.path.exists(path):
+                return None
+            self._hold(path, owner)
+        return path
+
+    def acquire(self, path, owner):
+        """Adds a reference of `owner` on a stored file."""
+        with self._lock:
+            self._hold(path, owner)
+
+    def release_owner(self, owner):
+        """Drops every reference held by `owner`."""
+        with self._lock:
+            for path in list(self._refs):
+                owners = self._refs[path]
+                if owners.pop(owner, None) is not None and not owners:
+                    del self._refs[path]
+
+    def _entries(self):
+        """
+        Yields (path, size including cache files, last used) for every stored file.
+        """
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if not STORED_NAME_PATTERN.match(name):
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            size = stat.st_size
+            for cache_path in glob.glob(f"{glob.escape(path)}.*"):
+                try:
+                    size += os.path.getsize(cache_path)
+                except OSError:
+                    pass
+            yield path, size, self._last_used.get(path, stat.st_mtime)
+
+    def _remove(self, path):
+        # Caller holds the lock
+        for cache_path in glob.glob(f"{glob.escape(path)}.*"):
+            try:
+                os.remove(cache_path)
+            except OSError:
+                pass
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        self._last_used.pop(path, None)
+
+    def evict(self, now=None):
+        """
+        Removes the files nobody holds that expired, then the least recently
+        used ones while the store is over its size quota.
+
+        Returns:
+            int: Number of files removed.
+        """
+        now = time.time() if now is None else now
+        removed = 0
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda entry: entry[2])
+            total = sum(size for _, size, _ in entries)
+            for path, size, last_used in entries:
+                expired = bool(self.ttl) and now - last_used > self.ttl
+                over_quota = bool(self.max_bytes) and total > self.max_bytes
+                if not (expired or over_quota) or path in self._refs:
+                    continue
+                self._remove(path)
+                total -= size
+                removed += 1
+        return removed
+
+    def total_bytes(self):
+        """Returns the size of the store, cache files included."""
+        with self._lock:
+            return sum(size for _, size, _ in self._entries())
+
+
+def sweep_stale_files(directory, ttl, now=None):
+    """
+    Removes the files in `directory` (not its subdirectories) that were not
+    modified for `ttl` seconds, e.g. abandoned chunked uploads.
+
+    Returns:
+        int: Number of files removed.
+    """
+    now = time.time() if now is None else now
+    removed = 0
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            if os.path.isfile(path) and now - os.path.getmtime(path) > ttl:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def start_janitor(store, interval, stale_dirs=(), sweepers=()):
+    """
+    Evicts from `store` every `interval` seconds on a daemon thread, and
+    removes files untouched for the store's TTL from `stale_dirs`. Each of
+    `sweepers` (callables returning how much they removed, e.g.
+    `ResultFiles.evict`) runs on the same schedule.
+
+    Returns:
+        threading.Event: Set it to stop the janitor.
+    """
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            try:
+                removed = store.evict()
+                for directory in stale_dirs:
+                    removed += sweep_stale_files(directory, store.ttl)
+                if removed:
+                    logging.info(f"Upload store: removed {removed} unused files")
+                for sweeper in sweepers:
+                    swept = sweeper()
+                    if swept:
+                        logging.info(f"Removed {swept} unused result directories")
+            except Exception:
+                logging.exception("Upload store eviction failed")
+
+    threading.Thread(target=run, name='upload-store-janitor', daemon=True).start()
+    return stop
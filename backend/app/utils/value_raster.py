@@ -0,0 +1,322 @@
+import os
+import json
+import math
+import threading
+from collections import OrderedDict
+import numpy as np
+from app.utils.vector_mask import rasterize_polygon
+
+VALUES_FILENAME = 'values.npy'
+VALUES_META_FILENAME = 'values.json'
+
+# Most samples returned for one line profile
+MAX_PROFILE_SAMPLES = 100_000
+
+
+def build_value_raster(segments, merged_df, mask=None):
+    """
+    Maps every pixel to the value assigned to its segment.
+
+    Args:
+        segments (numpy.ndarray): 2D segment labels (negative for unlabelled pixels).
+        merged_df (pandas.DataFrame): Merged per-segment table with 'Segment'
+            and 'Assigned_Value'; segments not in it were not analysed.
+        mask (numpy.ndarray, optional): Mask of the same shape; non-zero is inside.
+
+    Returns:
+        numpy.ndarray: float32 raster, NaN outside the analysed segments and the mask.
+    """
+    labels = merged_df['Segment'].to_numpy(dtype=np.int64)
+    max_label = max(int(segments.max()) if segments.size else 0, int(labels.max()) if labels.size else 0)
+    lookup = np.full(max_label + 2, np.nan, dtype=np.float32)
+    # Index 0 of the shifted table is for unlabelled (negative) pixels
+    lookup[labels + 1] = merged_df['Assigned_Value'].to_numpy(dtype=np.float32)
+    values = lookup[np.clip(segments, -1, None).astype(np.int64, copy=False) + 1]
+    if mask is not None:
+        values[np.asarray(mask) == 0] = np.nan
+    return values
+
+
+def write_value_raster(segments, merged_df, output_dir, mask=None, origin=(0, 0), image_shape=None):
+    """
+    Writes the value raster of an analysis into `output_dir` as a `.npy` that
+    `ValueRaster` memory-maps, with where it lies in the image next to it.
+
+    Args:
+        segments, merged_df, mask: See `build_value_raster`.
+        output_dir (str): Directory to write into (the analysis's export directory).
+        origin (tuple): (top, left) of the segmented crop in the image.
+        image_shape (tuple, optional): (height, width) of the image; the
+            raster's own shape if it was not cropped.
+
+    Returns:
+        str: Path of the raster.
+    """
+    values = build_value_raster(segments, merged_df, mask=mask)
+    image_shape = values.shape if image_shape is None else image_shape
+    meta = {'origin': [int(origin[0]), int(origin[1])], 'imageShape': [int(image_shape[0]), int(image_shape[1])]}
+    # The metadata goes first; the raster appearing means both are complete
+    meta_path = os.path.join(output_dir, VALUES_META_FILENAME)
+    with open(f"{meta_path}.tmp", 'w') as f:
+        json.dump(meta, f)
+    os.replace(f"{meta_path}.tmp", meta_path)
+    output_path = os.path.join(output_dir, VALUES_FILENAME)
+    tmp_path = f"{output_path}.tmp.npy"
+    np.save(tmp_path, values)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def _as_points(points, minimum):
+    points = np.asarray(points, dtype=np.float64)
+    if points.ndim != 2 or points.shape[1] != 2 or len(points) < minimum:
+        raise ValueError(f"Expected at least {minimum} [x, y] points")
+    if not np.isfinite(points).all():
+        raise ValueError('Points must have finite coordinates')
+    return points
+
+
+def _finite(value):
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+
+class ValueRaster:
+    """
+    The memory-mapped value raster of one analysis, answering point, line
+    profile and region queries in image pixel coordinates, with (0, 0) the
+    top-left corner of the top-left pixel as in `parse_mask_geometry`.
+
+    Rectangle statistics come from summed-area tables of the valid-pixel
+    count, the values and their squares, built on the first rectangle query,
+    so every later one reads four entries of each table whatever its size.
+    Values are taken relative to their mean in the tables to keep the
+    variance accurate.
+    """
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, VALUES_META_FILENAME)) as f:
+            meta = json.load(f)
+        self.values = np.load(os.path.join(directory, VALUES_FILENAME), mmap_mode='r')
+        self.top, self.left = meta['origin']
+        self.image_shape = tuple(meta['imageShape'])
+        self._tables = None
+        self._lock = threading.Lock()
+
+    @property
+    def table_bytes(self):
+        """Memory the summed-area tables take once built."""
+        height, width = self.values.shape
+        return (height + 1) * (width + 1) * (4 + 8 + 8)
+
+    def _check_inside_image(self, points):
+        height, width = self.image_shape
+        if (points < 0).any() or (points[:, 0] > width).any() or (points[:, 1] > height).any():
+            raise ValueError(f'Points must lie within the {width}x{height} image')
+
+    def _sample(self, x, y):
+        # Nearest pixel: pixel (i, j) covers [j, j + 1) x [i, i + 1)
+        height, width = self.values.shape
+        rows = np.floor(y).astype(np.int64) - self.top
+        cols = np.floor(x).astype(np.int64) - self.left
+        inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+        samples = np.full(rows.shape, np.nan, dtype=np.float32)
+        samples[inside] = self.values[rows[inside], cols[inside]]
+        return samples
+
+    def point(self, x, y):
+        """
+        Returns the value of the pixel at (x, y), or None where nothing was
+        analysed.
+
+        Raises:
+            ValueError: If the point is outside the image.
+        """
+        points = _as_points([[x, y]], 1)
+        self._check_inside_image(points)
+        return _finite(self._sample(points[:, 0], points[:, 1])[0])
+
+    def profile(self, points, step=1.0):
+        """
+        Samples the values every `step` pixels along a polyline.
+
+        Returns:
+            dict: 'distance' along the line, 'x', 'y' and 'value' of every
+            sample (None where nothing was analysed) and the 'length' of the line.
+
+        Raises:
+            ValueError: If the polyline is malformed, leaves the image or
+                needs more than MAX_PROFILE_SAMPLES samples.
+        """
+        points = _as_points(points, 2)
+        self._check_inside_image(points)
+        if not step > 0:
+            raise ValueError('The profile step must be positive')
+        cumulative = np.concatenate([[0.0], np.cumsum(np.hypot(*np.diff(points, axis=0).T))])
+        length = float(cumulative[-1])
+        count = int(length // step) + 1
+        if count > MAX_PROFILE_SAMPLES:
+            raise ValueError(f'A profile may have at most {MAX_PROFILE_SAMPLES} samples; use a larger step')
+        distance = np.arange(count) * step
+        if length - distance[-1] > 1e-9:
+            distance = np.append(distance, length)
+        x = np.interp(distance, cumulative, points[:, 0])
+        y = np.interp(distance, cumulative, points[:, 1])
+        values = self._sample(x, y)
+        return {
+            'length': length,
+            'distance': distance.tolist(),
+            'x': x.tolist(),
+            'y': y.tolist(),
+            'value': [_finite(value) for value in values],
+        }
+
+    def _summed_area_tables(self):
+        with self._lock:
+            if self._tables is None:
+                values = np.asarray(self.values, dtype=np.float64)
+                valid = np.isfinite(values)
+                offset = float(values[valid].mean()) if valid.any() else 0.0
+                centred = np.where(valid, values - offset, 0.0)
+                tables = []
+                for array, dtype in ((valid, np.int32), (centred, np.float64), (centred * centred, np.float64)):
+                    table = np.zeros((array.shape[0] + 1, array.shape[1] + 1), dtype=dtype)
+                    np.cumsum(array, axis=0, dtype=dtype, out=table[1:, 1:])
+                    np.cumsum(table[1:, 1:], axis=1, dtype=dtype, out=table[1:, 1:])
+                    tables.append(table)
+                self._tables = (offset, *tables)
+            return self._tables
+
+    def drop_tables(self):
+        """Frees the summed-area tables; they are rebuilt when needed."""
+        with self._lock:
+            self._tables = None
+
+    def _window(self, x0, y0, x1, y1):
+        # Raster rows and columns whose pixel centres lie in [x0, x1) x [y0, y1)
+        height, width = self.values.shape
+        top = min(max(math.ceil(y0 - 0.5) - self.top, 0), height)
+        bottom = min(max(math.ceil(y1 - 0.5) - self.top, top), height)
+        left = min(max(math.ceil(x0 - 0.5) - self.left, 0), width)
+        right = min(max(math.ceil(x1 - 0.5) - self.left, left), width)
+        return top, bottom, left, right
+
+    @staticmethod
+    def _statistics(count, area, mean, variance):
+        if count == 0:
+            return {'count': 0, 'area': int(area), 'coverage': 0.0, 'mean': None, 'std': None}
+        return {
+            'count': int(count),
+            'area': int(area),
+            'coverage': count / area,
+            'mean': float(mean),
+            'std': math.sqrt(max(float(variance), 0.0)),
+        }
+
+    def rectangle(self, x, y, width, height, use_tables=True):
+        """
+        Statistics of the values of the pixels whose centres lie in the
+        rectangle: 'count' of pixels with a value, 'area' in pixels,
+        'coverage' (count / area), 'mean' and 'std'.
+
+        Without `use_tables` the pixels are read directly instead of
+        building the summed-area tables (see `ValueRasterStore.fits_tables`).
+        """
+        if not (width > 0 and height > 0):
+            raise ValueError('A rectangle needs a positive width and height')
+        self._check_inside_image(_as_points([[x, y], [x + width, y + height]], 2))
+        top, bottom, left, right = self._window(x, y, x + width, y + height)
+        # The whole rectangle, also where it reaches outside the analysed crop
+        area = max((math.ceil(y + height - 0.5) - math.ceil(y - 0.5))
+                   * (math.ceil(x + width - 0.5) - math.ceil(x - 0.5)), 1)
+
+        if not use_tables:
+            values = np.asarray(self.values[top:bottom, left:right], dtype=np.float64)
+            return self._direct_statistics(values[np.isfinite(values)], area)
+
+        offset, count_table, sum_table, square_table = self._summed_area_tables()
+
+        def total(table):
+            return table[bottom, right] - table[top, right] - table[bottom, left] + table[top, left]
+
+        count = int(total(count_table))
+        if count == 0:
+            return self._statistics(0, area, None, None)
+        mean = total(sum_table) / count
+        return self._statistics(count, area, offset + mean, total(square_table) / count - mean * mean)
+
+    def _direct_statistics(self, values, area):
+        if not values.size:
+            return self._statistics(0, area, None, None)
+        return self._statistics(values.size, max(area, values.size), values.mean(), values.var())
+
+    def polygon(self, points):
+        """Statistics of the values inside a polygon; see `rectangle`."""
+        points = _as_points(points, 3)
+        self._check_inside_image(points)
+        x0, y0 = points.min(axis=0)
+        x1, y1 = points.max(axis=0)
+        top, bottom, left, right = self._window(x0, y0, x1, y1)
+        # Pixels of the polygon, over the whole image, for the area
+        image_window = (math.floor(y0), math.ceil(y1), math.floor(x0), math.ceil(x1))
+        area = int(np.count_nonzero(rasterize_polygon(points, image_window)))
+
+        window = (top + self.top, bottom + self.top, left + self.left, right + self.left)
+        inside = rasterize_polygon(points, window)
+        values = np.asarray(self.values[top:bottom, left:right])[inside].astype(np.float64)
+        return self._direct_statistics(values[np.isfinite(values)], max(area, 1))
+
+
+class ValueRasterStore:
+    """
+    LRU of the value rasters being queried, keyed by export directory. Rasters
+    stay memory-mapped; the summed-area tables of the least recently used are
+    dropped while they take more than `max_table_bytes`.
+    """
+
+    def __init__(self, max_open=32, max_table_bytes=256 * 1024 * 1024):
+        self.max_open = max_open
+        self.max_table_bytes = max_table_bytes
+        self._rasters = OrderedDict()  # export directory -> ValueRaster
+        self._lock = threading.Lock()
+
+    def get(self, directory):
+        """
+        Returns the raster written into `directory`, or None if there is none.
+        """
+        with self._lock:
+            raster = self._rasters.get(directory)
+            if raster is not None:
+                self._rasters.move_to_end(directory)
+                return raster
+        if not os.path.exists(os.path.join(directory, VALUES_FILENAME)):
+            return None
+        raster = ValueRaster(directory)
+        with self._lock:
+            raster = self._rasters.setdefault(directory, raster)
+            self._rasters.move_to_end(directory)
+            while len(self._rasters) > self.max_open:
+                self._rasters.popitem(last=False)
+        return raster
+
+    def discard(self, directory):
+        """Forgets the raster of `directory`, e.g. once the directory was removed."""
+        with self._lock:
+            self._rasters.pop(directory, None)
+
+    def fits_tables(self, raster):
+        """
+        Whether `raster` may build its summed-area tables, dropping other
+        rasters' tables to make room if needed.
+        """
+        if raster.table_bytes > self.max_table_bytes:
+            return False
+        with self._lock:
+            others = [r for r in self._rasters.values() if r is not raster and r._tables is not None]
+            total = raster.table_bytes + sum(r.table_bytes for r in others)
+            for other in others:
+                if total <= self.max_table_bytes:
+                    break
+                other.drop_tables()
+                total -= other.table_bytes
+        return True
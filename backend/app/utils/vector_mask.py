@@ -0,0 +1,198 @@
+import json
+import cv2
+import numpy as np
+
+# Shape types accepted in a mask geometry
+SHAPE_TYPES = ('polygon', 'rectangle', 'stroke')
+
+# Fractional bits of the fixed-point vertices passed to OpenCV (1/16 pixel)
+SUBPIXEL_BITS = 4
+
+# Most vertices accepted in one geometry, to bound the work a request can cause
+MAX_VERTICES = 1_000_000
+
+
+def _points(shape, minimum):
+    points = np.asarray(shape.get('points', []), dtype=np.float64)
+    if points.ndim != 2 or points.shape[1] != 2 or len(points) < minimum:
+        raise ValueError(f"A {shape['type']} needs at least {minimum} [x, y] points")
+    if not np.isfinite(points).all():
+        raise ValueError('Mask geometry has non-finite coordinates')
+    return points
+
+
+def parse_mask_geometry(text, labels=False):
+    """
+    Parses and validates a mask geometry sent instead of a mask image.
+
+    The geometry is JSON of the form::
+
+        {"width": 1200, "height": 800, "shapes": [
+            {"type": "polygon", "points": [[x, y], ...]},
+            {"type": "rectangle", "x": 10, "y": 20, "width": 300, "height": 200},
+            {"type": "stroke", "points": [[x, y], ...], "width": 12},
+            {"type": "polygon", "points": [...], "operation": "subtract"}
+        ]}
+
+    in image pixel coordinates, with (0, 0) the top-left corner of the
+    top-left pixel, as on an HTML canvas. Shapes are drawn in order; a
+    'subtract' shape erases what earlier shapes covered. With `labels`,
+    every shape carries an integer 'label' (1-65535) that marks its region.
+
+    Args:
+        text (str): JSON text of the geometry.
+        labels (bool): Whether the geometry describes a label-valued mask.
+
+    Returns:
+        dict: The geometry, with 'points' as float arrays.
+
+    Raises:
+        ValueError: If the geometry is malformed.
+    """
+    try:
+        geometry = json.loads(text)
+        width, height = int(geometry['width']), int(geometry['height'])
+        shapes = geometry['shapes']
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError(f'Invalid mask geometry: {e}')
+    if width <= 0 or height <= 0:
+        raise ValueError('Mask geometry must have a positive width and height')
+    if not isinstance(shapes, list) or not shapes:
+        raise ValueError('Mask geometry has no shapes')
+
+    parsed = []
+    vertices = 0
+    for shape in shapes:
+        if not isinstance(shape, dict) or shape.get('type') not in SHAPE_TYPES:
+            raise ValueError(f"Unknown mask shape type; expected one of {', '.join(SHAPE_TYPES)}")
+        operation = shape.get('operation', 'add')
+        if operation not in ('add', 'subtract'):
+            raise ValueError(f'Unknown mask shape operation: {operation}')
+        entry = {'type': shape['type'], 'operation': operation}
+
+        try:
+            if shape['type'] == 'polygon':
+                entry['points'] = _points(shape, 3)
+            elif shape['type'] == 'stroke':
+                entry['points'] = _points(shape, 1)
+                entry['width'] = float(shape['width'])
+                if not entry['width'] > 0:
+                    raise ValueError('A stroke needs a positive width')
+            else:
+                x, y = float(shape['x']), float(shape['y'])
+                w, h = float(shape['width']), float(shape['height'])
+                entry['points'] = np.array([[x, y], [x + w, y], [x + w, y + h], [x, y + h]])
+            if labels and operation == 'add':
+                entry['label'] = int(shape['label'])
+                if not 1 <= entry['label'] <= 65535:
+                    raise ValueError('Shape labels must be between 1 and 65535')
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Invalid {shape['type']} in mask geometry: {e}")
+
+        vertices += len(entry['points'])
+        if vertices > MAX_VERTICES:
+            raise ValueError(f'Mask geometry has more than {MAX_VERTICES} vertices')
+        parsed.append(entry)
+
+    return {'width': width, 'height': height, 'shapes': parsed}
+
+
+def canonical_geometry(geometry):
+    """Returns a stable text form of a parsed geometry, for content hashing."""
+    shapes = [
+        {key: value.tolist() if isinstance(value, np.ndarray) else value for key, value in shape.items()}
+        for shape in geometry['shapes']
+    ]
+    return json.dumps({'width': geometry['width'], 'height': geometry['height'], 'shapes': shapes},
+                      sort_keys=True, separators=(',', ':'))
+
+
+def geometry_bounding_box(geometry, margin=0):
+    """
+    Returns the bounding box of the added shapes from their vertices alone,
+    without rasterizing; like `mask_bounding_box` it may be a little larger
+    than the filled pixels (e.g. where a subtract shape trims an edge).
+
+    Returns:
+        tuple or None: (top, bottom, left, right) as slice bounds clamped to
+        the image, or None if no shape is added.
+    """
+    boxes = []
+    for shape in geometry['shapes']:
+        if shape['operation'] != 'add':
+            continue
+        points = shape['points']
+        reach = shape.get('width', 0) / 2
+        boxes.append((points[:, 1].min() - reach, points[:, 1].max() + reach,
+                      points[:, 0].min() - reach, points[:, 0].max() + reach))
+    if not boxes:
+        return None
+    boxes = np.array(boxes)
+    height, width = geometry['height'], geometry['width']
+    top = max(int(np.floor(boxes[:, 0].min())) - margin, 0)
+    bottom = min(int(np.ceil(boxes[:, 1].max())) + margin, height)
+    left = max(int(np.floor(boxes[:, 2].min())) - margin, 0)
+    right = min(int(np.ceil(boxes[:, 3].max())) + margin, width)
+    if top >= bottom or left >= right:
+        return None
+    return top, bottom, left, right
+
+
+def _fixed_point(points):
+    # Canvas coordinates put pixel centres at +0.5; OpenCV puts them at integers
+    return np.round((points - 0.5) * (1 << SUBPIXEL_BITS)).astype(np.int32).reshape(-1, 1, 2)
+
+
+def rasterize_mask(geometry, labels=False):
+    """
+    Rasterizes a mask geometry with OpenCV's scanline polygon fill, once, at
+    the size it declares.
+
+    Args:
+        geometry (dict): Result of `parse_mask_geometry`.
+        labels (bool): Fill every shape with its 'label' instead of 255.
+
+    Returns:
+        numpy.ndarray: (height, width) mask, uint8 with 255 inside, or uint16
+        labels with 0 outside every region when `labels` is set.
+    """
+    mask = np.zeros((geometry['height'], geometry['width']), dtype=np.uint16 if labels else np.uint8)
+    for shape in geometry['shapes']:
+        if shape['operation'] == 'subtract':
+            value = 0
+        else:
+            value = shape['label'] if labels else 255
+        points = _fixed_point(shape['points'])
+
+        if shape['type'] == 'stroke':
+            thickness = max(int(round(shape['width'])), 1)
+            if len(points) > 1:
+                cv2.polylines(mask, [points], False, value, thickness=thickness,
+                              lineType=cv2.LINE_8, shift=SUBPIXEL_BITS)
+            # Round caps and joints, as a canvas brush with lineCap 'round'
+            radius = int(round(shape['width'] / 2 * (1 << SUBPIXEL_BITS)))
+            for x, y in points[:, 0]:
+                cv2.circle(mask, (int(x), int(y)), radius, value, thickness=-1,
+                           lineType=cv2.LINE_8, shift=SUBPIXEL_BITS)
+        else:
+            cv2.fillPoly(mask, [points], value, lineType=cv2.LINE_8, shift=SUBPIXEL_BITS)
+    return mask
+
+
+def rasterize_polygon(points, window):
+    """
+    Rasterizes one polygon in image coordinates into a window of the image,
+    with the same pixel-centre rule as `rasterize_mask`.
+
+    Args:
+        points (numpy.ndarray): (N, 2) float vertices.
+        window (tuple): (top, bottom, left, right) of the window in the image.
+
+    Returns:
+        numpy.ndarray: Boolean array of the window's size, True inside.
+    """
+    top, bottom, left, right = window
+    mask = np.zeros((max(bottom - top, 0), max(right - left, 0)), dtype=np.uint8)
+    if mask.size:
+        cv2.fillPoly(mask, [_fixed_point(points - [left, top])], 1, lineType=cv2.LINE_8, shift=SUBPIXEL_BITS)
+    return mask.view(bool)
@@ -0,0 +1,339 @@
+import atexit
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future
+import numpy as np
+from app.utils.shared_arrays import get_registry, attach_shared_array
+from app.utils.concurrency import limit_native_threads
+from app.utils.image_segmentation.felzenszwalb_segmentation import felzenszwalb_segment_array, smallest_unsigned_dtype
+from app.utils.sequence_analysis import analyze_sequence
+
+# Seconds between checks of a running task's job (cancellation, time limit, client)
+POLL_INTERVAL = 0.1
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class WorkerDied(RuntimeError):
+    """Raised when a worker process exits while running a task."""
+
+
+def _limit_memory(limit):
+    """Caps the address space of this process; POSIX only."""
+    try:
+        import resource
+    except ImportError:
+        logging.warning("Per-worker memory limits are not supported on this platform")
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def _worker_main(conn, threads, memory_limit):
+    """Runs (function, args) tasks received on `conn` until it is closed."""
+    if threads:
+        limit_native_threads(threads)
+    if memory_limit:
+        _limit_memory(memory_limit)
+    while True:
+        try:
+            fn, args = conn.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            result = (True, fn(*args))
+        except BaseException as e:
+            result = (False, e)
+        try:
+            conn.send(result)
+        except Exception as e:
+            conn.send((False, RuntimeError(f"Could not return the result of {fn.__name__}: {e}")))
+
+
+class _Worker:
+    def __init__(self, context, threads, memory_limit):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn, threads, memory_limit), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join(timeout=1)
+        self.conn.close()
+
+
+class WorkerPool:
+    """
+    Worker processes that run one task each at a time, so a task can be
+    stopped by killing its worker without disturbing the others.
+
+    `concurrent.futures.ProcessPoolExecutor` cannot do that: it has no way to
+    stop a running task, and a worker that dies breaks the whole pool. Here a
+    killed or crashed worker is simply replaced by a fresh one on demand.
+
+    Workers are started with 'spawn' on every platform so they never inherit
+    the server's threads or locks. Each caps its OpenCV and BLAS threads to
+    `threads` (see `limit_native_threads`) and its address space to
+    `memory_limit` bytes.
+    """
+
+    def __init__(self, max_workers, threads=None, memory_limit=None):
+        self.max_workers = max_workers
+        self.threads = threads
+        self.memory_limit = memory_limit
+        self._context = multiprocessing.get_context('spawn')
+        self._idle = []
+        self._count = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def _acquire(self, job):
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError('Worker pool is shut down')
+                while self._idle:
+                    worker = self._idle.pop()
+                    if worker.process.is_alive():
+                        return worker
+                    # Died while idle (e.g. killed from outside)
+                    self._count -= 1
+                    worker.conn.close()
+                if self._count < self.max_workers:
+                    break
+                self._condition.wait(timeout=POLL_INTERVAL)
+                if job is not None:
+                    job.check()
+            self._count += 1
+        try:
+            return _Worker(self._context, self.threads, self.memory_limit)
+        except BaseException:
+            self._discard(None)
+            raise
+
+    def _release(self, worker):
+        with self._condition:
+            if not self._closed:
+                self._idle.append(worker)
+                self._condition.notify()
+                return
+        self._discard(worker)
+
+    def _discard(self, worker):
+        with self._condition:
+            self._count -= 1
+            self._condition.notify()
+        if worker is not None:
+            worker.kill()
+
+    def _run_on(self, worker, fn, args, job):
+        # The worker is released or discarded before returning
+        try:
+            worker.conn.send((fn, args))
+            while not worker.conn.poll(POLL_INTERVAL):
+                if not worker.process.is_alive():
+                    break
+                if job is not None:
+                    job.check()
+            try:
+                ok, value = worker.conn.recv()
+            except (EOFError, OSError):
+                worker.process.join(timeout=1)
+                raise WorkerDied(
+                    f"Analysis worker exited with code {worker.process.exitcode} (possibly out of memory)"
+                )
+        except BaseException:
+            # Cancelled, timed out or crashed: free the process and its memory now
+            self._discard(worker)
+            raise
+
+        if isinstance(value, MemoryError):
+            # The worker's heap may be fragmented; start afresh next time
+            self._discard(worker)
+            raise MemoryError('Analysis exceeded the per-job memory limit')
+        self._release(worker)
+        if not ok:
+            raise value
+        return value
+
+    def run(self, fn, *args, job=None):
+        """
+        Runs `fn(*args)` in a worker process and returns its result.
+
+        While it runs, `job` is checked every POLL_INTERVAL seconds; if it
+        should stop, the worker is killed and `JobCancelled` is raised.
+
+        Raises:
+            JobCancelled: If `job` was cancelled or ran out of time.
+            MemoryError: If the task exceeded the worker's memory limit.
+            WorkerDied: If the worker process exited, e.g. killed for memory.
+        """
+        return self._run_on(self._acquire(job), fn, args, job)
+
+    def submit(self, fn, *args, job=None):
+        """
+        Like `run`, but returns a `concurrent.futures.Future` at once. A
+        future cancelled before a worker is free never starts.
+        """
+        future = Future()
+
+        def target():
+            try:
+                worker = self._acquire(job)
+            except BaseException as e:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+                return
+            if not future.set_running_or_notify_cancel():
+                self._release(worker)
+                return
+            try:
+                future.set_result(self._run_on(worker, fn, args, job))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=target, daemon=True).start()
+        return future
+
+    def bind(self, job):
+        """Returns an executor whose `submit` runs tasks on behalf of `job`."""
+        return _JobExecutor(self, job)
+
+    def shutdown(self):
+        """Stops the idle workers; busy ones are stopped when their task ends."""
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._count -= len(idle)
+            self._condition.notify_all()
+        for worker in idle:
+            worker.kill()
+
+
+class _JobExecutor:
+    def __init__(self, pool, job):
+        self.pool = pool
+        self.job = job
+
+    def submit(self, fn, *args):
+        return self.pool.submit(fn, *args, job=self.job)
+
+
+def get_worker_pool(max_workers, threads=None, memory_limit=None):
+    """
+    Returns the shared analysis worker pool, (re)creating it if its settings changed.
+    """
+    global _pool
+    with _pool_lock:
+        settings = (max_workers, threads, memory_limit)
+        if _pool is None or (_pool.max_workers, _pool.threads, _pool.memory_limit) != settings:
+            if _pool is not None:
+                _pool.shutdown()
+            _pool = WorkerPool(max_workers, threads=threads, memory_limit=memory_limit)
+        return _pool
+
+
+def shutdown_worker_pool():
+    """Stops the worker processes."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+
+
+atexit.register(shutdown_worker_pool)
+
+
+def segment_shared(image_spec, mask_spec, out_spec, scale, sigma, min_size, memory_lean):
+    """
+    Worker entry point: attaches to the shared image, mask and output label
+    buffers by name, segments in place and returns the largest label.
+
+    The image buffer ends up holding the segmentation input (background
+    painted over), exactly as the in-process path leaves it.
+    """
+    with attach_shared_array(image_spec) as image, attach_shared_array(mask_spec) as mask, \
+            attach_shared_array(out_spec) as out:
+        segments, _ = felzenszwalb_segment_array(image, mask, scale, sigma, min_size, memory_lean=memory_lean)
+        max_label = int(segments.max()) if segments.size else 0
+        if max_label > np.iinfo(out.dtype).max:
+            raise ValueError(f"{max_label} segments do not fit the {out.dtype} label buffer")
+        out[...] = segments
+        del segments, image, mask, out
+    return max_label
+
+
+def _label_dtype(pixels, min_size, memory_lean):
+    """
+    Dtype of the shared label buffer, chosen before the labels exist: with
+    `memory_lean` the smallest that holds every segment, of which there are
+    at most one per `min_size` pixels; uint32 otherwise or when that is wider.
+    """
+    if not memory_lean:
+        return np.dtype(np.uint32)
+    dtype = smallest_unsigned_dtype(pixels // max(int(min_size), 1) + 1)
+    return dtype if dtype.itemsize < 4 else np.dtype(np.uint32)
+
+
+def run_segmentation_in_worker(image, mask, scale, sigma, min_size, memory_lean, job, max_workers,
+                               threads=None, memory_limit=None):
+    """
+    Runs `felzenszwalb_segment_array` in a worker process, handing the image,
+    mask and resulting labels over through shared memory instead of pickling.
+
+    The buffers belong to `job.id`; call `get_registry().release_owner(job.id)`
+    when the job is done (the returned arrays are views into them). If the
+    job is cancelled or runs out of time, the worker is killed at once.
+
+    Args:
+        image (numpy.ndarray): uint8 RGB image.
+        mask (numpy.ndarray): Boolean mask of the region to segment.
+        scale, sigma, min_size: Felzenszwalb parameters.
+        memory_lean (bool): See `felzenszwalb_segment_array`.
+        job (Job): The analysis this segmentation belongs to.
+        max_workers (int): Size of the worker pool.
+        threads (int, optional): Native threads per worker.
+        memory_limit (int, optional): Address space per worker in bytes.
+
+    Returns:
+        tuple: (segments view, segmentation input view, SharedArraySpec of the segments).
+    """
+    registry = get_registry()
+    image_spec, image_view = registry.share(image, owner=job.id)
+    mask_spec, _ = registry.share(np.asarray(mask, dtype=bool), owner=job.id)
+    out_spec, segments = registry.create(mask.shape, _label_dtype(mask.size, min_size, memory_lean), owner=job.id)
+
+    pool = get_worker_pool(max_workers, threads=threads, memory_limit=memory_limit)
+    try:
+        pool.run(segment_shared, image_spec, mask_spec, out_spec, scale, sigma, min_size, memory_lean, job=job)
+    except WorkerDied:
+        logging.error(f"Analysis worker crashed while processing job {job.id}")
+        raise
+
+    return segments, image_view, out_spec
+
+
+def run_sequence_in_workers(frames, mask, color_table, memory_lean, job, max_workers, threads=None, memory_limit=None):
+    """
+    Runs `analyze_sequence` with the frames spread over the worker pool; each
+    cropped frame is handed over through shared memory. Cancelling `job`
+    kills the workers of its frames in flight.
+
+    Returns:
+        list: See `analyze_sequence`.
+    """
+    pool = get_worker_pool(max_workers, threads=threads, memory_limit=memory_limit)
+    try:
+        return analyze_sequence(frames, mask, color_table, memory_lean=memory_lean, pool=pool.bind(job),
+                                max_pending=2 * max_workers, job_id=job.id, job=job)
+    except WorkerDied:
+        logging.error(f"Analysis worker crashed while processing job {job.id}")
+        raise
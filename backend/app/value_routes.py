@@ -0,0 +1,110 @@
+from flask import Blueprint, request, jsonify, current_app
+import os
+from werkzeug.utils import secure_filename
+from app.utils.value_raster import VALUES_FILENAME
+from app.utils.binary_frame import FRAME_MIMETYPE, encode_frame
+from app.utils.wait_for_file import wait_for_file
+
+values_bp = Blueprint('values', __name__)
+
+
+def _value_raster(result_id):
+    """
+    Returns the value raster of a previous single-mask analysis, waiting for
+    it to be written like the exports, or None if there is none.
+    """
+    export_dir = os.path.join(current_app.config['RESULT_FILES_FOLDER'], secure_filename(result_id))
+    if not os.path.isdir(export_dir) or not wait_for_file(os.path.join(export_dir, VALUES_FILENAME), timeout=30):
+        return None
+    current_app.extensions['result_files'].touch(secure_filename(result_id))
+    return current_app.extensions['value_rasters'].get(export_dir)
+
+
+def _not_found():
+    return jsonify({'error': 'Values not found for this result'}), 404
+
+
+@values_bp.route('/results/<result_id>/values', methods=['GET'])
+def raster_query(result_id):
+    """
+    Returns the whole float32 value raster (NaN where nothing was analysed)
+    as a binary frame (see `encode_frame`), with its 'origin' and the
+    'imageShape' it is placed in as metadata.
+    """
+    raster = _value_raster(result_id)
+    if raster is None:
+        return _not_found()
+    meta = {'origin': [raster.top, raster.left], 'imageShape': list(raster.image_shape)}
+    return current_app.response_class(encode_frame(meta, {'values': raster.values}), mimetype=FRAME_MIMETYPE)
+
+
+@values_bp.route('/results/<result_id>/values/point', methods=['GET'])
+def point_query(result_id):
+    """
+    Returns the value at image pixel coordinates ?x=&y= (null where nothing
+    was analysed).
+    """
+    try:
+        x, y = float(request.args['x']), float(request.args['y'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Query parameters x and y are required'}), 400
+
+    raster = _value_raster(result_id)
+    if raster is None:
+        return _not_found()
+    try:
+        value = raster.point(x, y)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'x': x, 'y': y, 'value': value})
+
+
+@values_bp.route('/results/<result_id>/values/profile', methods=['POST'])
+def profile_query(result_id):
+    """
+    Samples the values along a polyline.
+
+    Body (JSON): 'points' as [[x, y], ...] in image pixels and an optional
+    'step' between samples (1 pixel by default).
+    """
+    data = request.get_json(silent=True) or {}
+    raster = _value_raster(result_id)
+    if raster is None:
+        return _not_found()
+    try:
+        profile = raster.profile(data.get('points', []), step=float(data.get('step', 1.0)))
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(profile)
+
+
+@values_bp.route('/results/<result_id>/values/region', methods=['POST'])
+def region_query(result_id):
+    """
+    Returns count, area, coverage, mean and standard deviation of the values
+    in a region.
+
+    Body (JSON): either 'rectangle' as {x, y, width, height} or 'polygon' as
+    [[x, y], ...], in image pixels.
+    """
+    data = request.get_json(silent=True) or {}
+    if ('rectangle' in data) == ('polygon' in data):
+        return jsonify({'error': "Give either a 'rectangle' or a 'polygon'"}), 400
+
+    raster = _value_raster(result_id)
+    if raster is None:
+        return _not_found()
+    try:
+        if 'polygon' in data:
+            statistics = raster.polygon(data['polygon'])
+        else:
+            rectangle = data['rectangle']
+            statistics = raster.rectangle(
+                float(rectangle['x']), float(rectangle['y']), float(rectangle['width']), float(rectangle['height']),
+                use_tables=current_app.extensions['value_rasters'].fits_tables(raster),
+            )
+    except (KeyError, TypeError) as e:
+        return jsonify({'error': f'Invalid region: {e}'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(statistics)
@@ -0,0 +1,316 @@
+"""
+Headless batch analysis of image directories.
+
+Runs the same analysis as `/calculate-average` over many images in a process
+pool, without Flask:
+
+    python batch.py results/ images/*.png --mask mask.png --top 1e20 --bottom 1e14
+    python batch.py results/ images/ --mask masks/ --top 100 --bottom 1 --per-image
+
+One row per image is appended to `<output>/summary.csv` as soon as the image
+finishes, so an interrupted run picks up where it stopped when started again
+with the same arguments.
+"""
+import os
+import sys
+import csv
+import glob
+import json
+import time
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from app import Config
+from app.utils.file_utils import allowed_file
+from app.utils.image_io import open_image_lazy, load_mask
+from app.utils.analysis import analyze_image, ENGINE_PARAMS
+from app.utils.color_map.color_map_segmentation import calibrate_color_map
+from app.utils.export_results import export_results
+from app.utils.concurrency import limit_native_threads
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_FILENAME = 'summary.csv'
+RUN_FILENAME = 'run.json'
+SUMMARY_COLUMNS = [
+    'image', 'mask', 'average', 'num_segments', 'min_value', 'max_value',
+    'mean', 'median', 'mode', 'total_pixels', 'seconds', 'error',
+]
+
+# Set once per worker process by `_init_worker`
+_worker_state = {}
+
+
+def collect_images(inputs):
+    """
+    Expands directories and glob patterns into a sorted list of image paths.
+
+    Args:
+        inputs (list): Directories, glob patterns or file paths.
+
+    Returns:
+        list: Absolute paths of the supported images, without duplicates.
+    """
+    paths = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = [os.path.join(item, name) for name in os.listdir(item)]
+        else:
+            candidates = glob.glob(item)
+        paths.update(os.path.abspath(p) for p in candidates if os.path.isfile(p) and allowed_file(p))
+    return sorted(paths)
+
+
+def resolve_mask(image_path, mask_arg):
+    """
+    Returns the mask for an image: `mask_arg` itself if it is a file, otherwise
+    the file in the `mask_arg` directory named like the image (`<stem>.*` or
+    `<stem>_mask.*`). Returns None if there is no such file.
+    """
+    if os.path.isfile(mask_arg):
+        return os.path.abspath(mask_arg)
+
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    for candidate in sorted(glob.glob(os.path.join(glob.escape(mask_arg), f"{glob.escape(stem)}*"))):
+        candidate_stem = os.path.splitext(os.path.basename(candidate))[0]
+        if candidate_stem in (stem, f"{stem}_mask") and allowed_file(candidate):
+            return os.path.abspath(candidate)
+    return None
+
+
+def output_names(image_paths):
+    """
+    Names the per-image output directories after the image stems, numbering
+    repeated stems so images from different directories do not collide.
+    """
+    names = {}
+    seen = {}
+    for path in image_paths:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        count = seen.get(stem, 0)
+        seen[stem] = count + 1
+        names[path] = stem if count == 0 else f"{stem}-{count}"
+    return names
+
+
+def read_summary(summary_path):
+    """
+    Loads the rows of an existing summary table keyed by image path; later rows
+    for the same image win.
+    """
+    if not os.path.exists(summary_path):
+        return {}
+    with open(summary_path, newline='') as f:
+        return {row['image']: row for row in csv.DictReader(f)}
+
+
+def write_summary(summary_path, rows):
+    """
+    Rewrites the summary table atomically with `rows` in the given order.
+    """
+    tmp_path = f"{summary_path}.tmp"
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(tmp_path, summary_path)
+
+
+def _init_worker(color_table, memory_lean, threads=None):
+    """
+    Keeps the calibrated colour map in the worker so it is sent only once, and
+    caps the worker's native threads so the workers do not oversubscribe the CPU.
+    """
+    if threads:
+        limit_native_threads(threads)
+    _worker_state['color_table'] = color_table
+    _worker_state['memory_lean'] = memory_lean
+
+
+def analyze_file(image_path, mask_path, page=0, output_dir=None):
+    """
+    Analyses one image with the colour map set up by `_init_worker`.
+
+    Args:
+        image_path (str): Image to analyse.
+        mask_path (str): Mask of the region to analyse, same size as the image.
+        page (int): TIFF page to analyse.
+        output_dir (str, optional): Directory for the per-image outputs (merged
+            segment table as CSV plus the binary exports).
+
+    Returns:
+        dict: Summary row; 'error' is set instead of the results if the image failed.
+    """
+    start = time.time()
+    row = dict.fromkeys(SUMMARY_COLUMNS, '')
+    row.update({'image': image_path, 'mask': mask_path or ''})
+
+    try:
+        if mask_path is None:
+            raise FileNotFoundError("No mask found for image")
+
+        analysis = analyze_image(
+            open_image_lazy(image_path, page=page), load_mask(mask_path),
+            _worker_state['color_table'], memory_lean=_worker_state['memory_lean'],
+        )
+        results = analysis['results']
+        stats = results['stats']
+        row.update({
+            'average': results['average'],
+            'num_segments': stats['numSegments'],
+            'min_value': stats['minAssignedValue'],
+            'max_value': stats['maxAssignedValue'],
+            'mean': stats['mean'],
+            'median': stats['median'],
+            'mode': stats['mode'],
+            'total_pixels': stats['totalPixel'],
+        })
+
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+            analysis['merged_df'].to_csv(os.path.join(output_dir, 'segments.csv'), index=False)
+            export_results(analysis['segments'], analysis['merged_df'], output_dir)
+    except Exception as e:
+        row['error'] = f"{type(e).__name__}: {e}"
+
+    row['seconds'] = round(time.time() - start, 3)
+    return row
+
+
+def _run_params(args, color_map_path):
+    return {
+        'color_map': os.path.abspath(color_map_path),
+        'top_value': args.top,
+        'bottom_value': args.bottom,
+        'mask': os.path.abspath(args.mask),
+        'page': args.page,
+        'memory_lean': not args.no_memory_lean,
+        **ENGINE_PARAMS,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Batch colour-map analysis of TCAD images.")
+    parser.add_argument('output', help="Directory for the summary table and per-image outputs")
+    parser.add_argument('inputs', nargs='+', help="Image directories, glob patterns or files")
+    parser.add_argument('--mask', required=True,
+                        help="Mask used for every image, or a directory of per-image masks "
+                             "named <image stem>.* or <image stem>_mask.*")
+    parser.add_argument('--top', type=float, required=True, help="Value of the top of the colour map")
+    parser.add_argument('--bottom', type=float, required=True, help="Value of the bottom of the colour map")
+    parser.add_argument('--color-map', help="Colour map image (default: the Sentaurus TCAD colour map)")
+    parser.add_argument('--page', type=int, default=0, help="TIFF page to analyse")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="Worker processes (1 runs everything in this process)")
+    parser.add_argument('--per-image', action='store_true',
+                        help="Also write each image's segment table and label exports")
+    parser.add_argument('--no-memory-lean', action='store_true', help="Disable the memory-lean segmentation mode")
+    parser.add_argument('--restart', action='store_true', help="Discard the results of a previous run")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler(sys.stdout)],
+        force=True,
+    )
+
+    color_map_path = args.color_map or os.path.join(Config.ASSETS_FOLDER, 'color_map_crop.jpg')
+    images = collect_images(args.inputs)
+    if not images:
+        logger.error("No images found")
+        return 1
+
+    os.makedirs(args.output, exist_ok=True)
+    summary_path = os.path.join(args.output, SUMMARY_FILENAME)
+    run_path = os.path.join(args.output, RUN_FILENAME)
+
+    # A previous run is only resumed with the same settings
+    params = _run_params(args, color_map_path)
+    if args.restart and os.path.exists(summary_path):
+        os.remove(summary_path)
+    if os.path.exists(summary_path) and os.path.exists(run_path):
+        with open(run_path) as f:
+            previous = json.load(f)
+        if previous != params:
+            logger.error(f"{args.output} holds a run with different settings; use --restart to overwrite it")
+            return 1
+    with open(run_path, 'w') as f:
+        json.dump(params, f, indent=2)
+
+    rows = read_summary(summary_path)
+    pending = [path for path in images if path not in rows or rows[path]['error']]
+    if len(pending) < len(images):
+        logger.info(f"Resuming: {len(images) - len(pending)} of {len(images)} images already done")
+
+    color_table = calibrate_color_map(color_map_path, args.top, args.bottom,
+                                      num_rows=ENGINE_PARAMS['color_map_grid_rows'])
+    memory_lean = not args.no_memory_lean
+    names = output_names(images)
+
+    def job_args(path):
+        output_dir = os.path.join(args.output, 'images', names[path]) if args.per_image else None
+        return path, resolve_mask(path, args.mask), args.page, output_dir
+
+    start = time.time()
+    done = failed = 0
+    summary_exists = os.path.exists(summary_path)
+    with open(summary_path, 'a', newline='') as summary:
+        writer = csv.DictWriter(summary, fieldnames=SUMMARY_COLUMNS)
+        if not summary_exists:
+            writer.writeheader()
+
+        def record(row):
+            nonlocal done, failed
+            # Flushed per image so an interrupted run loses nothing that finished
+            writer.writerow(row)
+            summary.flush()
+            rows[row['image']] = row
+            done += 1
+            if row['error']:
+                failed += 1
+                logger.warning(f"[{done}/{len(pending)}] {row['image']}: {row['error']}")
+            else:
+                rate = done / max(time.time() - start, 1e-9)
+                logger.info(f"[{done}/{len(pending)}] {os.path.basename(row['image'])}: "
+                            f"average {row['average']:.6g} ({rate:.2f} images/s)")
+
+        try:
+            if args.workers <= 1:
+                _init_worker(color_table, memory_lean)
+                for path in pending:
+                    record(analyze_file(*job_args(path)))
+            else:
+                with ProcessPoolExecutor(
+                    max_workers=args.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker,
+                    initargs=(color_table, memory_lean, max((os.cpu_count() or 1) // args.workers, 1)),
+                ) as pool:
+                    futures = [pool.submit(analyze_file, *job_args(path)) for path in pending]
+                    try:
+                        for future in as_completed(futures):
+                            record(future.result())
+                    except BaseException:
+                        pool.shutdown(wait=False, cancel_futures=True)
+                        raise
+        except KeyboardInterrupt:
+            logger.warning(f"Interrupted after {done} images; run the same command again to resume")
+            return 130
+
+    # Compact the table: one row per image, in input order
+    write_summary(summary_path, [rows[path] for path in images if path in rows])
+
+    elapsed = time.time() - start
+    logger.info(f"Processed {done} images in {elapsed:.1f} s ({done / max(elapsed, 1e-9):.2f} images/s), "
+                f"{failed} failed; summary written to {summary_path}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
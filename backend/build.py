@@ -2,6 +2,7 @@ import PyInstaller.__main__
 import os
 import sys
 import shutil
+import argparse
 import platform
 
 def get_platform_specific_path(path):
@@ -17,8 +18,29 @@ def clean_build_dirs():
         if os.path.exists(dir_name):
             shutil.rmtree(dir_name)
 
+def parse_args():
+    parser = argparse.ArgumentParser(description='Builds the backend executable with PyInstaller')
+    parser.add_argument(
+        '--onefile', action='store_true',
+        help='Build a single self-extracting executable instead of the unpacked, fast-starting layout'
+    )
+    return parser.parse_args()
+
+def flatten_onedir(onedir_path, dist_path, name):
+    """
+    Moves an unpacked build (onedir_path/name/: the executable and its
+    _internal directory) into dist_path, where the app expects the executable.
+    """
+    os.makedirs(dist_path, exist_ok=True)
+    build_dir = os.path.join(onedir_path, name)
+    for entry in os.listdir(build_dir):
+        shutil.move(os.path.join(build_dir, entry), os.path.join(dist_path, entry))
+    shutil.rmtree(onedir_path)
+
 def main():
     try:
+        options = parse_args()
+
         # Get the absolute path to the backend directory
         backend_dir = os.path.dirname(os.path.abspath(__file__))
         
@@ -50,17 +72,26 @@ def main():
         current_platform = platform.system()
         print(f"Building for platform: {current_platform}")
         
+        # The unpacked layout starts without extracting the whole bundle (numpy,
+        # pandas, cv2, skimage) to a temp directory on every launch
+        onedir_path = os.path.join(build_path, 'onedir')
+        if options.onefile:
+            layout_args = ['--onefile', f'--distpath={dist_path}']
+        else:
+            # UPX-compressed libraries would be decompressed on every load
+            layout_args = ['--onedir', '--noupx', f'--distpath={onedir_path}']
+        print(f"Layout: {'onefile' if options.onefile else 'onedir (fast start)'}")
+
         # PyInstaller arguments
         args = [
             app_path,
-            '--onefile',
+            *layout_args,
             '--noconsole',
             '--noconfirm',
             '--clean',
             '--name=flask_backend',
             '--exclude-module=matplotlib',  # Exclude matplotlib as it's not needed
             '--exclude-module=tkinter',     # Exclude tkinter as it's not needed
-            f'--distpath={dist_path}',
             f'--workpath={build_path}',
             *add_data_args,
             '--hidden-import=flask',
@@ -103,6 +134,8 @@ def main():
         
         # Run PyInstaller
         PyInstaller.__main__.run(args)
+        if not options.onefile:
+            flatten_onedir(onedir_path, dist_path, 'flask_backend')
         
         # Verify the build output
         if current_platform == 'Windows':
@@ -111,7 +144,12 @@ def main():
             exe_path = os.path.join(dist_path, 'flask_backend')
         
         if os.path.exists(exe_path):
-            size = os.path.getsize(exe_path) / (1024 * 1024)  # Size in MB
+            if options.onefile:
+                size = os.path.getsize(exe_path) / (1024 * 1024)  # Size in MB
+            else:
+                size = sum(
+                    os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(dist_path) for f in files
+                ) / (1024 * 1024)
             print(f"Build completed successfully!")
             print(f"Executable: {exe_path}")
             print(f"Size: {size:.2f} MB")
@@ -1,9 +1,16 @@
-import sys
 import time
+# Taken before the heavy imports below, so the startup time logged covers them
+PROCESS_STARTED = time.time()
+import os
+import sys
+import json
 import socket
+import argparse
+import threading
 import logging
 import atexit
 import platform
+import multiprocessing
 from app import create_app
 
 # Configure logging
@@ -36,9 +43,139 @@ def find_available_port(start_port=5015, max_attempts=10):
             continue
     raise RuntimeError(f"Could not find an available port after {max_attempts} attempts")
 
-def main():
+# Prefix of the line announcing the backend is ready (see announce_ready)
+READY_PREFIX = 'VISTAR_READY '
+
+def parse_args(argv=None):
+    """Parses the command line; the environment gives the defaults."""
+    parser = argparse.ArgumentParser(description='Runs the analysis backend')
+    parser.add_argument(
+        '--socket', default=os.environ.get('VISTAR_SOCKET'),
+        help='Also serve on this Unix domain socket (POSIX only)'
+    )
+    parser.add_argument(
+        '--announce-ready', action='store_true', default=os.environ.get('VISTAR_ANNOUNCE_READY') == '1',
+        help=f'Print a {READY_PREFIX.strip()} line once the backend accepts connections'
+    )
+    parser.add_argument(
+        '--state-file', default=os.environ.get('VISTAR_STATE_FILE'),
+        help='Keep running after the app exits and record the addresses here, so later launches reuse this backend'
+    )
+    parser.add_argument(
+        '--idle-timeout', type=float, default=float(os.environ.get('VISTAR_IDLE_TIMEOUT', 30 * 60)),
+        help='Seconds without requests after which a backend kept running (--state-file) exits'
+    )
+    parser.add_argument(
+        '--app-version', default=os.environ.get('VISTAR_APP_VERSION'),
+        help='Version of the app starting the backend, reported by /health'
+    )
+    return parser.parse_args(argv)
+
+def serve_unix_socket(app, path):
+    """
+    Serves the app on a Unix domain socket from a background thread, next to
+    the TCP server. Local clients skip TCP connection setup this way.
+    """
+    from werkzeug.serving import make_server
+    if os.path.exists(path):
+        # Left over by a backend that did not shut down cleanly
+        os.unlink(path)
+    server = make_server(f'unix://{path}', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='ipc-socket', daemon=True).start()
+
+    def remove_socket():
+        server.shutdown()
+        if os.path.exists(path):
+            os.unlink(path)
+
+    atexit.register(remove_socket)
+    return server
+
+def announce_ready(port, socket_path, app_version):
+    """
+    Prints one JSON line with the addresses the backend listens on, so the
+    app that started it knows at once instead of polling /health.
+
+    Returns:
+        dict: The announced addresses.
+    """
+    info = {
+        'port': port,
+        'socket': socket_path,
+        'pid': os.getpid(),
+        'appVersion': app_version,
+        'startupSeconds': round(time.time() - PROCESS_STARTED, 3),
+    }
+    print(f"{READY_PREFIX}{json.dumps(info)}", flush=True)
+    logger.info(f"Backend ready after {info['startupSeconds']:.2f} seconds")
+    return info
+
+def write_state_file(path, info):
+    """
+    Records a backend kept running for later launches, and removes the record
+    when it exits.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(info, f)
+    os.replace(tmp_path, path)
+
+    def remove_state_file():
+        try:
+            with open(path) as f:
+                if json.load(f).get('pid') != os.getpid():
+                    # A newer backend has taken over the record
+                    return
+            os.remove(path)
+        except (OSError, ValueError):
+            pass
+
+    atexit.register(remove_state_file)
+
+def detach_output():
+    """
+    Points stdout and stderr at the null device. A backend kept running
+    outlives the app reading its pipes; the log file still gets every line.
+    """
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    os.close(devnull)
+
+def shut_down_when_idle(app, server, idle_timeout):
+    """Stops `server` once no request has been served for `idle_timeout` seconds."""
+    lock = threading.Lock()
+    activity = {'active': 0, 'last': time.monotonic()}
+
+    @app.before_request
+    def begin_request():
+        with lock:
+            activity['active'] += 1
+
+    @app.teardown_request
+    def end_request(exc=None):
+        with lock:
+            activity['active'] -= 1
+            activity['last'] = time.monotonic()
+
+    def watch():
+        while True:
+            time.sleep(min(idle_timeout / 4, 60))
+            with lock:
+                idle = activity['active'] == 0 and time.monotonic() - activity['last'] > idle_timeout
+            if idle:
+                logger.info(f"No requests for {idle_timeout:.0f} seconds, shutting down")
+                server.shutdown()
+                return
+
+    threading.Thread(target=watch, name='idle-shutdown', daemon=True).start()
+
+def main(argv=None):
     try:
         start = time.time()
+        args = parse_args(argv)
+        logger.info(f"Imports took {start - PROCESS_STARTED:.2f} seconds")
         logger.info("Starting backend...")
 
         # Register cleanup function
@@ -58,7 +195,14 @@ def main():
         else:
             logger.warning(f"Unknown platform: {current_platform}, skipping platform-specific setup")
 
+        socket_path = args.socket
+        if socket_path and not hasattr(socket, 'AF_UNIX'):
+            logger.warning("Unix domain sockets are not available on this platform, serving TCP only")
+            socket_path = None
+
         app = create_app()
+        app.config['IPC_SOCKET'] = socket_path
+        app.config['APP_VERSION'] = args.app_version
         logger.info(f"App created in {time.time() - start:.2f} seconds")
 
         # Only enable debug in development
@@ -66,11 +210,33 @@ def main():
         port = find_available_port()
         logger.info(f"Using port: {port}")
         logger.info(f"About to run app after {time.time() - start:.2f} seconds")
-        
-        app.run(debug=debug, port=port, host='127.0.0.1')  # Explicitly set host to localhost
+
+        if not (socket_path or args.announce_ready or args.state_file):
+            app.run(debug=debug, port=port, host='127.0.0.1')  # Explicitly set host to localhost
+            return
+
+        # Bind the servers here rather than in app.run, so readiness is
+        # announced once they accept connections (and without the reloader,
+        # which would start the backend twice)
+        from werkzeug.serving import make_server
+        server = make_server('127.0.0.1', port, app, threaded=True)
+        if socket_path:
+            serve_unix_socket(app, socket_path)
+            logger.info(f"Also serving on Unix socket: {socket_path}")
+        if args.state_file:
+            shut_down_when_idle(app, server, args.idle_timeout)
+        info = announce_ready(port, socket_path, args.app_version) if args.announce_ready else None
+        if args.state_file:
+            write_state_file(args.state_file, info or {
+                'port': port, 'socket': socket_path, 'pid': os.getpid(), 'appVersion': args.app_version,
+            })
+            detach_output()
+        server.serve_forever()
     except Exception as e:
         logger.error(f"Error starting backend: {e}")
         sys.exit(1)
 
 if __name__ == "__main__":
+    # Needed for analysis worker processes in frozen (PyInstaller) builds
+    multiprocessing.freeze_support()
     main()
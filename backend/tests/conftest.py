@@ -0,0 +1,42 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# Import the backend's `app` package whichever directory pytest runs from
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def color_bar():
+    """A 350x20 colour bar running from red (top) to blue (bottom)."""
+    t = np.linspace(0, 1, 350)[:, None]
+    bar = np.empty((350, 20, 3), dtype=np.uint8)
+    bar[..., 0] = np.round(255 * (1 - t))
+    bar[..., 1] = np.round(96 * np.sin(np.pi * t))
+    bar[..., 2] = np.round(255 * t)
+    return bar
+
+
+@pytest.fixture(scope='session')
+def color_map(color_bar):
+    from app.pipeline import ColorMap
+    return ColorMap(color_bar, top_value=100.0, bottom_value=0.0)
+
+
+@pytest.fixture(scope='session')
+def banded_image(color_map):
+    """
+    A 120x160 uint8 RGB image of four blocks painted with colour map bands,
+    and a mask covering part of every block.
+    """
+    colors = color_map.colors.astype(np.uint8)
+    image = np.empty((120, 160, 3), dtype=np.uint8)
+    image[:60, :80] = colors[3]
+    image[:60, 80:] = colors[12]
+    image[60:, :80] = colors[20]
+    image[60:, 80:] = colors[30]
+    mask = np.zeros((120, 160), dtype=np.uint8)
+    mask[20:100, 30:140] = 255
+    return image, mask
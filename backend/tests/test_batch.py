@@ -0,0 +1,90 @@
+import os
+
+import pytest
+
+import batch
+
+
+def _touch(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'')
+    return path
+
+
+def test_collect_images_expands_directories_and_globs(tmp_path):
+    a = _touch(tmp_path / 'run' / 'a.tif')
+    b = _touch(tmp_path / 'run' / 'b.png')
+    _touch(tmp_path / 'run' / 'notes.txt')
+    c = _touch(tmp_path / 'other' / 'c.jpg')
+
+    images = batch.collect_images([str(tmp_path / 'run'), str(tmp_path / 'other' / '*.jpg'), str(a)])
+
+    assert images == sorted(str(p) for p in (a, b, c))
+
+
+def test_resolve_mask_finds_per_image_masks(tmp_path):
+    masks = tmp_path / 'masks'
+    plain = _touch(masks / 'a.png')
+    suffixed = _touch(masks / 'b_mask.png')
+    _touch(masks / 'ab.png')
+
+    assert batch.resolve_mask('/images/a.tif', str(masks)) == str(plain)
+    assert batch.resolve_mask('/images/b.tif', str(masks)) == str(suffixed)
+    assert batch.resolve_mask('/images/c.tif', str(masks)) is None
+    # A single mask file is used for every image
+    assert batch.resolve_mask('/images/c.tif', str(plain)) == str(plain)
+
+
+def test_output_names_number_repeated_stems():
+    names = batch.output_names(['/x/a.tif', '/y/a.png', '/y/b.tif', '/z/a.tif'])
+    assert names == {'/x/a.tif': 'a', '/y/a.png': 'a-1', '/y/b.tif': 'b', '/z/a.tif': 'a-2'}
+
+
+@pytest.fixture
+def fake_analysis(monkeypatch):
+    """Runs main() without segmenting: records which images it analyses."""
+    analysed = []
+
+    def analyze_file(image_path, mask_path, page=0, output_dir=None):
+        analysed.append(os.path.basename(image_path))
+        row = dict.fromkeys(batch.SUMMARY_COLUMNS, '')
+        row.update({'image': image_path, 'mask': mask_path, 'average': 1.0})
+        return row
+
+    monkeypatch.setattr(batch, 'analyze_file', analyze_file)
+    monkeypatch.setattr(batch, 'calibrate_color_map', lambda *args, **kwargs: None)
+    return analysed
+
+
+def test_main_resumes_with_failed_and_missing_images(tmp_path, fake_analysis):
+    images = [_touch(tmp_path / 'in' / f'{name}.png') for name in ('a', 'b', 'c')]
+    mask = _touch(tmp_path / 'mask.png')
+    out = tmp_path / 'out'
+    argv = [str(out), str(tmp_path / 'in'), '--mask', str(mask), '--top', '1', '--bottom', '0',
+            '--color-map', str(mask), '--workers', '1']
+
+    assert batch.main(argv) == 0
+    assert fake_analysis == ['a.png', 'b.png', 'c.png']
+
+    # b failed last time; a and c are done
+    rows = batch.read_summary(str(out / batch.SUMMARY_FILENAME))
+    rows[str(images[1])]['error'] = 'MemoryError: '
+    batch.write_summary(str(out / batch.SUMMARY_FILENAME), list(rows.values()))
+    fake_analysis.clear()
+
+    assert batch.main(argv) == 0
+    assert fake_analysis == ['b.png']
+    rows = batch.read_summary(str(out / batch.SUMMARY_FILENAME))
+    assert list(rows) == [str(path) for path in images]
+    assert not any(row['error'] for row in rows.values())
+
+
+def test_main_refuses_to_resume_with_other_settings(tmp_path, fake_analysis):
+    _touch(tmp_path / 'in' / 'a.png')
+    mask = _touch(tmp_path / 'mask.png')
+    argv = [str(tmp_path / 'out'), str(tmp_path / 'in'), '--mask', str(mask), '--bottom', '0',
+            '--color-map', str(mask), '--workers', '1']
+
+    assert batch.main(argv + ['--top', '1']) == 0
+    assert batch.main(argv + ['--top', '2']) == 1
+    assert batch.main(argv + ['--top', '2', '--restart']) == 0
@@ -0,0 +1,95 @@
+import io
+
+import pytest
+from flask import Flask
+
+from app.upload_routes import _chunk_range
+from app.utils import chunked_upload
+from app.utils.chunked_upload import append_chunk, complete_upload, create_upload, read_upload_meta
+
+
+@pytest.fixture
+def upload(tmp_path):
+    root = str(tmp_path)
+    return root, create_upload(root, 'image.tif', total_size=10)['uploadId']
+
+
+def _append(root, upload_id, offset, data, length=None, buffer_size=4):
+    return append_chunk(root, upload_id, offset, io.BytesIO(data), length=length, buffer_size=buffer_size)
+
+
+def test_chunks_are_appended_and_completed(upload):
+    root, upload_id = upload
+    assert _append(root, upload_id, 0, b'abcdef', length=6)['offset'] == 6
+    assert _append(root, upload_id, 6, b'ghij')['offset'] == 10
+
+    meta = complete_upload(root, upload_id)
+    with open(meta['path'], 'rb') as f:
+        assert f.read() == b'abcdefghij'
+    assert not chunked_upload._locks
+
+
+@pytest.mark.parametrize('data, length', [
+    (b'abc', 4),            # short
+    (b'abcde', 4),          # long
+    (b'abcdefghijk', None), # past the total size
+    (b'abcdefghijk', 11),
+])
+def test_bad_chunks_are_rolled_back(upload, data, length):
+    root, upload_id = upload
+    _append(root, upload_id, 0, b'xy')
+
+    with pytest.raises(ValueError):
+        _append(root, upload_id, 2, data, length=length)
+
+    assert read_upload_meta(root, upload_id)['offset'] == 2
+    # The client resends the chunk from the same offset
+    assert _append(root, upload_id, 2, b'abcdefgh', length=8)['offset'] == 10
+    assert not chunked_upload._locks
+
+
+def test_chunks_must_start_at_the_received_size(upload):
+    root, upload_id = upload
+    _append(root, upload_id, 0, b'abc')
+
+    for offset in (0, 2, 4):
+        with pytest.raises(ValueError, match='does not match'):
+            _append(root, upload_id, offset, b'd')
+    assert read_upload_meta(root, upload_id)['offset'] == 3
+
+
+def test_unknown_and_complete_uploads_refuse_chunks(upload):
+    root, upload_id = upload
+    with pytest.raises(FileNotFoundError):
+        _append(root, 'f' * 32, 0, b'abc')
+    _append(root, upload_id, 0, b'0123456789')
+    complete_upload(root, upload_id)
+    with pytest.raises(ValueError, match='complete'):
+        _append(root, upload_id, 10, b'')
+    assert not chunked_upload._locks
+
+
+def _parse(headers, data=b'abcd'):
+    with Flask(__name__).test_request_context(method='PATCH', data=data, headers=headers):
+        return _chunk_range()
+
+
+def test_chunk_range_headers():
+    assert _parse({'Upload-Offset': '6'}) == (6, 4, None)
+    assert _parse({'Content-Range': 'bytes 6-9/10'}) == (6, 4, 10)
+    assert _parse({'Content-Range': 'bytes 6-9/*'}) == (6, 4, None)
+
+
+@pytest.mark.parametrize('headers', [
+    {},
+    {'Upload-Offset': 'six'},
+    {'Upload-Offset': '-1'},
+    {'Content-Range': 'bytes=6-9/10'},
+    {'Content-Range': 'bytes 9-6/10'},
+    {'Content-Range': 'bytes 6-10/10'},
+    {'Content-Range': 'bytes 6-8/10'},   # disagrees with the body
+    {'Content-Range': 'bytes 6-10/*'},
+])
+def test_invalid_chunk_ranges(headers):
+    with pytest.raises(ValueError):
+        _parse(headers)
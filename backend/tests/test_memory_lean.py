@@ -0,0 +1,144 @@
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from app.utils.image_segmentation.felzenszwalb_segmentation import (
+    felzenszwalb_segment_array,
+    reorder_segments_by_position,
+)
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Peak RSS the memory-lean segmentation may add per megapixel segmented.
+# Felzenszwalb itself needs about 250 bytes a pixel (float64 image and its
+# smoothed copy, edge costs and endpoints); the rest is headroom. The default
+# mode's float32 copy and int64 labels alone would add another 20.
+LEAN_PEAK_BYTES_PER_MEGAPIXEL = 320 * 1e6
+
+# Peak memory of one segmentation, measured in a fresh interpreter so the
+# high-water mark is not left over from other tests. ru_maxrss is in KiB on
+# Linux and in bytes on macOS.
+PEAK_RSS_SCRIPT = """
+import json, resource, sys
+import numpy as np
+from app.utils.image_segmentation.felzenszwalb_segmentation import felzenszwalb_segment_array
+
+memory_lean = sys.argv[1] == 'true'
+height, width = int(sys.argv[2]), int(sys.argv[3])
+
+# 16-bit blocks of colour on a gradient, so the default mode promotes to
+# float32; built in row chunks so its temporaries do not set the baseline peak
+image = np.empty((height, width, 3), dtype=np.uint16)
+mask = np.empty((height, width), dtype=bool)
+cols = np.arange(width)
+for start in range(0, height, 64):
+    stop = min(start + 64, height)
+    rows = np.arange(start, stop)[:, None]
+    image[start:stop, :, 0] = (rows // 64) * 4096 % 65536
+    image[start:stop, :, 1] = (cols // 64) * 4096 % 65536
+    image[start:stop, :, 2] = (rows + cols) * 8 % 65536
+    mask[start:stop] = (rows - height / 2) ** 2 + (cols - width / 2) ** 2 < (min(height, width) / 2.5) ** 2
+
+unit = 1 if sys.platform == 'darwin' else 1024
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+felzenszwalb_segment_array(image, mask, 100, 0.8, 50, memory_lean=memory_lean)
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+print(json.dumps({'peak_bytes': after - before}))
+"""
+
+
+def _peak_bytes_per_megapixel(memory_lean, height=2000, width=2000):
+    result = subprocess.run(
+        [sys.executable, '-c', PEAK_RSS_SCRIPT, 'true' if memory_lean else 'false', str(height), str(width)],
+        cwd=BACKEND_DIR, capture_output=True, text=True, check=True,
+    )
+    peak_bytes = json.loads(result.stdout.strip().splitlines()[-1])['peak_bytes']
+    return peak_bytes / (height * width / 1e6)
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='resource is POSIX only')
+def test_memory_lean_peak_rss_per_megapixel_within_budget():
+    lean = _peak_bytes_per_megapixel(memory_lean=True)
+    assert lean < LEAN_PEAK_BYTES_PER_MEGAPIXEL, f'{lean / 1e6:.0f} MB per megapixel'
+
+
+def _synthetic_rgb8(height=120, width=160, seed=0):
+    rng = np.random.default_rng(seed)
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    for _ in range(12):
+        top, left = rng.integers(0, height - 10), rng.integers(0, width - 10)
+        image[top:top + rng.integers(10, 50), left:left + rng.integers(10, 60)] = rng.integers(0, 256, 3)
+    mask = np.zeros((height, width), dtype=bool)
+    mask[10:-10, 15:-15] = True
+    return image, mask
+
+
+def test_memory_lean_segments_uint8_images_identically():
+    image, mask = _synthetic_rgb8()
+    default, default_input = felzenszwalb_segment_array(image.copy(), mask.copy(), 100, 0.8, 20)
+    lean, lean_input = felzenszwalb_segment_array(image.copy(), mask.copy(), 100, 0.8, 20, memory_lean=True)
+
+    assert np.issubdtype(lean.dtype, np.unsignedinteger)
+    assert lean.dtype.itemsize < default.dtype.itemsize
+    np.testing.assert_array_equal(lean, default)
+    np.testing.assert_array_equal(lean_input, default_input)
+
+
+def test_reorder_numbers_segments_from_the_bottom_left():
+    segments = np.array([
+        [7, 7, 3, 3],
+        [7, 7, 3, 3],
+        [5, 5, 9, 9],
+    ])
+    expected = np.array([
+        [3, 3, 4, 4],
+        [3, 3, 4, 4],
+        [1, 1, 2, 2],
+    ])
+    for compact in (False, True):
+        np.testing.assert_array_equal(reorder_segments_by_position(segments, compact=compact), expected)
+
+
+@pytest.mark.parametrize('num_labels, dtype', [(200, np.uint8), (300, np.uint16), (70000, np.uint32)])
+def test_reorder_compact_matches_default(num_labels, dtype):
+    rng = np.random.default_rng(num_labels)
+    # Sparse labels, so the relabelling has gaps to close
+    segments = (rng.permutation(num_labels) * 3).repeat(2).reshape(-1, 4)
+    default = reorder_segments_by_position(segments)
+    compact = reorder_segments_by_position(segments, compact=True)
+
+    assert compact.dtype == dtype
+    assert default.dtype == np.dtype(int)
+    np.testing.assert_array_equal(compact.astype(np.int64), default)
+    assert compact.max() == num_labels
+
+
+def test_reorder_compact_zeroes_unlabelled_pixels():
+    rng = np.random.default_rng(1)
+    segments = rng.integers(-3, 40, size=(50, 60))
+    default = reorder_segments_by_position(segments)
+    compact = reorder_segments_by_position(segments, compact=True)
+
+    unlabelled = segments < 0
+    # The default keeps the original negative values, compact maps them to 0
+    np.testing.assert_array_equal(default[unlabelled], segments[unlabelled])
+    assert not compact[unlabelled].any()
+    np.testing.assert_array_equal(compact[~unlabelled].astype(np.int64), default[~unlabelled])
+
+
+def test_reorder_compact_treats_nan_as_unlabelled():
+    segments = np.array([
+        [0.0, 0.0, np.nan],
+        [2.0, np.nan, 1.0],
+    ])
+    default = reorder_segments_by_position(segments)
+    compact = reorder_segments_by_position(segments, compact=True)
+
+    nan = np.isnan(segments)
+    assert (default[nan] == -1).all()
+    assert not compact[nan].any()
+    np.testing.assert_array_equal(compact[~nan].astype(np.int64), default[~nan])
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from app.pipeline import ColorMap, Pipeline
+from app.utils.analysis import analyze_image
+
+
+def _assert_same_result(result, analysis):
+    assert result.average == analysis['results']['average']
+    assert result.stats == analysis['results']['stats']
+    assert result.color_map_data == analysis['results']['colorMapData']
+    np.testing.assert_array_equal(result.labels, analysis['segments'])
+    pd.testing.assert_frame_equal(result.segment_table, analysis['merged_df'])
+
+
+def test_run_matches_analyze_image(color_map, banded_image):
+    image, mask = banded_image
+    result = Pipeline(color_map).run(image.copy(), mask.copy())
+    analysis = analyze_image(image.copy(), mask.copy(), color_map.table)
+
+    _assert_same_result(result, analysis)
+    assert result.bbox == analysis['bbox']
+    assert result.image_shape == image.shape[:2]
+
+
+def test_run_matches_analyze_image_without_memory_lean(color_map, banded_image):
+    image, mask = banded_image
+    result = Pipeline(color_map, memory_lean=False).run(image.copy(), mask.copy())
+    analysis = analyze_image(image.copy(), mask.copy(), color_map.table, memory_lean=False)
+
+    _assert_same_result(result, analysis)
+
+
+def test_run_reads_paths_like_arrays(tmp_path, color_map, banded_image):
+    image, mask = banded_image
+    Image.fromarray(image).save(tmp_path / 'image.png')
+    Image.fromarray(mask).save(tmp_path / 'mask.png')
+    pipeline = Pipeline(color_map)
+
+    from_paths = pipeline.run(str(tmp_path / 'image.png'), tmp_path / 'mask.png')
+    from_arrays = pipeline.run(image.copy(), mask.copy())
+
+    assert from_paths.average == from_arrays.average
+    np.testing.assert_array_equal(from_paths.labels, from_arrays.labels)
+
+
+def test_result_stays_within_the_colour_map_range(color_map, banded_image):
+    image, mask = banded_image
+    result = Pipeline(color_map).run(image.copy(), mask.copy())
+
+    assert color_map.bottom_value <= result.average <= color_map.top_value
+    full = result.label_image()
+    top, bottom, left, right = result.bbox
+    assert full.shape == image.shape[:2]
+    np.testing.assert_array_equal(full[top:bottom, left:right], np.maximum(result.labels, 0))
+    full[top:bottom, left:right] = 0
+    assert not full.any()
+
+
+def test_with_values_matches_a_fresh_calibration(color_bar, color_map):
+    rescaled = color_map.with_values(top_value=1e20, bottom_value=1e14)
+    fresh = ColorMap(color_bar, top_value=1e20, bottom_value=1e14)
+
+    np.testing.assert_array_equal(rescaled.colors, color_map.colors)
+    pd.testing.assert_frame_equal(rescaled.table, fresh.table)
+    assert rescaled.distribution == fresh.distribution
+    # The original keeps its own values
+    assert color_map.values[0] == 100.0
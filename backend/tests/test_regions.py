@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.utils.analysis import analyze_image, analyze_regions, regions_from_label_mask, regions_from_masks
+from app.utils.image_segmentation.felzenszwalb_segmentation import region_segment_counts, select_segments
+
+
+def test_regions_from_label_mask_numbers_values_in_order():
+    label_mask = np.array([
+        [0, 0, 40, 40],
+        [7, 7, 40, 0],
+        [7, 300, 300, 0],
+    ])
+    regions, values = regions_from_label_mask(label_mask)
+
+    np.testing.assert_array_equal(values, [7, 40, 300])
+    np.testing.assert_array_equal(regions, [
+        [0, 0, 2, 2],
+        [1, 1, 2, 0],
+        [1, 3, 3, 0],
+    ])
+    assert regions.dtype == np.uint8
+
+
+def test_regions_from_label_mask_without_background():
+    regions, values = regions_from_label_mask(np.array([[5, 5], [9, 9]], dtype=np.uint16))
+
+    np.testing.assert_array_equal(values, [5, 9])
+    np.testing.assert_array_equal(regions, [[1, 1], [2, 2]])
+
+
+def test_regions_from_masks_stacks_only_overlapping_masks():
+    a = np.zeros((4, 4), dtype=np.uint8)
+    b = np.zeros((4, 4), dtype=np.uint8)
+    a[:2] = 255
+    b[2:] = 255
+    np.testing.assert_array_equal(regions_from_masks([a, b]), np.where(a > 0, 1, np.where(b > 0, 2, 0)))
+
+    b[1] = 255
+    stack = regions_from_masks([a, b])
+    assert stack.dtype == bool and stack.shape == (2, 4, 4)
+    np.testing.assert_array_equal(stack[1], b > 0)
+
+
+def test_region_segment_counts_agree_for_labels_and_stacks():
+    rng = np.random.default_rng(0)
+    segments = rng.integers(0, 12, size=(30, 40))
+    regions = rng.integers(0, 4, size=(30, 40))
+    stack = np.stack([regions == region for region in (1, 2, 3)])
+
+    counts = region_segment_counts(segments, regions, 3, chunk_rows=7)
+    np.testing.assert_array_equal(counts, region_segment_counts(segments, stack, 3, chunk_rows=7))
+    for region in (1, 2, 3):
+        np.testing.assert_array_equal(counts[region - 1], np.bincount(segments[regions == region], minlength=12))
+
+
+def _segment_stats(rows):
+    return pd.DataFrame(rows, columns=['R', 'G', 'B', 'PixelCount'], index=pd.Index(range(1, len(rows) + 1)))
+
+
+def test_select_segments_keeps_coloured_segments_mostly_inside():
+    stats = _segment_stats([
+        [10, 20, 30, 100],       # fully inside
+        [40, 50, 60, 100],       # 89% inside
+        [250, 5, 250, 100],      # magenta background
+        [np.nan, 0, 0, 100],     # colour unknown
+        [70, 80, 90, 0],         # empty
+        [1, 2, 3, 50],           # outside
+    ])
+    inside = np.array([100, 89, 100, 100, 0, 0])
+
+    selected = select_segments(stats, total_pixels=400, inside_mask_count=inside)
+
+    assert selected.index.tolist() == [1]
+    assert selected.index.name == 'Segment'
+    row = selected.loc[1]
+    assert (row['R'], row['G'], row['B'], row['PixelCount']) == (10, 20, 30, 100)
+    assert row['PercentageArea'] == pytest.approx(25.0)
+
+
+def test_select_segments_without_a_mask_and_with_float_colours():
+    stats = _segment_stats([
+        [0.5, 0.25, 1.0, 30],
+        [0.0, 1.0, 0.0, 30],
+    ])
+    selected = select_segments(stats, total_pixels=60, float_colors=True)
+
+    assert selected.index.tolist() == [1, 2]
+    assert (selected.loc[1, 'R'], selected.loc[1, 'G'], selected.loc[1, 'B']) == (127, 63, 255)
+    assert selected.loc[1, 'PercentageArea'] == pytest.approx(50.0)
+
+
+def test_a_single_region_matches_the_single_mask_analysis(color_map, banded_image):
+    image, mask = banded_image
+    analysis = analyze_image(image.copy(), mask.copy(), color_map.table)
+    regions = analyze_regions(image.copy(), (mask > 0).astype(np.uint8), color_map.table)
+
+    assert regions['results']['average'] == pytest.approx(analysis['results']['average'])
+    assert regions['regions'][0]['results']['average'] == pytest.approx(analysis['results']['average'])
+
+
+def test_regions_are_aggregated_on_their_own_segments(color_map, banded_image):
+    image, mask = banded_image
+    left = np.zeros(mask.shape, dtype=np.uint8)
+    right = np.zeros(mask.shape, dtype=np.uint8)
+    left[20:100, 30:80] = 255
+    right[20:100, 80:140] = 255
+
+    analysis = analyze_regions(image.copy(), regions_from_masks([left, right]), color_map.table)
+    left_only = analyze_image(image.copy(), left, color_map.table)
+
+    assert [region['region'] for region in analysis['regions']] == [1, 2]
+    # Only the segments along the crop edges may differ between the two segmentations
+    assert analysis['regions'][0]['results']['average'] == pytest.approx(left_only['results']['average'], abs=0.5)
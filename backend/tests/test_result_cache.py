@@ -0,0 +1,115 @@
+import threading
+import time
+
+import pytest
+
+from app.utils.result_cache import ResultCache, Unshared
+
+
+class Cancelled(Unshared):
+    pass
+
+
+def _follow(cache, key, compute, outcomes):
+    def run():
+        try:
+            outcomes.append(cache.get_or_compute(key, compute))
+        except Exception as e:
+            outcomes.append(e)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def _lead(cache, key, outcome):
+    """
+    Starts a computation of `key` that blocks until the returned event is set,
+    then returns `outcome` or raises it.
+    """
+    started = threading.Event()
+    release = threading.Event()
+
+    def compute():
+        started.set()
+        release.wait(5)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+    outcomes = []
+    thread = _follow(cache, key, compute, outcomes)
+    assert started.wait(5)
+    return thread, release, outcomes
+
+
+def _wait_for_followers():
+    # Followers have nothing to signal while they wait on the leader
+    time.sleep(0.1)
+
+
+def test_concurrent_requests_compute_once():
+    cache = ResultCache()
+    leader, release, leader_outcomes = _lead(cache, 'key', b'value')
+    calls = []
+    follower_outcomes = []
+    followers = [_follow(cache, 'key', lambda: calls.append(1) or b'other', follower_outcomes) for _ in range(3)]
+    _wait_for_followers()
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join(5)
+
+    assert leader_outcomes == [(b'value', False)]
+    assert follower_outcomes == [(b'value', True)] * 3
+    assert calls == []
+    assert cache.get('key') == b'value'
+
+
+def test_followers_recompute_when_the_leader_is_cancelled():
+    cache = ResultCache()
+    leader, release, leader_outcomes = _lead(cache, 'key', Cancelled('client went away'))
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return b'value'
+
+    follower_outcomes = []
+    followers = [_follow(cache, 'key', compute, follower_outcomes) for _ in range(3)]
+    _wait_for_followers()
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join(5)
+
+    assert len(leader_outcomes) == 1 and isinstance(leader_outcomes[0], Cancelled)
+    # One follower leads the recomputation and the others share it
+    assert calls == [1]
+    assert sorted(follower_outcomes) == [(b'value', False), (b'value', True), (b'value', True)]
+    assert cache.get('key') == b'value'
+
+
+def test_followers_share_the_leaders_failure():
+    cache = ResultCache()
+    leader, release, leader_outcomes = _lead(cache, 'key', ValueError('bad input'))
+    follower_outcomes = []
+    follower = _follow(cache, 'key', lambda: b'value', follower_outcomes)
+    _wait_for_followers()
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert [type(outcome) for outcome in leader_outcomes + follower_outcomes] == [ValueError, ValueError]
+    assert cache.get('key') is None
+
+
+def test_unshared_results_are_not_cached():
+    cache = ResultCache()
+
+    def cancelled():
+        raise Cancelled()
+
+    with pytest.raises(Cancelled):
+        cache.get_or_compute('key', cancelled)
+
+    assert cache.get('key') is None
+    assert cache.get_or_compute('key', lambda: b'value') == (b'value', False)
+    assert cache.get_or_compute('key', lambda: b'other') == (b'value', True)
@@ -0,0 +1,64 @@
+import pandas as pd
+import pytest
+
+from app.utils.analysis import segment_image, plan_segment_values, aggregate_segments, analyze_image
+from app.utils.analysis_sessions import AnalysisSessionStore
+
+
+def test_session_is_found_by_its_inputs_only():
+    store = AnalysisSessionStore()
+    session = store.put('client', 'image+mask', {'segments': None}, image_fingerprint='image')
+
+    assert store.get('client', 'image+mask') is session
+    assert store.get('client', 'image+other-mask') is None
+    # The same image with another mask, for updating the segmentation around the edit
+    assert store.get('client', 'image+other-mask', image_fingerprint='image') is session
+    assert store.get('client', 'other-image+mask', image_fingerprint='other-image') is None
+    assert store.get('other-client', 'image+mask') is None
+
+
+def test_least_recently_used_sessions_are_dropped():
+    store = AnalysisSessionStore(max_sessions=2)
+    store.put('a', 'fa', {})
+    store.put('b', 'fb', {})
+    store.get('a', 'fa')
+    store.put('c', 'fc', {})
+
+    assert len(store) == 2
+    assert store.get('b', 'fb') is None
+    assert store.get('a', 'fa') is not None and store.get('c', 'fc') is not None
+
+
+def test_unused_sessions_expire():
+    store = AnalysisSessionStore(ttl=60)
+    session = store.put('a', 'fa', {})
+    session.touched_at -= 61
+
+    assert store.get('a', 'fa') is None
+    assert len(store) == 0
+
+
+def test_put_and_discard_replace_the_session():
+    store = AnalysisSessionStore()
+    store.put('a', 'first', {})
+    store.put('a', 'second', {})
+    assert store.get('a', 'first') is None
+    store.discard('a')
+    assert store.get('a', 'second') is None
+
+
+@pytest.mark.parametrize('top_value, bottom_value', [(100.0, 0.0), (1e20, 1e14), (5.0, -5.0)])
+def test_reused_plan_gives_the_full_analysis_for_new_values(color_map, banded_image, top_value, bottom_value):
+    image, mask = banded_image
+    # What a session keeps: the segmentation and the colour matching of its colour map
+    state = segment_image(image.copy(), mask.copy())
+    plan = plan_segment_values(state, color_map.table)
+
+    table = color_map.with_values(top_value, bottom_value).table
+    reused = aggregate_segments(state, table, plan=plan)
+    fresh = aggregate_segments(state, table)
+    full = analyze_image(image.copy(), mask.copy(), table)
+
+    pd.testing.assert_frame_equal(reused['merged_df'], fresh['merged_df'])
+    assert reused['results'] == fresh['results']
+    assert reused['results']['average'] == pytest.approx(full['results']['average'])
@@ -0,0 +1,85 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+from app.utils.shared_arrays import SharedArrayRegistry, attach_shared_array, sweep_orphaned_segments
+
+
+@pytest.fixture
+def registry():
+    registry = SharedArrayRegistry(prefix='vistartest')
+    yield registry
+    registry.cleanup()
+
+
+def _unlinked(name):
+    try:
+        shared_memory.SharedMemory(name=name).close()
+    except FileNotFoundError:
+        return True
+    return False
+
+
+def test_share_copies_into_a_buffer_other_users_attach_to(registry):
+    array = np.arange(12, dtype=np.uint16).reshape(3, 4)
+    spec, view = registry.share(array, owner='job')
+
+    assert spec.shape == (3, 4) and np.dtype(spec.dtype) == np.uint16
+    np.testing.assert_array_equal(view, array)
+    with attach_shared_array(spec) as attached:
+        np.testing.assert_array_equal(attached, array)
+        attached[0, 0] = 99
+    assert registry.view(spec)[0, 0] == 99
+
+
+def test_buffer_is_unlinked_when_its_last_reference_is_released(registry):
+    spec, _ = registry.create((4, 4), np.uint8, owner='job')
+    registry.acquire(spec.name)
+    assert registry.active_buffers() == {spec.name: 2}
+
+    registry.release(spec.name)
+    assert registry.active_buffers() == {spec.name: 1}
+    assert not _unlinked(spec.name)
+
+    registry.release(spec.name)
+    assert registry.active_buffers() == {}
+    assert _unlinked(spec.name)
+    # Releasing a buffer that is gone is harmless
+    registry.release(spec.name)
+
+
+def test_release_owner_keeps_buffers_others_still_hold(registry):
+    held, _ = registry.create((2, 2), np.uint8, owner='job')
+    dropped, _ = registry.create((2, 2), np.uint8, owner='job')
+    other, _ = registry.create((2, 2), np.uint8, owner='other-job')
+    # e.g. a background export still writing from the labels
+    registry.acquire(held.name)
+
+    registry.release_owner('job')
+
+    assert registry.active_buffers() == {held.name: 1, other.name: 1}
+    assert _unlinked(dropped.name)
+    registry.release(held.name)
+    assert _unlinked(held.name)
+
+
+def test_cleanup_unlinks_everything_whatever_the_counts(registry):
+    spec, _ = registry.create((2, 2), np.uint8, owner='job')
+    registry.acquire(spec.name)
+    registry.cleanup()
+    assert registry.active_buffers() == {}
+    assert _unlinked(spec.name)
+
+
+def test_sweep_removes_segments_of_dead_processes_only(tmp_path):
+    dead_pid = 2 ** 31 - 2
+    orphan = tmp_path / f'vistar_{dead_pid}_0123456789abcdef'
+    alive = tmp_path / 'vistar_1_0123456789abcdef'
+    unrelated = tmp_path / 'other_segment'
+    for path in (orphan, alive, unrelated):
+        path.write_bytes(b'')
+
+    assert sweep_orphaned_segments(shm_dir=str(tmp_path)) == 1
+    assert not orphan.exists()
+    assert alive.exists() and unrelated.exists()
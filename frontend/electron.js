@@ -2,6 +2,7 @@ import { app, BrowserWindow, Notification, ipcMain } from "electron";
 import path from "path";
 import { fileURLToPath } from "url";
 import { spawn } from "child_process";
+import http from "http";
 import fs from "fs";
 import os from "os";
 import logging from "electron-log";
@@ -30,6 +31,17 @@ const __filename = fileURLToPath(import.meta.url);
 const __dirname = path.dirname(__filename);
 
 let flaskProcess = null;
+// Addresses the backend announced once it accepted connections
+let backendInfo = null;
+const BACKEND_READY_PREFIX = "VISTAR_READY ";
+// Unix domain socket for the IPC transport; Windows keeps to TCP
+const backendSocketPath =
+  process.platform === "win32" ? null : path.join(os.tmpdir(), `vistar-${process.pid}.sock`);
+// Packaged builds keep the backend running between launches, so only the
+// first launch pays for its startup (see run.py --state-file)
+const warmBackend = app.isPackaged || process.env.VISTAR_WARM_BACKEND === "1";
+const backendStateFile = () => path.join(app.getPath("userData"), "backend.json");
+let backendSpawnedAt = null;
 
 function logToFile(message) {
   // Write logs to ~/Logs/Vistar/backend.log
@@ -41,10 +53,92 @@ function logToFile(message) {
   fs.appendFileSync(logPath, `[${new Date().toISOString()}] ${message}\n`);
 }
 
+// Reads the backend's readiness line and tells every window
+function handleBackendOutput(output) {
+  for (const line of output.split(/\r?\n/)) {
+    if (!line.startsWith(BACKEND_READY_PREFIX)) continue;
+    try {
+      backendInfo = JSON.parse(line.slice(BACKEND_READY_PREFIX.length));
+    } catch (err) {
+      logToFile(`Could not parse backend readiness: ${err.message}`);
+      continue;
+    }
+    logToFile(
+      `Backend ready on port ${backendInfo.port} ${Date.now() - backendSpawnedAt}ms after launch ` +
+        `(${backendInfo.startupSeconds}s in Python)`
+    );
+    announceBackend();
+  }
+}
+
+function announceBackend() {
+  BrowserWindow.getAllWindows().forEach((win) => win.webContents.send("backend-ready", backendInfo));
+}
+
+// Resolves to the backend's /health answer, or null if it does not answer promptly
+function getBackendHealth(port) {
+  return new Promise((resolve) => {
+    const req = http.get({ host: "127.0.0.1", port, path: "/health", timeout: 500 }, (res) => {
+      const chunks = [];
+      res.on("data", (chunk) => chunks.push(chunk));
+      res.on("end", () => {
+        try {
+          resolve(res.statusCode === 200 ? JSON.parse(Buffer.concat(chunks).toString()) : null);
+        } catch {
+          resolve(null);
+        }
+      });
+    });
+    req.on("timeout", () => {
+      req.destroy();
+      resolve(null);
+    });
+    req.on("error", () => resolve(null));
+  });
+}
+
+// Reuses the backend a previous launch left running, if it still answers and
+// belongs to this version of the app
+async function reuseWarmBackend() {
+  let record;
+  try {
+    record = JSON.parse(fs.readFileSync(backendStateFile(), "utf8"));
+  } catch {
+    return false;
+  }
+  const started = Date.now();
+  const health = await getBackendHealth(record.port);
+  if (!health || health.pid !== record.pid) {
+    logToFile(`Backend recorded on port ${record.port} is gone, starting a new one`);
+    return false;
+  }
+  if (health.appVersion !== app.getVersion()) {
+    logToFile(`Backend pid ${record.pid} is from version ${health.appVersion}, replacing it`);
+    try {
+      process.kill(record.pid);
+    } catch (err) {
+      logToFile(`Could not stop the old backend: ${err.message}`);
+    }
+    return false;
+  }
+  backendInfo = { ...record, reused: true };
+  logToFile(`Reusing backend pid ${record.pid} on port ${record.port}, ready in ${Date.now() - started}ms`);
+  announceBackend();
+  return true;
+}
+
 function startFlaskBackend() {
   let flaskPath;
   let args = [];
   let command;
+  const backendArgs = ["--announce-ready", "--app-version", app.getVersion()];
+  if (backendSocketPath) {
+    backendArgs.push("--socket", backendSocketPath);
+  }
+  if (warmBackend) {
+    backendArgs.push("--state-file", backendStateFile());
+  }
+  backendSpawnedAt = Date.now();
   
   if (app.isPackaged) {
     // Production mode: Use platform-specific executable
@@ -93,7 +187,7 @@ function startFlaskBackend() {
       command = fs.existsSync(pythonPath) ? path.resolve(pythonPath) : "python3";
     }
     
-    args = [flaskPath];
+    args = [flaskPath, ...backendArgs];
     logToFile(`Dev mode: Starting backend with ${command} ${flaskPath}`);
     logToFile(`Backend dir: ${backendDir}, Python path: ${command}, Exists: ${fs.existsSync(pythonPath)}`);
   }
@@ -111,8 +205,11 @@ function startFlaskBackend() {
       
       if (platform === "win32") {
         // Windows: Execute .exe directly
-        flaskProcess = spawn(flaskPath, [], {
+        flaskProcess = spawn(flaskPath, backendArgs, {
           stdio: "pipe",
+          // A warm backend outlives this launch
+          detached: warmBackend,
+          windowsHide: true,
           env: {
             ...process.env,
             PATH: `${path.dirname(flaskPath)}${path.delimiter}${
@@ -129,8 +226,11 @@ function startFlaskBackend() {
           logToFile(`Warning: Could not set executable permissions: ${err.message}`);
         }
         
-        flaskProcess = spawn(flaskPath, [], {
+        flaskProcess = spawn(flaskPath, backendArgs, {
           stdio: "pipe",
+          // A warm backend outlives this launch
+          detached: warmBackend,
+          windowsHide: true,
           env: {
             ...process.env,
             PATH: `${path.dirname(flaskPath)}${path.delimiter}${
@@ -141,11 +241,12 @@ function startFlaskBackend() {
       }
     } else {
       // Development mode: Use Python
-      flaskProcess = spawn(command, args);
+      flaskProcess = spawn(command, args, { detached: warmBackend });
     }
 
     flaskProcess.stdout.on("data", (data) => {
       const output = data.toString().trim();
+      handleBackendOutput(output);
       logToFile(`Flask stdout: ${output}`);
       console.log(`Flask stdout: ${output}`);
     });
@@ -267,13 +368,23 @@ autoUpdater.on("update-downloaded", (info) => {
   );
 });
 
-app.whenReady().then(() => {
-  startFlaskBackend();
+app.whenReady().then(async () => {
+  if (!(warmBackend && (await reuseWarmBackend()))) {
+    startFlaskBackend();
+  }
   createWindow();
+
+  if (warmBackend) {
+    // A warm backend exits after a long idle spell; keep it up while the app is open
+    setInterval(() => backendInfo && getBackendHealth(backendInfo.port), 60 * 1000);
+  }
 });
 
 app.on("window-all-closed", () => {
-  if (flaskProcess) {
+  if (flaskProcess && warmBackend) {
+    flaskProcess.unref();
+    logToFile("Flask process left running for the next launch");
+  } else if (flaskProcess) {
     flaskProcess.kill();
     logToFile("Flask process killed on window-all-closed");
   }
@@ -288,6 +399,38 @@ app.on("activate", () => {
   }
 });
 
+// Addresses of the backend, or null until it is ready
+ipcMain.handle("backend-info", () => backendInfo);
+
+// Forwards a request to the backend over its Unix socket. Bodies and
+// responses cross as bytes, so no JSON or base64 re-encoding is needed.
+ipcMain.handle("backend-request", (_event, { method, path: requestPath, headers, body }) => {
+  if (!backendInfo?.socket) {
+    return Promise.reject(new Error("The backend has no IPC socket"));
+  }
+  return new Promise((resolve, reject) => {
+    const req = http.request(
+      {
+        socketPath: backendInfo.socket,
+        path: requestPath,
+        method,
+        // URLs in the response must point at the TCP server the page can load from
+        headers: { ...headers, Host: `127.0.0.1:${backendInfo.port}` },
+      },
+      (res) => {
+        const chunks = [];
+        res.on("data", (chunk) => chunks.push(chunk));
+        res.on("end", () =>
+          resolve({ status: res.statusCode, headers: res.headers, body: Buffer.concat(chunks) })
+        );
+        res.on("error", reject);
+      }
+    );
+    req.on("error", reject);
+    req.end(body ? Buffer.from(body) : undefined);
+  });
+});
+
 // Add IPC handlers for manual update checking
 ipcMain.handle("check-for-updates", async () => {
   if (app.isPackaged) {
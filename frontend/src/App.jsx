@@ -1,6 +1,7 @@
 import { useEffect, useState } from "react"
 import { HashRouter as Router } from "react-router-dom"
 import AppRoutes from "./Routes"
+import { onBackendReady } from "./utils/backendTransport"
 import { MathJaxContext } from "better-react-mathjax"
 
 const SplashScreen = ({ waitingTime }) => (
@@ -84,7 +85,19 @@ const App = () => {
   const [backendPort, setBackendPort] = useState(5015)
   const [waitingTime, setWaitingTime] = useState(0)
 
+  // In the app the backend announces itself; no need to poll
   useEffect(() => {
+    return onBackendReady((info) => {
+      window.BACKEND_URL = `http://127.0.0.1:${info.port}`
+      window.BACKEND_SOCKET = info.socket
+      console.log(`Backend ready after ${info.startupSeconds}s at ${window.BACKEND_URL}`)
+      setBackendReady(true)
+    })
+  }, [])
+
+  useEffect(() => {
+    // Outside the app (a plain browser) there is no announcement: poll /health
+    if (window.require || backendReady) return
     let isMounted = true
     const checkBackend = async () => {
       try {
@@ -119,7 +132,7 @@ const App = () => {
     return () => {
       isMounted = false;
     };
-  }, [backendPort]);
+  }, [backendPort, backendReady]);
 
   useEffect(() => {
     const timer = setTimeout(() => {
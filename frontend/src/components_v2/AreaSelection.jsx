@@ -479,7 +479,18 @@ const AreaSelection = ({ image, deviceWidth, deviceHeight, onComplete, onBack })
     maskCtx.fill()
     const maskImageUrl = maskCanvas.toDataURL("image/png")
 
-    onComplete(croppedImageUrl, currentSelectionSize, maskImageUrl)
+    // The selection as geometry, so the backend can rasterize the mask itself
+    const selection = {
+      points: points.map((p) => [p.x, p.y]),
+      imageWidth: imageRef.current.width,
+      imageHeight: imageRef.current.height,
+      left: minX,
+      top: minY,
+      width: maskCanvas.width,
+      height: maskCanvas.height,
+    }
+
+    onComplete(croppedImageUrl, currentSelectionSize, maskImageUrl, selection)
   }
 
   const programmaticZoom = (zoomDirection) => {
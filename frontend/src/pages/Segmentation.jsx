@@ -1,7 +1,7 @@
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import { useNavigate, useLocation } from "react-router-dom";
-import axios from "axios";
-import { base64ToBlob } from "../utils/imageUtils";
+import { base64ToBlob, selectionToMaskGeometry } from "../utils/imageUtils";
+import { backendPost } from "../utils/backendTransport";
 import ImageUploader from "../components_v2/ImageUploader";
 import DeviceMeasurement from "../components_v2/DeviceMeasurement";
 import AreaSelection from "../components_v2/AreaSelection";
@@ -29,10 +29,16 @@ const Segmentation = () => {
   // Area selection state
   const [croppedImageUrl, setCroppedImageUrl] = useState(null);
   const [maskImageUrl, setMaskImageUrl] = useState(null);
+  const [selection, setSelection] = useState(null);
   const [currentSelectionSize, setCurrentSelectionSize] = useState({
     area: 0,
   });
 
+  // Id of the device image sent to the backend ahead of the mask, so it is
+  // decoded while the area is being selected
+  const [preparedImageId, setPreparedImageId] = useState(null);
+  const prepareRequestRef = useRef(0);
+
   // Color map state
   const [topValue, setTopValue] = useState("");
   const [bottomValue, setBottomValue] = useState("");
@@ -97,9 +103,26 @@ const Segmentation = () => {
     });
   };
 
+  // Send the device image ahead; the calculation falls back to sending it inline
+  const prepareImage = async (deviceImageUrl) => {
+    const request = ++prepareRequestRef.current;
+    setPreparedImageId(null);
+    try {
+      const formData = new FormData();
+      formData.append("image", await base64ToBlob(deviceImageUrl), "device-image.png");
+      const response = await backendPost("/images", formData);
+      if (request === prepareRequestRef.current) {
+        setPreparedImageId(response.data.imageId);
+      }
+    } catch (error) {
+      console.warn("Could not send the image ahead:", error);
+    }
+  };
+
   // Handle device measurement completion
   const handleDeviceMeasurementComplete = (deviceImageUrl, width, height, ratio) => {
     setDeviceImage(deviceImageUrl);
+    prepareImage(deviceImageUrl);
     setDeviceWidth(width);
     setDeviceHeight(height);
     setPixelToUnitRatio(ratio);
@@ -111,9 +134,10 @@ const Segmentation = () => {
   };
 
   // Handle area selection completion
-  const handleAreaSelectionComplete = (croppedUrl, selectionSize, maskUrl) => {
+  const handleAreaSelectionComplete = (croppedUrl, selectionSize, maskUrl, selectionGeometry) => {
     setCroppedImageUrl(croppedUrl);
     setMaskImageUrl(maskUrl);
+    setSelection(selectionGeometry);
     setCurrentSelectionSize(selectionSize);
     setActiveStep("colormap");
     setCompletedSteps({
@@ -127,7 +151,10 @@ const Segmentation = () => {
     setImage(null);
     setCroppedImageUrl(null);
     setMaskImageUrl(null);
+    setSelection(null);
     setDeviceImage(null);
+    prepareRequestRef.current++;
+    setPreparedImageId(null);
     setDeviceWidth("");
     setDeviceHeight("");
     setPixelToUnitRatio(null);
@@ -171,33 +198,51 @@ const Segmentation = () => {
     
     setIsLoading(true);
     try {
-      const imageBlob = await base64ToBlob(croppedImageUrl);
-      const maskBlob = await base64ToBlob(maskImageUrl);
+      const buildFormData = async (usePreparedImage) => {
+        const formData = new FormData();
+        if (usePreparedImage) {
+          // The image is already on the backend; send only its id
+          formData.append("imageId", preparedImageId);
+        } else {
+          formData.append("image", await base64ToBlob(croppedImageUrl), "cropped-image.png");
+        }
+        // The selection polygon is rasterized by the backend, a few KB instead of a mask image
+        if (selection) {
+          formData.append("maskGeometry", selectionToMaskGeometry(selection, !usePreparedImage));
+        } else {
+          formData.append("mask", await base64ToBlob(maskImageUrl), "mask.png");
+        }
+        formData.append("topValue", top);
+        formData.append("bottomValue", bottom);
+        formData.append("colorMapSource", colorMapSource);
 
-      const formData = new FormData();
-      formData.append("image", imageBlob, "cropped-image.png");
-      formData.append("mask", maskBlob, "mask.png");
-      formData.append("topValue", top);
-      formData.append("bottomValue", bottom);
-      formData.append("colorMapSource", colorMapSource);
-      
-      // Add custom color map file if "other" is selected
-      if (colorMapSource === "other" && customColorMapImage?.file) {
-        formData.append("colorMap", customColorMapImage.file);
-      }
-      
-      // Add measurement dimensions if available
-      if (currentSelectionSize.area > 0) {
-        formData.append("selectionArea", currentSelectionSize.area.toString());
-      }
+        // Add custom color map file if "other" is selected
+        if (colorMapSource === "other" && customColorMapImage?.file) {
+          formData.append("colorMap", customColorMapImage.file);
+        }
 
-      const backendUrl = window.BACKEND_URL || "http://127.0.0.1:5001";
+        // Add measurement dimensions if available
+        if (currentSelectionSize.area > 0) {
+          formData.append("selectionArea", currentSelectionSize.area.toString());
+        }
+        return formData;
+      };
 
-      const response = await axios.post(`${backendUrl}/calculate-average`, formData, {
-        headers: {
-          "Content-Type": "multipart/form-data",
-        },
-      });
+      const postCalculation = async (usePreparedImage) =>
+        backendPost("/calculate-average", await buildFormData(usePreparedImage));
+
+      const usePreparedImage = Boolean(preparedImageId && selection);
+      let response;
+      try {
+        response = await postCalculation(usePreparedImage);
+      } catch (error) {
+        // The image id expired on the backend: send the image itself
+        if (!usePreparedImage || error.response?.status !== 404) {
+          throw error;
+        }
+        setPreparedImageId(null);
+        response = await postCalculation(false);
+      }
 
       // Determine color map image URL
       let colorMapImageUrl = null;
@@ -0,0 +1,89 @@
+import axios from "axios"
+
+// Content type of the backend's binary frames (backend/app/utils/binary_frame.py)
+export const FRAME_MIMETYPE = "application/x-vistar-frame"
+
+const FRAME_MAGIC = "VSTF"
+const FRAME_VERSION = 1
+
+const TYPED_ARRAYS = {
+  u1: Uint8Array,
+  i1: Int8Array,
+  u2: Uint16Array,
+  i2: Int16Array,
+  u4: Uint32Array,
+  i4: Int32Array,
+  f4: Float32Array,
+  f8: Float64Array,
+}
+
+// Electron's IPC when the page runs in the app, null in a plain browser
+const ipcRenderer = window.require ? window.require("electron").ipcRenderer : null
+
+// Calls `callback` with the backend's addresses once it is ready; returns an unsubscribe function
+export const onBackendReady = (callback) => {
+  if (!ipcRenderer) return null
+  const listener = (_event, info) => callback(info)
+  ipcRenderer.on("backend-ready", listener)
+  // The backend may have been ready before this page loaded
+  ipcRenderer.invoke("backend-info").then((info) => info && callback(info))
+  return () => ipcRenderer.removeListener("backend-ready", listener)
+}
+
+const parseBody = (body, contentType) => {
+  if (contentType && contentType.includes("application/json")) {
+    return JSON.parse(new TextDecoder().decode(body))
+  }
+  return body
+}
+
+// POSTs form data to the backend, over the IPC socket when there is one and
+// HTTP otherwise. Resolves and rejects like axios ({ status, data } and
+// error.response).
+export const backendPost = async (path, formData) => {
+  if (!ipcRenderer || !window.BACKEND_SOCKET) {
+    return axios.post(`${window.BACKEND_URL || "http://127.0.0.1:5001"}${path}`, formData, {
+      headers: {
+        "Content-Type": "multipart/form-data",
+      },
+    })
+  }
+
+  // Let the browser encode the multipart body, then send its bytes as they are
+  const request = new Request("http://backend", { method: "POST", body: formData })
+  const body = new Uint8Array(await request.arrayBuffer())
+  const result = await ipcRenderer.invoke("backend-request", {
+    method: "POST",
+    path,
+    headers: { "Content-Type": request.headers.get("content-type") },
+    body,
+  })
+  const response = { status: result.status, data: parseBody(result.body, result.headers["content-type"]) }
+  if (result.status >= 400) {
+    const error = new Error(`Request failed with status code ${result.status}`)
+    error.response = response
+    throw error
+  }
+  return response
+}
+
+// Unpacks a binary frame into { meta, arrays } with typed array views of the payloads
+export const decodeFrame = (buffer) => {
+  const view = new DataView(buffer)
+  const magic = new TextDecoder().decode(new Uint8Array(buffer, 0, 4))
+  if (magic !== FRAME_MAGIC) throw new Error("Not a binary frame")
+  if (view.getUint8(4) !== FRAME_VERSION) throw new Error(`Unsupported frame version: ${view.getUint8(4)}`)
+  const headerLength = view.getUint32(8, true)
+  const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 12, headerLength)))
+
+  const arrays = {}
+  for (const entry of header.arrays) {
+    const TypedArray = TYPED_ARRAYS[entry.dtype]
+    if (!TypedArray) throw new Error(`Unsupported dtype: ${entry.dtype}`)
+    arrays[entry.name] = {
+      shape: entry.shape,
+      data: new TypedArray(buffer, entry.offset, entry.nbytes / TypedArray.BYTES_PER_ELEMENT),
+    }
+  }
+  return { meta: header.meta, arrays }
+}
@@ -68,3 +68,15 @@ export const base64ToBlob = async (base64String) => {
     throw new Error("Failed to convert image data")
   }
 }
+
+// Mask geometry of an AreaSelection selection for the backend's maskGeometry
+// field: relative to the whole image, or to the cropped image when `cropped`
+export const selectionToMaskGeometry = (selection, cropped) => {
+  const dx = cropped ? selection.left : 0
+  const dy = cropped ? selection.top : 0
+  return JSON.stringify({
+    width: cropped ? selection.width : selection.imageWidth,
+    height: cropped ? selection.height : selection.imageHeight,
+    shapes: [{ type: "polygon", points: selection.points.map(([x, y]) => [x - dx, y - dy]) }],
+  })
+}